@@ -1,5 +1,41 @@
+import os
+import functools
+
 from pyramid.config import Configurator
 from pyramid.renderers import JSONP
+from pyramid.settings import asbool
+
+from .profiling import StackSampler
+from .lookupcache import SQLiteLookupCache
+from .concurrency import SingleFlight, UpstreamLimiter, HedgingPolicy
+from .resilience import CircuitBreaker
+from .records import RecordStore
+from .rendercache import RenderCache
+from .scheduler import BundleScheduler, PrebuiltBundles, parse_jobs
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+
+def _upstream_limiter(settings):
+    """
+    Builds the limiter of the requests made to the Journal Manager from
+    the ``delorean.upstream.*`` settings. Per endpoint limits are given
+    as ``delorean.upstream.rate.<endpoint> = <rate> [<burst>]``.
+    """
+    prefix = 'delorean.upstream.rate.'
+    endpoint_limits = {}
+    for key, value in settings.items():
+        if key.startswith(prefix) and value.strip():
+            limit = [float(v) for v in value.split()]
+            endpoint_limits[key[len(prefix):]] = (limit[0], limit[-1])
+
+    rate = settings.get('delorean.upstream.rate', '').strip()
+    return UpstreamLimiter(
+        max_concurrency=int(settings.get('delorean.upstream.max_concurrency', 0)),
+        rate=float(rate) if rate else None,
+        burst=float(settings.get('delorean.upstream.burst', 1)),
+        endpoint_limits=endpoint_limits)
+
 
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
@@ -11,5 +47,57 @@ def main(global_config, **settings):
 
     config.add_route('home', '/')
     config.add_route('generate', '/generate/{resource}')
+    config.add_route('admin_stacks', '/admin/stacks/{resource}')
+    config.add_route('notify', '/notify')
+
+    # concurrent requests for the same bundle share a single generation
+    config.registry.single_flight = SingleFlight()
+    config.registry.upstream_limiter = _upstream_limiter(settings)
+    config.registry.circuit_breaker = CircuitBreaker(
+        failure_rate=float(settings.get('delorean.circuit_breaker.failure_rate', 0.5)),
+        window=int(settings.get('delorean.circuit_breaker.window', 20)),
+        min_calls=int(settings.get('delorean.circuit_breaker.min_calls', 10)),
+        reset_timeout=int(settings.get('delorean.circuit_breaker.reset_timeout', 30)))
+
+    if asbool(settings.get('delorean.sampler', False)):
+        config.registry.sampler = StackSampler(
+            interval=float(settings.get('delorean.sampler.interval', 0.01)))
+        config.registry.sampler.start()
+
+    if asbool(settings.get('delorean.hedging', False)):
+        config.registry.hedging = HedgingPolicy(
+            percentile=float(settings.get('delorean.hedging.percentile', 95)),
+            min_samples=int(settings.get('delorean.hedging.min_samples', 20)),
+            max_extra=float(settings.get('delorean.hedging.max_extra', 0.1)))
+
+    if settings.get('delorean.lookup_cache.path'):
+        config.registry.lookup_cache = SQLiteLookupCache(
+            settings['delorean.lookup_cache.path'],
+            ttl=int(settings.get('delorean.lookup_cache.ttl', 3600)))
+
+    if settings.get('delorean.render_cache.path'):
+        config.registry.render_cache = RenderCache(
+            settings['delorean.render_cache.path'],
+            max_age=int(settings.get('delorean.render_cache.max_age',
+                                     30 * 24 * 3600)))
+        config.registry.render_cache.prune()
+
+    if settings.get('delorean.records.dir'):
+        config.registry.record_store = RecordStore(
+            settings['delorean.records.dir'])
+
+    jobs = parse_jobs(settings.get('delorean.schedule.jobs', ''))
+    if jobs:
+        from .views import pregenerate
+        index_path = settings.get('delorean.schedule.index',
+                                  os.path.join(HERE, 'prebuilt.json'))
+        config.registry.prebuilt_bundles = PrebuiltBundles(
+            index_path, os.path.join(HERE, 'public'))
+        config.registry.scheduler = BundleScheduler(
+            jobs, functools.partial(pregenerate, config.registry),
+            lock_dir=settings.get('delorean.schedule.lock_dir') or
+                os.path.join(os.path.dirname(index_path), 'schedule_locks'))
+        config.registry.scheduler.start()
+
     config.scan()
     return config.make_wsgi_app()
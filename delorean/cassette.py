@@ -0,0 +1,110 @@
+# coding: utf-8
+"""
+Record/replay of the Journal Manager responses, so that real
+generations can be rerun offline.
+"""
+import time
+import gzip
+import json
+import base64
+import threading
+
+import requests
+
+from .upstream import request_key
+
+
+class CassetteMissError(LookupError):
+    def __init__(self, *args, **kwargs):
+        super(CassetteMissError, self).__init__(*args, **kwargs)
+
+
+class Cassette(object):
+    """
+    Gzipped JSON-lines file where each line is an upstream interaction.
+
+    In ``record`` mode the interactions are appended as they happen.
+    In ``replay`` mode they are served back, in the recorded order
+    when the same request was made more than once. With
+    ``emulate_timing``, each replayed response takes as long as the
+    original one did.
+    """
+    def __init__(self, path, mode='replay', emulate_timing=False,
+                 sleep=time.sleep):
+        if mode not in ('record', 'replay'):
+            raise ValueError('unknown cassette mode: %s' % mode)
+
+        self.path = path
+        self.mode = mode
+        self._emulate_timing = emulate_timing
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._file = None
+        self._closed = False
+        self._interactions = None
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    key = staticmethod(request_key)
+
+    def record(self, method, url, params, response, elapsed):
+        line = json.dumps({
+            'key': self.key(method, url, params),
+            'status': response.status_code,
+            'headers': dict(response.headers),
+            'body': base64.b64encode(response.content),
+            'elapsed': elapsed,
+        })
+        with self._lock:
+            # reopening would truncate what was recorded so far
+            if self._closed:
+                raise ValueError('cassette closed: %s' % self.path)
+            if self._file is None:
+                self._file = gzip.open(self.path, 'wb')
+            self._file.write(line + '\n')
+
+    def _load(self):
+        interactions = {}
+        with gzip.open(self.path, 'rb') as f:
+            for line in f:
+                interaction = json.loads(line)
+                interactions.setdefault(interaction['key'], []).append(
+                    interaction)
+        return interactions
+
+    def play(self, method, url, params=None):
+        """
+        Returns the recorded ``requests.Response`` for the given request.
+        """
+        key = self.key(method, url, params)
+        with self._lock:
+            if self._interactions is None:
+                self._interactions = self._load()
+
+            try:
+                recorded = self._interactions[key]
+            except KeyError:
+                raise CassetteMissError('request not recorded: %s' % key)
+
+            # the last response is reused when the request was repeated
+            # more times than it was recorded.
+            interaction = recorded.pop(0) if len(recorded) > 1 else recorded[0]
+
+        if self._emulate_timing:
+            self._sleep(interaction['elapsed'])
+
+        response = requests.Response()
+        response.status_code = interaction['status']
+        response.headers.update(interaction['headers'])
+        response._content = base64.b64decode(interaction['body'])
+        response.url = url
+        return response
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,151 @@
+# coding: utf-8
+"""
+Crawl checkpoints, so that an interrupted generation can be resumed.
+"""
+import os
+import json
+import time
+import uuid
+import fcntl
+import logging
+import threading
+
+from .storage import json_default
+
+logger = logging.getLogger(__name__)
+
+
+class Checkpoint(object):
+    """
+    JSON-lines file where each line holds the records collected from a
+    page of a resource and the offset of the next page (``null`` after
+    the last one).
+
+    Lines are flushed to disk as the pages are completed, so a crawl
+    interrupted at any point can resume from its last completed page.
+    A line left incomplete by a crash is ignored.
+
+    The first line identifies the crawl and tells when it started; the
+    pages of crawls started more than ``max_age`` seconds ago are
+    discarded, as the listing has likely changed since. A generation
+    :meth:`acquire`\ s the checkpoint, so that no other one, in this or
+    another process, appends to it at the same time.
+    """
+    def __init__(self, path, max_age=None, clock=time.time):
+        self.path = path
+        self._max_age = max_age
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self.run = None  # the crawl the file holds the pages of
+
+    def _ensure_dir(self):
+        base_path = os.path.dirname(self.path)
+        if base_path and not os.path.exists(base_path):
+            try:
+                os.makedirs(base_path, 0755)
+            except OSError:  # created meanwhile
+                if not os.path.isdir(base_path):
+                    raise
+
+    def acquire(self):
+        """
+        Takes the checkpoint, returning ``False`` if another generation
+        holds it.
+        """
+        self._ensure_dir()
+        lock_file = open(self.path + '.lock', 'ab')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def release(self):
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _discard(self, reason):
+        logger.info('Discarding %s: %s.' % (self.path, reason))
+        os.remove(self.path)
+        self.run = None
+
+    def load(self):
+        """
+        Returns ``(offset, records, finished)``: the offset of the next
+        page to be fetched, the records collected so far and whether the
+        crawl reached its last page.
+        """
+        offset, records, finished = 0, [], False
+        if not os.path.exists(self.path):
+            return offset, records, finished
+
+        with open(self.path, 'r+b') as f:
+            try:
+                header = json.loads(f.readline())
+                run, created = header['run'], header['created']
+            except (ValueError, KeyError, TypeError):
+                self._discard('no crawl header')
+                return offset, records, finished
+            if (self._max_age is not None and
+                    self._clock() - created > self._max_age):
+                self._discard('crawl %s is too old' % run)
+                return offset, records, finished
+
+            self.run = run
+            position = f.tell()
+            for line in iter(f.readline, b''):
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('incomplete line')
+                    page = json.loads(line)
+                except ValueError:
+                    # interrupted while writing the line, which is
+                    # dropped before new pages are appended.
+                    f.truncate(position)
+                    break
+
+                position += len(line)
+                records.extend(page['records'])
+                if page['next'] is None:
+                    finished = True
+                else:
+                    offset = page['next']
+
+        return offset, records, finished
+
+    def save(self, next_offset, records):
+        """
+        Records that a page was completed, yielding ``records``.
+        """
+        line = json.dumps({'next': next_offset, 'records': records},
+                          default=json_default)
+        with self._lock:
+            self._ensure_dir()
+            if self.run is None:
+                # the first page of a new crawl
+                self.run = uuid.uuid4().hex
+                header = json.dumps({'run': self.run, 'created': self._clock()})
+                mode = 'wb'
+            else:
+                header, mode = None, 'ab'
+
+            with open(self.path, mode) as f:
+                if header is not None:
+                    f.write(header + '\n')
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def clear(self):
+        """
+        Discards the checkpoint, once the generation was deployed.
+        """
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.run = None
@@ -0,0 +1,92 @@
+# coding: utf-8
+"""
+Compact records: the data of a record projected onto the fields its
+template uses, kept in slots instead of a dict.
+"""
+
+
+class CompactRecord(object):
+    """
+    Read-only mapping of the fields of a record, each in a slot.
+
+    Fields missing from the projected data are missing from the mapping
+    too, so templates telling them apart with ``UNDEFINED`` still work.
+    Being read-only, records may be shared, e.g. the journal of all the
+    issues of a journal.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def project(cls, data):
+        """
+        Returns a record with the fields of ``data`` among the slots.
+        """
+        record = cls.__new__(cls)
+        for field in cls.__slots__:
+            if field in data:
+                object.__setattr__(record, field, data[field])
+        return record
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is read-only' % type(self).__name__)
+
+    def __getitem__(self, key):
+        if key in self.__slots__:
+            try:
+                return getattr(self, key)
+            except AttributeError:  # not in the projected data
+                pass
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def keys(self):
+        return [field for field in self.__slots__ if field in self]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.keys()]
+
+    def __eq__(self, other):
+        if isinstance(other, (CompactRecord, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def to_dict(self):
+        """
+        Returns the fields as a dict, with the nested records as dicts.
+        """
+        return dict((field, value.to_dict()
+                     if isinstance(value, CompactRecord) else value)
+                    for field, value in self.items())
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.to_dict())
+
+
+def record_type(name, fields):
+    """
+    Returns a :class:`CompactRecord` subclass with a slot per field.
+    """
+    return type(str(name), (CompactRecord,),
+                {'__slots__': tuple(str(field) for field in fields)})
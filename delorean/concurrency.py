@@ -0,0 +1,340 @@
+# coding: utf-8
+"""
+Coordination of the generations running concurrently in a process.
+"""
+import sys
+import time
+import Queue
+import urlparse
+import threading
+import collections
+from contextlib import contextmanager
+
+from .resilience import DeadlineExceeded
+from .tracing import traced
+
+
+class _Call(object):
+    def __init__(self, cancellation=None):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.cancellation = cancellation
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """
+    Deduplicates concurrent calls sharing the same key.
+
+    While a call is in flight, later calls with the same key don't run
+    their function: they wait for the running one and get its result,
+    or its exception. Those waiting for more than ``timeout`` seconds
+    give up with :class:`delorean.resilience.DeadlineExceeded`.
+
+    With a ``timeout``, the function runs in a thread of its own, so that
+    the caller that started it may give up waiting too, while the call
+    goes on for the others. When all of them gave up, the ``cancellation``
+    token given by the caller that started it is cancelled, and later
+    calls start over. Callers without a timeout never give up.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, timeout=None, cancellation=None):
+        """
+        Returns a ``(result, shared)`` pair, where ``shared`` tells if the
+        result was produced by a call made by someone else.
+
+        ``cancellation`` is the token ``func`` runs under, if any.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call(cancellation)
+            call.waiters += 1
+
+        if leader and timeout is None:
+            self._run(key, call, func)
+        else:
+            if leader:
+                thread = threading.Thread(target=traced(self._run),
+                                          args=(key, call, func))
+                thread.daemon = True
+                thread.start()
+            if not call.done.wait(timeout):
+                self._give_up(key, call)
+                raise DeadlineExceeded('gave up waiting for %s' % (key,))
+
+        if call.exc_info is not None:
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+
+        return call.result, not leader
+
+    def _give_up(self, key, call):
+        with self._lock:
+            call.waiters -= 1
+            if (call.waiters or call.cancellation is None or
+                    call.done.is_set()):
+                return
+            # nobody is left waiting for the call
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.cancellation.cancel()
+
+    def _run(self, key, call, func):
+        try:
+            call.result = func()
+        except Exception:
+            call.exc_info = sys.exc_info()
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+
+
+class TokenBucket(object):
+    """
+    Allows ``rate`` operations per second, with bursts of up to
+    ``burst`` operations.
+    """
+    def __init__(self, rate, burst=1, clock=time.time, sleep=time.sleep):
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = self._burst
+        self._updated = clock()
+
+    def acquire(self):
+        """
+        Takes a token, waiting for it if needed, and returns the time
+        spent waiting.
+        """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self._burst,
+                self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+
+            # the token is reserved before waiting, so the concurrent
+            # callers queue up behind it.
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0.0
+
+        if wait:
+            self._sleep(wait)
+        return wait
+
+
+def endpoint_name(url):
+    """
+    Name of the API endpoint ``url`` belongs to, e.g. ``journals``
+    for ``http://manager.scielo.org/api/v1/journals/1/``.
+    """
+    segments = [seg for seg in urlparse.urlsplit(url).path.split('/') if seg]
+    while segments and segments[-1].isdigit():
+        segments.pop()
+    return segments[-1] if segments else ''
+
+
+class UpstreamLimiter(object):
+    """
+    Process-wide limits for the requests made to the upstream API: at most
+    ``max_concurrency`` requests at once, and a token bucket per endpoint.
+
+    ``endpoint_limits`` maps endpoint names to ``(rate, burst)`` pairs,
+    endpoints not listed there are limited by ``rate`` and ``burst``.
+    A ``None`` rate leaves them unlimited.
+    """
+    def __init__(self, max_concurrency=None, rate=None, burst=1,
+                 endpoint_limits=None, clock=time.time, sleep=time.sleep):
+        self._clock = clock
+        self._sleep = sleep
+        self._default_limit = (rate, burst)
+        self._endpoint_limits = endpoint_limits or {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+        if max_concurrency:
+            self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        else:
+            self._semaphore = None
+
+    def _bucket(self, endpoint):
+        with self._lock:
+            if endpoint not in self._buckets:
+                rate, burst = self._endpoint_limits.get(endpoint,
+                                                        self._default_limit)
+                self._buckets[endpoint] = TokenBucket(
+                    rate, burst, clock=self._clock,
+                    sleep=self._sleep) if rate else None
+            return self._buckets[endpoint]
+
+    @contextmanager
+    def slot(self, endpoint):
+        """
+        Holds a request slot for ``endpoint`` while the context is active.
+        Yields the time spent waiting for it.
+        """
+        start = self._clock()
+        bucket = self._bucket(endpoint)
+        if bucket is not None:
+            bucket.acquire()
+
+        if self._semaphore is not None:
+            self._semaphore.acquire()
+        try:
+            yield self._clock() - start
+        finally:
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+
+class HedgingPolicy(object):
+    """
+    Hedges slow idempotent requests: when a request hasn't answered
+    within the ``percentile`` latency observed for its endpoint, a
+    duplicate is sent and the first answer is taken.
+
+    Hedging starts once ``min_samples`` latencies of the endpoint were
+    observed, and duplicates are limited to ``max_extra`` of the requests.
+    A request can't be aborted midway, so the losing response is just
+    closed once it arrives, releasing its connection.
+    """
+    def __init__(self, percentile=95, min_samples=20, max_extra=0.1,
+                 window=200):
+        self._percentile = percentile
+        self._min_samples = min_samples
+        self._max_extra = max_extra
+        self._window = window
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._requests = 0
+        self._hedges = 0
+
+    def observe(self, endpoint, latency):
+        with self._lock:
+            self._latencies.setdefault(endpoint, collections.deque(
+                maxlen=self._window)).append(latency)
+
+    def delay(self, endpoint):
+        """
+        Seconds to wait for a response of ``endpoint`` before hedging,
+        or ``None`` while there are not enough samples.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies.get(endpoint, ()))
+        if len(latencies) < self._min_samples:
+            return None
+        index = int(round(self._percentile / 100.0 * (len(latencies) - 1)))
+        return latencies[index]
+
+    def _allow_hedge(self):
+        with self._lock:
+            if self._hedges + 1 > self._max_extra * self._requests:
+                return False
+            self._hedges += 1
+            return True
+
+    def _attempt(self, func, results):
+        start = time.time()
+        try:
+            results.put((True, func(), time.time() - start))
+        except Exception:
+            results.put((False, sys.exc_info(), time.time() - start))
+
+    @staticmethod
+    def _spawn(target, *args):
+        thread = threading.Thread(target=traced(target), args=args)
+        thread.daemon = True
+        thread.start()
+
+    @staticmethod
+    def _discard(results, pending):
+        # the losers are closed as they arrive
+        for i in range(pending):
+            ok, value, elapsed = results.get()
+            if ok:
+                value.close()
+
+    def call(self, endpoint, func):
+        """
+        Calls ``func``, hedging it if it is slow, and returns the first
+        response.
+        """
+        with self._lock:
+            self._requests += 1
+
+        delay = self.delay(endpoint)
+        if delay is None:
+            start = time.time()
+            response = func()
+            self.observe(endpoint, time.time() - start)
+            return response
+
+        results = Queue.Queue()
+        self._spawn(self._attempt, func, results)
+        pending = 1
+
+        try:
+            outcome = results.get(timeout=delay)
+        except Queue.Empty:
+            if self._allow_hedge():
+                self._spawn(self._attempt, func, results)
+                pending += 1
+            outcome = results.get()
+        pending -= 1
+
+        ok, value, elapsed = outcome
+        if not ok and pending:
+            # the duplicate may still succeed
+            ok, value, elapsed = results.get()
+            pending -= 1
+
+        if pending:
+            self._spawn(self._discard, results, pending)
+
+        if not ok:
+            raise value[0], value[1], value[2]
+
+        self.observe(endpoint, elapsed)
+        return value
+
+
+def parallel_map(func, items, workers=None):
+    """
+    Calls ``func`` for each one of ``items``, each in its own thread, and
+    returns the results in the order of ``items``. The exception of the
+    first failed call, if any, is raised once all of them are done.
+
+    With ``workers``, no more than that many calls run at a time.
+    """
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    slots = threading.BoundedSemaphore(workers or max(1, len(items)))
+
+    def run(i, item):
+        with slots:
+            try:
+                results[i] = func(item)
+            except Exception:
+                errors[i] = sys.exc_info()
+
+    run = traced(run)
+    threads = [threading.Thread(target=run, args=(i, item))
+               for i, item in enumerate(items)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for exc_info in errors:
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+    return results
@@ -0,0 +1,190 @@
+# coding: utf-8
+"""
+Sources of the Journal Manager resources read by the collectors: the
+live API or an offline snapshot of it.
+"""
+import os
+import gzip
+import json
+import mmap
+import time
+import shutil
+import datetime
+
+import requests
+import slumber
+
+from .resilience import backoff_delay
+
+# resources needed to generate the title, issue and section bundles
+SNAPSHOT_RESOURCES = ('journals', 'issues', 'sections', 'sponsors', 'users')
+
+
+class ResourceNotFoundError(LookupError):
+    def __init__(self, *args, **kwargs):
+        super(ResourceNotFoundError, self).__init__(*args, **kwargs)
+
+
+class APIDataSource(object):
+    """
+    Reads the resources from the Journal Manager API, the default source
+    of the collectors.
+    """
+    def __init__(self, api_uri, username=None, api_key=None, session=None,
+                 serializer=None, slumber_lib=slumber):
+        api_kwargs = {}
+        if session is not None:
+            api_kwargs['session'] = session
+        if serializer is not None:
+            api_kwargs['serializer'] = serializer
+        self._api = slumber_lib.API(api_uri, **api_kwargs)
+        self._auth = {}
+        if all([username, api_key]):
+            self._auth = {'username': username, 'api_key': api_key}
+
+    def page(self, resource, offset, limit, collection=None):
+        kwargs = dict(self._auth)
+        if collection:
+            kwargs['collection'] = collection
+        return getattr(self._api, resource).get(offset=offset, limit=limit,
+                                                **kwargs)
+
+    def get(self, endpoint, res_id, collection=None):
+        """
+        Returns a single resource, looked up on behalf of the generation
+        of ``collection``.
+        """
+        kwargs = dict(self._auth)
+        if self._auth:
+            # sent even when None, the cached lookups are keyed by it
+            kwargs['collection'] = collection
+        try:
+            return getattr(self._api, endpoint)(res_id).get(**kwargs)
+        except slumber.exceptions.HttpNotFoundError:
+            raise ResourceNotFoundError('%s %s not found' % (endpoint, res_id))
+
+
+def write_snapshot(source, path, collection=None, resources=SNAPSHOT_RESOURCES,
+                   limit=50, max_retries=10, sleep=time.sleep):
+    """
+    Dumps the raw ``resources`` of a ``collection``, read from
+    ``source``, to ``path``: a gzipped JSON-lines file whose first line
+    describes the snapshot and the others hold an object each.
+
+    Returns the number of objects per resource.
+    """
+    counts = dict((resource, 0) for resource in resources)
+    tmp_path = path + '.part'
+    with gzip.open(tmp_path, 'wb') as out:
+        out.write(json.dumps({'snapshot': {
+            'collection': collection,
+            'resources': list(resources),
+            'created': datetime.datetime.utcnow().isoformat(),
+        }}) + '\n')
+
+        for resource in resources:
+            offset, retries = 0, 0
+            while True:
+                try:
+                    page = source.page(resource, offset, limit, collection)
+                except requests.exceptions.ConnectionError:
+                    if retries == max_retries:
+                        raise
+                    sleep(backoff_delay(retries))
+                    retries += 1
+                    continue
+
+                for obj in page['objects']:
+                    res_id = obj.get('id')
+                    if res_id is None:
+                        res_id = obj['resource_uri'].strip('/').split('/')[-1]
+                    # the object goes last, so that the index is built
+                    # without decoding it.
+                    out.write(b'{"resource": %s, "id": %s, "object": %s}\n' % (
+                        json.dumps(resource), json.dumps(unicode(res_id)),
+                        json.dumps(obj)))
+                    counts[resource] += 1
+
+                if not page['meta']['next']:
+                    break
+                offset, retries = offset + limit, 0
+
+    os.rename(tmp_path, path)
+    return counts
+
+
+class SnapshotDataSource(object):
+    """
+    Reads the resources from a snapshot written by
+    :func:`write_snapshot`.
+
+    The snapshot is unpacked once, aside it, and the unpacked file is
+    memory-mapped. Objects are decoded only when they are read, through
+    an index of their positions built when the source is opened.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._unpacked_path = path + '.unpacked'
+        self._unpack()
+
+        self._file = open(self._unpacked_path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._ids = {}  # resource -> ids, in the snapshot order
+        self._positions = {}  # (resource, id) -> (start, end)
+        self._index()
+
+    def _unpack(self):
+        if (os.path.exists(self._unpacked_path) and
+                os.path.getmtime(self._unpacked_path) >= os.path.getmtime(self.path)):
+            return
+
+        tmp_path = self._unpacked_path + '.%s.tmp' % os.getpid()
+        with gzip.open(self.path, 'rb') as packed:
+            with open(tmp_path, 'wb') as unpacked:
+                shutil.copyfileobj(packed, unpacked)
+        os.rename(tmp_path, self._unpacked_path)
+
+    def _index(self):
+        self.info = json.loads(self._map.readline())['snapshot']
+        start = self._map.tell()
+        for line in iter(self._map.readline, b''):
+            end = start + len(line)
+            # only the keys are decoded, the objects are left for later
+            head = json.loads(line[:line.index(b', "object": ')] + b'}')
+            key = (head['resource'], head['id'])
+            self._ids.setdefault(head['resource'], []).append(head['id'])
+            self._positions[key] = (start, end)
+            start = end
+
+    def _load(self, resource, res_id):
+        try:
+            start, end = self._positions[(resource, unicode(res_id))]
+        except KeyError:
+            raise ResourceNotFoundError('%s %s not in the snapshot' % (
+                resource, res_id))
+        return json.loads(self._map[start:end])['object']
+
+    def page(self, resource, offset, limit, collection=None):
+        if collection != self.info['collection']:
+            raise ValueError('snapshot of %s, not %s' % (
+                self.info['collection'] or 'all', collection or 'all'))
+
+        ids = self._ids.get(resource, [])
+        next_offset = offset + limit
+        return {
+            'meta': {
+                'offset': offset,
+                'limit': limit,
+                'total_count': len(ids),
+                'next': next_offset if next_offset < len(ids) else None,
+            },
+            'objects': [self._load(resource, res_id)
+                        for res_id in ids[offset:next_offset]],
+        }
+
+    def get(self, endpoint, res_id, collection=None):
+        return self._load(endpoint, res_id)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
@@ -0,0 +1,108 @@
+# coding: utf-8
+"""
+Differences between the ID files of two generations.
+"""
+import re
+import tarfile
+import collections
+
+# fields identifying the records of each database, written for every
+# record (unlike the ISSN, only written along with scielo_issn)
+KEY_FIELDS = {
+    'title': ('v068',),  # acronym
+    'issue': ('v930', 'v036'),  # journal acronym, year + order
+    'section': ('v930',),  # journal acronym
+}
+
+RECORD_START = re.compile(r'^!ID ', re.MULTILINE)
+
+
+def split_records(id_string):
+    """
+    Splits the contents of an ID file into the text of its records.
+    """
+    starts = [match.start() for match in RECORD_START.finditer(id_string)]
+    return [id_string[start:end].rstrip('\n')
+            for start, end in zip(starts, starts[1:] + [len(id_string)])]
+
+
+def record_key(record, fields):
+    """
+    Returns the values of the first occurrence of ``fields`` in the
+    record, e.g. ``(u'0102-6720', u'20101')`` for ``('v035', 'v036')``.
+    """
+    values = []
+    for field in fields:
+        match = re.search(r'^!%s!(.*)$' % field, record, re.MULTILINE)
+        values.append(match.group(1) if match else '')
+    return tuple(values)
+
+
+def _keyed(records, fields):
+    """
+    Returns the ``records`` by their key, raising ``ValueError`` when
+    two of them share it, as telling them apart would be impossible.
+    """
+    keyed = collections.OrderedDict()
+    for record in records:
+        key = record_key(record, fields)
+        if key in keyed:
+            raise ValueError('records with the same key: %s' % (key,))
+        keyed[key] = record
+    return keyed
+
+
+def diff(previous, current, fields):
+    """
+    Compares the ID files ``previous`` and ``current``, returning the
+    records of ``current`` that were added or changed, the keys of the
+    changed records and the keys of the removed records.
+    """
+    previous_records = _keyed(split_records(previous), fields)
+
+    updated, changed, seen = [], [], set()
+    for key, record in _keyed(split_records(current), fields).items():
+        seen.add(key)
+        if key not in previous_records:
+            updated.append(record)
+        elif previous_records[key] != record:
+            updated.append(record)
+            changed.append(key)
+
+    removed = [key for key in previous_records if key not in seen]
+    return updated, changed, sorted(removed)
+
+
+def is_full_bundle(path, prefix):
+    """
+    Tells if the bundle at ``path`` can be the base of a delta of
+    ``prefix`` records: it holds the whole ``<prefix>.id`` file, i.e.
+    it is neither a delta nor sharded, nor generated without the ID
+    format.
+    """
+    try:
+        bundle = tarfile.open(path)
+    except (IOError, tarfile.TarError):
+        return False
+    try:
+        names = set(bundle.getnames())
+    finally:
+        bundle.close()
+    return ('%s.id' % prefix in names and
+            '%s.delta.json' % prefix not in names)
+
+
+def read_member(path, name):
+    """
+    Returns the contents of the member ``name`` of a bundle, or
+    ``None`` if there is no such member.
+    """
+    bundle = tarfile.open(path)
+    try:
+        try:
+            member = bundle.extractfile(name)
+        except KeyError:
+            return None
+        return member.read().decode('cp1252')
+    finally:
+        bundle.close()
@@ -3,10 +3,14 @@ from __future__ import unicode_literals
 
 import time
 import os
+import json
+import zlib
+import hashlib
 import tarfile
 import StringIO
 import tempfile
 import collections
+import multiprocessing
 from datetime import datetime
 import logging
 from abc import (
@@ -19,9 +23,46 @@ from mako.template import Template
 from mako.exceptions import RichTraceback
 import slumber
 
+from .profiling import phase, collected
+from .tracing import span
+from .resilience import backoff_delay
+from .checkpoint import Checkpoint
+from .rendercache import fingerprint
+from . import delta
+from . import isis
+from .writers import WRITERS
+from .compact import CompactRecord, record_type
+from .datasources import APIDataSource, ResourceNotFoundError
 
 logger = logging.getLogger(__name__)
+HERE = os.path.abspath(os.path.dirname(__file__))
 ITEMS_PER_REQUEST = 50
+MAX_RETRIES = 10
+RETRY_BASE_DELAY = 1  # seconds
+RETRY_MAX_DELAY = 60  # seconds
+# members a bundle may have, besides the delta ones
+OUTPUT_FORMATS = ('id', 'mst', 'iso', 'jsonl', 'csv')
+DEFAULT_FORMATS = ('id',)
+# formats written from the rendered ID records
+ID_FORMATS = ('id', 'mst', 'iso')
+# how the records are split into the shards of the ID file
+SHARD_BY = ('count', 'journal')
+# seconds between the checks of the cancellation while shards render
+SHARD_POLL_INTERVAL = 0.1
+# fields of the journal of each issue
+ISSUE_JOURNAL_FIELDS = ('title', 'short_title', 'medline_title', 'publisher_name',
+                        'publication_city', 'sponsors', 'print_issn',
+                        'eletronic_issn', 'scielo_issn', 'resource_uri',
+                        'acronym', 'title_iso', 'use_license')
+# fields read by the templates, onto which compact records are projected
+ISSUE_TEMPLATE_FIELDS = ('journal', 'volume', 'number', 'thematic_titles',
+                         'order', 'is_press_release', 'is_trashed', 'display',
+                         'sections', 'publication_date', 'ctrl_vocabulary',
+                         'updated', 'editorial_standard', 'total_documents',
+                         'suppl_volume', 'suppl_number', 'is_marked_up',
+                         'use_license')
+SECTION_TEMPLATE_FIELDS = ('acronym', 'title', 'short_title', 'scielo_issn',
+                           'print_issn', 'eletronic_issn', 'sections')
 MONTH_ABBREVS = {'es_ES': {1: 'ene', 2: 'feb', 3: 'mar', 4: 'abr',
         5: 'may', 6: 'jun', 7: 'jul', 8: 'ago', 9: 'sep', 10: 'oct',
         11: 'nov', 12: 'dic'}, 'en_US': {1: 'Jan', 2: 'Feb', 3: 'Mar',
@@ -42,8 +83,17 @@ class Bundle(object):
         Accepts an arbitrary number of logical name - data pairs::
 
           b = Bundle(('arq1', 'arq1 content as str'))
+
+        Text is packed encoded as cp1252, bytes are packed as they are.
+
+        An optional ``cancellation`` token is checked between members.
         """
         self._data = dict(args)
+        self._cancellation = kwargs.get('cancellation', None)
+
+    def _check_cancellation(self):
+        if self._cancellation is not None:
+            self._cancellation.check()
 
     def _tar(self):
         """
@@ -55,25 +105,60 @@ class Bundle(object):
         out = tarfile.open(tmp.name, 'w')
 
         try:
-            for name, data in self._data.items():
-                info = tarfile.TarInfo(name)
-                info.size = len(data)
-                out.addfile(info, StringIO.StringIO(data.encode('cp1252', 'replace')))
-        finally:
+            with span('bundle.tar'), phase('tar'):
+                for name, data in self._data.items():
+                    self._check_cancellation()
+                    if isinstance(data, unicode):
+                        data = data.encode('cp1252', 'replace')
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    out.addfile(info, StringIO.StringIO(data))
+        except:
+            out.close()
+            tmp.close()  # removes the temporary file
+            raise
+        else:
             out.close()
 
         tmp.seek(0)
         return tmp
 
     def deploy(self, target):
+        """
+        Writes the tarball to ``target``. It is written aside and then
+        renamed, so a failed deploy never leaves a partial bundle behind.
+        """
         data = self._tar()
 
         base_path = os.path.split(os.path.splitext(target)[-2])[0]
         if not os.path.exists(base_path):
             os.makedirs(base_path, 0755)
 
-        with open(target, 'w') as f:
-            f.write(data.read())
+        partial_target = target + '.part'
+        try:
+            self._check_cancellation()
+            with span('bundle.deploy', target=target), phase('deploy'):
+                with open(partial_target, 'w') as f:
+                    f.write(data.read())
+            os.rename(partial_target, target)
+        except:
+            if os.path.exists(partial_target):
+                os.remove(partial_target)
+            raise
+        finally:
+            data.close()
+
+
+def _restore_transformer(source, render_cache):
+    return Transformer(source, render_cache=render_cache)
+
+
+def _render_shard(task):
+    """
+    Renders the records of a shard, in a process of the pool.
+    """
+    transformer, records = task
+    return [transformer.transform(data) for data in records]
 
 
 class Transformer(object):
@@ -84,6 +169,9 @@ class Transformer(object):
     def __init__(self, *args, **kwargs):
         """
         Accepts a ``template`` as a string.
+
+        With a ``render_cache``, records already rendered by the same
+        template are not rendered again.
         """
         if args:
             self._template = Template(args[0])
@@ -93,16 +181,36 @@ class Transformer(object):
         else:
             raise TypeError()
 
+        self._render_cache = kwargs.get('render_cache', None)
+        if self._render_cache is not None:
+            self._template_version = hashlib.sha1(
+                self._template.source.encode('utf-8')).hexdigest()
+
+    def __reduce__(self):
+        # compiled templates can't be pickled; they are compiled again
+        return (_restore_transformer, (self._template.source,
+                                       self._render_cache))
+
     def transform(self, data):
         """
         Renders a template using the given data.
         ``data`` must be dict.
         """
-        if not isinstance(data, dict):
+        if not isinstance(data, (dict, CompactRecord)):
             raise TypeError('data must be dict')
 
         try:
-            return self._template.render(**data)
+            with span('render') as args:
+                if self._render_cache is None:
+                    return self._template.render(**data)
+
+                key = fingerprint(self._template_version, data)
+                text = self._render_cache.get(key)
+                args['cached'] = text is not None
+                if text is None:
+                    text = self._template.render(**data)
+                    self._render_cache.set(key, text)
+                return text
         except NameError, exc:
             raise ValueError("there are some data missing: {}".format(exc))
         except:
@@ -112,10 +220,13 @@ class Transformer(object):
                 print line, "\n"
             print "%s: %s" % (str(traceback.error.__class__.__name__), traceback.error)
 
-    def transform_list(self, data_list, callabl=None):
+    def transform_list(self, data_list, callabl=None, cancellation=None):
         """
         Renders a template using the given list of data.
         ``data_list`` must be list or tuple.
+
+        The optional ``cancellation`` token is checked before each
+        record is rendered.
         """
         if isinstance(data_list, str) or isinstance(data_list, dict) or \
            isinstance(data_list, set):
@@ -128,10 +239,14 @@ class Transformer(object):
         if callabl:
             callabl(data_list)
 
-        for data in data_list:
-            res.append(self.transform(data))
+        with phase('render'):
+            for data in data_list:
+                if cancellation is not None:
+                    cancellation.check()
+                res.append(self.transform(data))
 
-        return '\n'.join(res)
+        with phase('join'):
+            return '\n'.join(res)
 
 
 class DataCollector(object):
@@ -143,73 +258,187 @@ class DataCollector(object):
     """
     __metaclass__ = ABCMeta
 
+    # compact records the data is projected onto, if any
+    _record_type = None
+
     def __init__(self,
                  resource_url,
                  slumber_lib=slumber,
                  collection=None,
                  username=None,
-                 api_key=None):
+                 api_key=None,
+                 session=None,
+                 serializer=None,
+                 lookup_cache=None,
+                 cancellation=None,
+                 checkpoint=None,
+                 data_source=None,
+                 compact=False):
         self._resource_url = resource_url
-        self._slumber_lib = slumber_lib
 
-        self._api = self._slumber_lib.API(resource_url)
-        self.resource = getattr(self._api, self._resource_name)
+        # reads the resources: the API by default, or e.g. a snapshot
+        if data_source is None:
+            data_source = APIDataSource(resource_url, username=username,
+                                        api_key=api_key, session=session,
+                                        serializer=serializer,
+                                        slumber_lib=slumber_lib)
+        self._data_source = data_source
 
         self._collection = collection
 
-        self._username = username
-        self._api_key = api_key
-
         # memoization to avoid unecessary field lookups
         # Ex.: _memo['publishers']['1'] = 'Unesp'
         self._memo = {}
         self._last_resource = {}
 
+        # resources looked up by other collectors, possibly in
+        # other processes.
+        self._lookup_cache = lookup_cache
+
+        # tells when the generation must be abandoned
+        self._cancellation = cancellation
+
+        # where the completed pages are saved, so that an interrupted
+        # crawl is resumed instead of restarted.
+        self._checkpoint = checkpoint
+
+        # resources looked up while getting the data of the current record
+        self._dependencies = None
+
+        # records are projected onto the fields used by the template, and
+        # the resources looked up are shared between them.
+        self._compact = compact
+        self._shared = {}
+
+    def _check_cancellation(self):
+        if self._cancellation is not None:
+            self._cancellation.check()
+
+    def _sleep(self, secs):
+        if self._cancellation is not None:
+            self._cancellation.sleep(secs)
+        else:
+            time.sleep(secs)
+
     def fetch_data(self, offset, limit, collection=None):
-        kwargs = {}
+        return self._data_source.page(self._resource_name, offset, limit,
+                                      collection)
+
+    def record_key(self, obj):
+        """
+        Identifies a record by its resource and id, e.g. ``issues-12``,
+        or returns ``None`` when it has no id.
+        """
+        res_id = obj.get('id')
+        if res_id is None and obj.get('resource_uri'):
+            res_id = obj['resource_uri'].strip('/').split('/')[-1]
+        if res_id is None:
+            return None
+        return '%s-%s' % (self._resource_name, res_id)
+
+    def journal_acronym(self, data):
+        """
+        Acronym of the journal the record ``data`` belongs to.
+        """
+        return data['acronym']
 
-        if collection:
-            kwargs['collection'] = collection
+    def _get_record(self, obj):
+        """
+        Returns ``(key, dependencies, data)`` for ``obj``, where
+        ``dependencies`` are the keys of the resources looked up.
+        """
+        key = self.record_key(obj)
+        self._dependencies = set()
+        try:
+            data = self.get_data(obj)
+            if self._compact and self._record_type is not None:
+                data = self._record_type.project(data)
+            return [key, sorted(self._dependencies), data]
+        finally:
+            self._dependencies = None
 
-        if all([self._username, self._api_key]):
-            kwargs['username'] = self._username
-            kwargs['api_key'] = self._api_key
+    def fetch_record(self, res_id):
+        """
+        Fetches a single record, returning ``(key, dependencies, data)``,
+        or ``None`` if it was removed or trashed.
+        """
+        try:
+            obj = self._data_source.get(self._resource_name, res_id,
+                                        collection=self._collection)
+        except ResourceNotFoundError:
+            return None
 
-        return self.resource.get(offset=offset, limit=limit, **kwargs)
+        if obj.get('is_trashed'):
+            return None
+        return self._get_record(obj)
 
     def __iter__(self):
+        for key, dependencies, data in self.iter_records():
+            yield data
+
+    def iter_records(self):
+        """
+        Yields ``(key, dependencies, data)`` for each record of the
+        resource.
+        """
         offset = 0
         limit = ITEMS_PER_REQUEST
         err_count = 0
 
+        if self._checkpoint is not None:
+            offset, records, finished = self._checkpoint.load()
+            if offset or records:
+                logger.info('Resuming %s at offset %s.' % (
+                    self._resource_name, offset))
+            for record in records:
+                yield record
+            if finished:
+                raise StopIteration()
+
         while True:
+            self._check_cancellation()
             try:  # handles resource unavailability
-                page = self.fetch_data(offset=offset, limit=limit, collection=self._collection)
+                with span('fetch_page', resource=self._resource_name,
+                          offset=offset, limit=limit, retries=err_count):
+                    page = self.fetch_data(offset=offset, limit=limit, collection=self._collection)
             except requests.exceptions.ConnectionError as exc:
-                if err_count < 10:
-                    wait_secs = err_count * 5
-                    logger.info('Connection failed. Waiting %ss to retry.' % wait_secs)
-                    time.sleep(wait_secs)
+                if err_count < MAX_RETRIES:
+                    wait_secs = backoff_delay(err_count, base=RETRY_BASE_DELAY,
+                                              cap=RETRY_MAX_DELAY)
+                    logger.info('Connection failed. Waiting %.1fs to retry.' % wait_secs)
+                    self._sleep(wait_secs)
                     err_count += 1
                     continue
                 else:
                     logger.error('Unable to connect to resource (%s).' % exc)
                     raise ResourceUnavailableError(exc)
             else:
+                completed = []
                 for obj in page['objects']:
                     # we are interested only in non-trashed items.
                     if obj.get('is_trashed'):
                         continue
 
-                    yield self.get_data(obj)
+                    record = self._get_record(obj)
+                    if self._checkpoint is not None:
+                        completed.append(record)
+                    yield record
+
+                next_offset = offset + ITEMS_PER_REQUEST
+                if self._checkpoint is not None:
+                    self._checkpoint.save(
+                        next_offset if page['meta']['next'] else None,
+                        completed)
 
                 if not page['meta']['next']:
                     raise StopIteration()
                 else:
-                    offset += ITEMS_PER_REQUEST
+                    offset = next_offset
                     err_count = 0
 
     def _lookup_field(self, endpoint, res_id, field):
+        if self._dependencies is not None:
+            self._dependencies.add('%s-%s' % (endpoint, res_id))
 
         def http_lookup():
             """
@@ -220,16 +449,18 @@ class DataCollector(object):
             res_lookup_key = '%s-%s' % (endpoint, res_id)
             if res_lookup_key not in self._last_resource:
 
-                # authorization params
-                kwargs = {}
-                if all([self._username, self._api_key]):
-                    kwargs['username'] = self._username
-                    kwargs['api_key'] = self._api_key
-                    kwargs['collection'] = self._collection
+                def fetch():
+                    self._check_cancellation()
+                    with span('lookup', endpoint=endpoint, id=res_id, retries=0):
+                        return self._data_source.get(
+                            endpoint, res_id, collection=self._collection)
 
                 self._last_resource = {}  # release the memory
-                self._last_resource[res_lookup_key] = getattr(
-                    self._api, endpoint)(res_id).get(**kwargs)
+                if self._lookup_cache is None:
+                    self._last_resource[res_lookup_key] = fetch()
+                else:
+                    self._last_resource[res_lookup_key] = \
+                        self._lookup_cache.get_or_fill(res_lookup_key, fetch)
 
             return self._last_resource[res_lookup_key]
 
@@ -243,6 +474,13 @@ class DataCollector(object):
             one_step_before[field] = http_lookup()[field]
             return one_step_before[field]
 
+    @property
+    def memo(self):
+        """
+        Fields looked up so far, by endpoint and resource id.
+        """
+        return self._memo
+
     def _lookup_fields(self, endpoint, res_id, fields):
 
         attr_list = {}
@@ -252,6 +490,20 @@ class DataCollector(object):
 
         return attr_list
 
+    def _lookup_record(self, endpoint, res_id, fields, record_type):
+        """
+        Looks up ``fields`` of a resource as a compact record, shared by
+        all the records looking the resource up.
+        """
+        if self._dependencies is not None:
+            self._dependencies.add('%s-%s' % (endpoint, res_id))
+
+        key = (endpoint, res_id)
+        if key not in self._shared:
+            self._shared[key] = record_type.project(
+                self._lookup_fields(endpoint, res_id, fields))
+        return self._shared[key]
+
     @abstractmethod
     def get_data(self, obj):
         """
@@ -262,6 +514,11 @@ class DataCollector(object):
 
 class IssueCollector(DataCollector):
     _resource_name = 'issues'
+    _record_type = record_type('IssueRecord', ISSUE_TEMPLATE_FIELDS)
+    _journal_type = record_type('IssueJournalRecord', ISSUE_JOURNAL_FIELDS)
+
+    def journal_acronym(self, data):
+        return data['journal']['acronym']
 
     def get_data(self, obj):
 
@@ -271,20 +528,13 @@ class IssueCollector(DataCollector):
 
         # lookup journal
         journalid = obj['journal'].strip('/').split('/')[-1]
-        obj['journal'] = self._lookup_fields('journals', journalid, ['title',
-                                                                     'short_title',
-                                                                     'medline_title',
-                                                                     'publisher_name',
-                                                                     'publication_city',
-                                                                     'sponsors',
-                                                                     'print_issn',
-                                                                     'eletronic_issn',
-                                                                     'scielo_issn',
-                                                                     'resource_uri',
-                                                                     'acronym',
-                                                                     'title_iso',
-                                                                     'use_license'
-                                                                     ])
+        if self._compact:
+            obj['journal'] = self._lookup_record('journals', journalid,
+                                                 ISSUE_JOURNAL_FIELDS,
+                                                 self._journal_type)
+        else:
+            obj['journal'] = self._lookup_fields('journals', journalid,
+                                                 list(ISSUE_JOURNAL_FIELDS))
 
         # Formating publication date, must have 00 for the days digits.
         pub_month = "%02d" % obj['publication_end_month'] if obj['publication_end_month'] else  u'00'
@@ -498,6 +748,7 @@ class TitleCollector(DataCollector):
 
 class SectionCollector(DataCollector):
     _resource_name = 'journals'
+    _record_type = record_type('SectionRecord', SECTION_TEMPLATE_FIELDS)
 
     def get_data(self, obj):
         del(obj['collections'])
@@ -531,7 +782,17 @@ class DeLorean(object):
                  titlecollector=TitleCollector,
                  issuecollector=IssueCollector,
                  sectioncollector=SectionCollector,
-                 transformer=Transformer):
+                 transformer=Transformer,
+                 session=None,
+                 serializer=None,
+                 lookup_cache=None,
+                 cancellation=None,
+                 checkpoint_dir=None,
+                 checkpoint_max_age=None,
+                 record_store=None,
+                 render_cache=None,
+                 data_source=None,
+                 compact_records=False):
 
         self._datetime_lib = datetime_lib
         self._api_uri = api_uri
@@ -541,6 +802,16 @@ class DeLorean(object):
         self._transformer = transformer
         self.username = username
         self.api_key = api_key
+        self._session = session
+        self._serializer = serializer
+        self._lookup_cache = lookup_cache
+        self._cancellation = cancellation
+        self._checkpoint_dir = checkpoint_dir
+        self._checkpoint_max_age = checkpoint_max_age
+        self._record_store = record_store
+        self._render_cache = render_cache
+        self._data_source = data_source
+        self._compact_records = compact_records
 
     def _generate_filename(self,
                            prefix,
@@ -553,80 +824,473 @@ class DeLorean(object):
         now = self._datetime_lib.strftime(self._datetime_lib.now(), fmt)
         return '{0}.{1}'.format('-'.join([prefix, now]), filetype)
 
-    def generate_title(self, target='/tmp/', collection=None):
+    def _checkpoint(self, prefix, collection):
         """
-        Starts the Title bundle generation, and returns the expected
-        resource name.
+        Returns the checkpoint of the crawls of ``prefix`` records of the
+        ``collection``, taken for this generation, if checkpointing is
+        enabled and no other generation in flight holds it.
+        """
+        if self._checkpoint_dir is None:
+            return None
+
+        checkpoint = Checkpoint(os.path.join(self._checkpoint_dir,
+            '%s-%s.checkpoint.jsonl' % (prefix, collection or 'all')),
+            max_age=self._checkpoint_max_age)
+        if not checkpoint.acquire():
+            # e.g. the same records in other formats; this one goes
+            # without checkpointing rather than mixing their pages.
+            logger.info('%s is taken by another generation.' % checkpoint.path)
+            return None
+        return checkpoint
+
+    def _collector_kwargs(self, collection):
+        kwargs = {'collection': collection,
+                  'username': self.username,
+                  'api_key': self.api_key}
+        if self._session is not None:
+            kwargs['session'] = self._session
+        if self._serializer is not None:
+            kwargs['serializer'] = self._serializer
+        if self._lookup_cache is not None:
+            kwargs['lookup_cache'] = self._lookup_cache
+        if self._cancellation is not None:
+            kwargs['cancellation'] = self._cancellation
+        if self._data_source is not None:
+            kwargs['data_source'] = self._data_source
+        if self._compact_records:
+            kwargs['compact'] = True
+        return kwargs
+
+    def _generate(self, prefix, collector, template, target, collection,
+                  delta_from=None, formats=None, shards=None, shard_by='count'):
         """
-        HERE = os.path.abspath(os.path.dirname(__file__))
-        expected_resource_name = self._generate_filename('title')
+        Collects, renders and packs the records of a resource into
+        a bundle, and returns the bundle name.
 
-        # data generator
-        iter_data = self._titlecollector(self._api_uri,
-                                         collection=collection,
-                                         username=self.username,
-                                         api_key=self.api_key)
+        ``formats`` are the members packed in the bundle, ``id`` by
+        default (see :data:`OUTPUT_FORMATS`). All of them are written
+        from a single pass over the collected records.
 
-        # id file rendering
-        transformer = self._transformer(filename=os.path.join(HERE,
-            'templates/title_db_entry.txt'))
-        id_string = transformer.transform_list(iter_data)
+        With ``delta_from``, the name of a previous bundle in ``target``,
+        a delta bundle is packed instead (see :meth:`_delta_members`).
 
-        # packaging
-        packmeta = [('title.id', id_string)]
-        pack = Bundle(*packmeta)
-        pack.deploy(os.path.join(target, expected_resource_name))
+        With ``shards``, the ID file is split into that many members,
+        rendered by a pool of processes (see :meth:`_render_shards`).
+        """
+        formats = tuple(formats or DEFAULT_FORMATS)
+        unknown = set(formats) - set(OUTPUT_FORMATS)
+        if unknown:
+            raise ValueError('unknown output formats: %s' % ', '.join(
+                sorted(unknown)))
+        if shards is not None:
+            if shards < 1 or shard_by not in SHARD_BY:
+                raise ValueError('invalid sharding: %s by %s' % (shards, shard_by))
+            if delta_from is not None:
+                raise ValueError('delta bundles can\'t be sharded')
+
+        if delta_from is None:
+            expected_resource_name = self._generate_filename(prefix)
+        else:
+            expected_resource_name = self._generate_filename(prefix + '-delta')
+        checkpoint = self._checkpoint(prefix, collection)
+        writers = [WRITERS[fmt]() for fmt in formats if fmt in WRITERS]
+        rendered = set(formats) & set(ID_FORMATS)
+
+        try:
+            with span('generate', resource=prefix, collection=collection):
+                # data generator
+                kwargs = self._collector_kwargs(collection)
+                if checkpoint is not None:
+                    kwargs['checkpoint'] = checkpoint
+                iter_data = collector(self._api_uri, **kwargs)
+
+                # id file rendering
+                transformer = self._make_transformer(template)
+                shard_texts = None
+                if shards is not None and rendered:
+                    if self._record_store is not None:
+                        records, data = iter_data.iter_records(), lambda record: record[2]
+                    else:
+                        records, data = iter_data, lambda record: record
+                    groups = self._shard(list(self._fan_out(records, writers, data)),
+                                         shards, shard_by, iter_data, data)
+                    texts = self._render_shards(groups, transformer, data)
+                    if self._record_store is not None:
+                        entries = [[record[0], record[1], text]
+                                   for group, group_texts in zip(groups, texts)
+                                   for record, text in zip(group, group_texts)]
+                    shard_texts = ['\n'.join(group_texts) for group_texts in texts]
+                    id_string = '\n'.join(text for group_texts in texts
+                                          for text in group_texts)
+                elif self._record_store is not None:
+                    entries = self._render_entries(
+                        self._fan_out(iter_data.iter_records(), writers,
+                                      lambda record: record[2]),
+                        transformer)
+                    id_string = '\n'.join(entry[2] for entry in entries)
+                elif not rendered:
+                    for data in self._fan_out(iter_data, writers):
+                        pass
+                elif self._cancellation is None:
+                    id_string = transformer.transform_list(
+                        self._fan_out(iter_data, writers))
+                else:
+                    id_string = transformer.transform_list(
+                        self._fan_out(iter_data, writers),
+                        cancellation=self._cancellation)
+                collected(iter_data)
+
+                # packaging
+                packmeta = []
+                if rendered:
+                    if shard_texts is not None:
+                        id_members = self._shard_members(
+                            prefix, shard_texts, [len(group) for group in groups],
+                            shard_by)
+                    elif delta_from is None:
+                        id_members = [('%s.id' % prefix, id_string)]
+                    else:
+                        id_members = self._delta_members(
+                            prefix, id_string, os.path.join(target, delta_from))
+                        id_string = dict(id_members)['%s.id' % prefix]
+
+                    if 'id' in formats:
+                        packmeta.extend(id_members)
+                    if 'mst' in formats:
+                        packmeta.extend(self._master_file_members(prefix, id_string))
+                    if 'iso' in formats:
+                        packmeta.append(self._iso2709_member(prefix, id_string))
+                for writer in writers:
+                    packmeta.append(('%s.%s' % (prefix, writer.extension),
+                                     writer.getvalue()))
+
+                pack = Bundle(*packmeta, cancellation=self._cancellation)
+                pack.deploy(os.path.join(target, expected_resource_name))
+
+            if self._record_store is not None:
+                self._record_store.save(prefix, collection, entries)
+
+            if checkpoint is not None:
+                checkpoint.clear()
+        finally:
+            if checkpoint is not None:
+                checkpoint.release()
 
         return expected_resource_name
 
-    def generate_issue(self, target='/tmp/', collection=None):
+    def _fan_out(self, records, writers, data=lambda record: record):
         """
-        Starts the Issue bundle generation, and returns the expected
-        resource name.
+        Passes the ``records`` on, after writing their ``data`` with each
+        one of the ``writers``.
+        """
+        if not writers:
+            return records
+        return self._written(records, writers, data)
+
+    def _written(self, records, writers, data):
+        for record in records:
+            if self._cancellation is not None:
+                self._cancellation.check()
+            for writer in writers:
+                writer.write(data(record))
+            yield record
+
+    def _shard(self, records, shards, shard_by, collector,
+               data=lambda record: record):
         """
-        HERE = os.path.abspath(os.path.dirname(__file__))
-        expected_resource_name = self._generate_filename('issue')
+        Splits ``records`` into ``shards`` groups, in their order: in
+        runs of about the same length, or by the journal acronym, so the
+        records of a journal are kept together.
+        """
+        groups = [[] for i in range(shards)]
+        if shard_by == 'journal':
+            for record in records:
+                acronym = collector.journal_acronym(data(record)) or ''
+                shard = zlib.crc32(acronym.encode('utf-8')) & 0xffffffff
+                groups[shard % shards].append(record)
+        else:
+            size, extra = divmod(len(records), shards)
+            start = 0
+            for i in range(shards):
+                end = start + size + (1 if i < extra else 0)
+                groups[i] = records[start:end]
+                start = end
+        return groups
+
+    def _render_shards(self, groups, transformer, data=lambda record: record):
+        """
+        Renders the groups of records in a pool of processes, as many as
+        the shards up to the number of CPUs, returning the texts of the
+        records of each group. The cancellation is checked while waiting
+        for the workers, which are terminated when it fires.
 
-        # data generator
-        iter_data = self._issuecollector(self._api_uri,
-                                         collection=collection,
-                                         username=self.username,
-                                         api_key=self.api_key)
+        With a single CPU, they are rendered in this process, sparing the
+        cost of sending the records and compiling the template again.
+        """
+        processes = min(len(groups), multiprocessing.cpu_count())
+        if processes < 2:
+            with phase('render'):
+                return [self._render_texts(group, transformer, data)
+                        for group in groups]
+
+        tasks = [(transformer, [self._plain(data(record)) for record in group])
+                 for group in groups]
+
+        if self._cancellation is not None:
+            self._cancellation.check()
+        with span('render.shards', shards=len(groups),
+                  processes=processes), phase('render'):
+            pool = multiprocessing.Pool(processes)
+            try:
+                pending = pool.map_async(_render_shard, tasks, chunksize=1)
+                # the workers can't check the token, so it is checked
+                # while waiting for them, terminating them when it fires.
+                while self._cancellation is not None and not pending.ready():
+                    remaining = self._cancellation.remaining()
+                    pending.wait(SHARD_POLL_INTERVAL if remaining is None
+                                 else min(remaining, SHARD_POLL_INTERVAL))
+                    self._cancellation.check()
+                texts = pending.get()
+            except:
+                pool.terminate()
+                raise
+            else:
+                pool.close()
+            finally:
+                pool.join()
+        if self._cancellation is not None:
+            self._cancellation.check()
+        return texts
+
+    def _render_texts(self, records, transformer, data):
+        texts = []
+        for record in records:
+            if self._cancellation is not None:
+                self._cancellation.check()
+            texts.append(transformer.transform(data(record)))
+        return texts
+
+    @staticmethod
+    def _plain(data):
+        # compact records are sent to the workers as the dicts they hold
+        if isinstance(data, CompactRecord):
+            return data.to_dict()
+        return data
+
+    def _shard_members(self, prefix, shard_texts, counts, shard_by):
+        """
+        Returns the ``<prefix>.000.id``, ``<prefix>.001.id``... members
+        and ``<prefix>.manifest.json``, with the record count and the
+        SHA-1 checksum of each one of them.
+        """
+        with span('bundle.shards', shards=len(shard_texts)):
+            encoded = []
+            for text in shard_texts:
+                data = text.encode('cp1252', 'replace')
+                encoded.append((data, hashlib.sha1(data).hexdigest()))
+
+        members, manifest = [], []
+        for i, ((data, checksum), count) in enumerate(zip(encoded, counts)):
+            name = '%s.%03d.id' % (prefix, i)
+            members.append((name, data))
+            manifest.append({'name': name, 'records': count, 'sha1': checksum})
+
+        members.append(('%s.manifest.json' % prefix, json.dumps({
+            'shard_by': shard_by,
+            'records': sum(counts),
+            'shards': manifest,
+        }, indent=2)))
+        return members
+
+    def _delta_members(self, prefix, id_string, previous_path):
+        """
+        Returns the members of a delta bundle against the bundle at
+        ``previous_path``:
+
+        * ``<prefix>.id``: the added and changed records;
+        * ``<prefix>.removed``: the keys of the removed records, one per
+          line, their fields separated by tabs;
+        * ``<prefix>.delta.json``: the base bundle, the fields of the
+          record keys and the keys of the changed records, which must be
+          deleted before the ``.id`` records are loaded.
+        """
+        with span('bundle.delta', base=os.path.basename(previous_path)):
+            if not delta.is_full_bundle(previous_path, prefix):
+                raise ValueError('not a full %s bundle: %s' % (
+                    prefix, previous_path))
+            previous = delta.read_member(previous_path, '%s.id' % prefix)
+
+            # compared as it would be read back from the bundle
+            current = id_string.encode('cp1252', 'replace').decode('cp1252')
+            fields = delta.KEY_FIELDS[prefix]
+            updated, changed, removed = delta.diff(previous, current, fields)
+
+        manifest = {
+            'base': os.path.basename(previous_path),
+            'key_fields': fields,
+            'updated': len(updated),
+            'changed': changed,
+            'removed': len(removed),
+        }
+        return [
+            ('%s.id' % prefix, '\n'.join(updated)),
+            ('%s.removed' % prefix, '\n'.join('\t'.join(key) for key in removed)),
+            ('%s.delta.json' % prefix, json.dumps(manifest, indent=2)),
+        ]
+
+    def _master_file_members(self, prefix, id_string):
+        """
+        Returns the ``<prefix>.mst`` and ``<prefix>.xrf`` members of the
+        ISIS master file holding the records of ``id_string``.
+        """
+        mst, xrf = StringIO.StringIO(), StringIO.StringIO()
+        with span('bundle.master_file'), phase('master_file'):
+            writer = isis.MasterFileWriter(mst, xrf)
+            for fields in isis.parse_id(id_string):
+                writer.write(fields)
+            writer.close()
 
-        # id file rendering
-        transformer = self._transformer(filename=os.path.join(HERE,
-            'templates/issue_db_entry.txt'))
-        id_string = transformer.transform_list(iter_data)
+        return [('%s.mst' % prefix, mst.getvalue()),
+                ('%s.xrf' % prefix, xrf.getvalue())]
 
-        # packaging
-        packmeta = [('issue.id', id_string)]
-        pack = Bundle(*packmeta)
-        pack.deploy(os.path.join(target, expected_resource_name))
+    def _iso2709_member(self, prefix, id_string):
+        """
+        Returns the ``<prefix>.iso`` member, with the records of
+        ``id_string`` in the ISO-2709 format.
+        """
+        out = StringIO.StringIO()
+        with span('bundle.iso2709'), phase('iso2709'):
+            writer = isis.ISO2709Writer(out)
+            for fields in isis.parse_id(id_string):
+                writer.write(fields)
 
-        return expected_resource_name
+        return ('%s.iso' % prefix, out.getvalue())
 
-    def generate_section(self, target='/tmp/', collection=None):
+    def _make_transformer(self, template):
+        kwargs = {'filename': os.path.join(HERE, 'templates', template)}
+        if self._render_cache is not None:
+            kwargs['render_cache'] = self._render_cache
+        return self._transformer(**kwargs)
+
+    def _render_entries(self, records, transformer):
         """
-        Starts the Section bundle generation, and returns the expected
-        resource name.
+        Renders ``(key, dependencies, data)`` records into the
+        ``[key, dependencies, text]`` entries kept by the record store.
+        """
+        entries = []
+        with phase('render'):
+            for key, dependencies, data in records:
+                if self._cancellation is not None:
+                    self._cancellation.check()
+                entries.append([key, dependencies, transformer.transform(data)])
+        return entries
+
+    def refresh(self, prefix, changes, target='/tmp/', collection=None,
+                current=None):
         """
-        HERE = os.path.abspath(os.path.dirname(__file__))
-        expected_resource_name = self._generate_filename('section')
+        Rebuilds the bundle of ``prefix`` records re-rendering only the
+        records affected by ``changes``, a list of ``(endpoint, id,
+        action)`` tuples, and returns the new bundle name.
+
+        ``current`` is the name of the bundle built from the stored
+        records, if any, returned as is when none of them is affected.
 
-        # data generator
-        iter_data = self._sectioncollector(self._api_uri,
-                                           collection=collection,
-                                           username=self.username,
-                                           api_key=self.api_key)
+        Returns ``None`` when a full generation is needed instead: the
+        records of the bundle weren't stored or a record was created,
+        as there is no telling whether it belongs to the collection.
+        """
+        collector, template = self._resource(prefix)
+        entries = None
+        if self._record_store is not None:
+            entries = self._record_store.load(prefix, collection)
+        if entries is None:
+            return None
+
+        changed = set('%s-%s' % (endpoint, res_id)
+                      for endpoint, res_id, action in changes)
+        deleted = set('%s-%s' % (endpoint, res_id)
+                      for endpoint, res_id, action in changes
+                      if action == 'delete')
+        known = set(entry[0] for entry in entries)
+
+        data_source = collector(self._api_uri,
+                                **self._collector_kwargs(collection))
+        for endpoint, res_id, action in changes:
+            if (endpoint == data_source._resource_name and
+                    action == 'create' and
+                    '%s-%s' % (endpoint, res_id) not in known):
+                return None
+
+        if current is not None and not any(
+                key in changed or changed.intersection(dependencies)
+                for key, dependencies, text in entries):
+            return current
+
+        expected_resource_name = self._generate_filename(prefix)
+        with span('refresh', resource=prefix, collection=collection,
+                  changes=len(changes)):
+            transformer = self._make_transformer(template)
+
+            refreshed = []
+            for key, dependencies, text in entries:
+                if key in deleted:
+                    continue
 
-        # id file rendering
-        transformer = self._transformer(filename=os.path.join(HERE,
-            'templates/section_db_entry.txt'))
-        id_string = transformer.transform_list(iter_data)
+                if key in changed or changed.intersection(dependencies):
+                    record = data_source.fetch_record(key.split('-', 1)[1])
+                    if record is None:
+                        continue
+                    key, dependencies, data = record
+                    text = transformer.transform(data)
+                refreshed.append([key, dependencies, text])
 
-        # packaging
-        packmeta = [('section.id', id_string)]
-        pack = Bundle(*packmeta)
-        pack.deploy(os.path.join(target, expected_resource_name))
+            id_string = '\n'.join(entry[2] for entry in refreshed)
+            pack = Bundle(('%s.id' % prefix, id_string),
+                          cancellation=self._cancellation)
+            pack.deploy(os.path.join(target, expected_resource_name))
 
+        self._record_store.save(prefix, collection, refreshed)
         return expected_resource_name
+
+    def _resource(self, prefix):
+        """
+        Returns the collector and the template of ``prefix`` records.
+        """
+        return {
+            'title': (self._titlecollector, 'title_db_entry.txt'),
+            'issue': (self._issuecollector, 'issue_db_entry.txt'),
+            'section': (self._sectioncollector, 'section_db_entry.txt'),
+        }[prefix]
+
+    def generate_title(self, target='/tmp/', collection=None, delta_from=None,
+                    formats=None, shards=None, shard_by='count'):
+        """
+        Starts the Title bundle generation, and returns the expected
+        resource name.
+        """
+        return self._generate('title', *self._resource('title'),
+                              target=target, collection=collection,
+                              delta_from=delta_from, formats=formats,
+                              shards=shards, shard_by=shard_by)
+
+    def generate_issue(self, target='/tmp/', collection=None, delta_from=None,
+                    formats=None, shards=None, shard_by='count'):
+        """
+        Starts the Issue bundle generation, and returns the expected
+        resource name.
+        """
+        return self._generate('issue', *self._resource('issue'),
+                              target=target, collection=collection,
+                              delta_from=delta_from, formats=formats,
+                              shards=shards, shard_by=shard_by)
+
+    def generate_section(self, target='/tmp/', collection=None, delta_from=None,
+                    formats=None, shards=None, shard_by='count'):
+        """
+        Starts the Section bundle generation, and returns the expected
+        resource name.
+        """
+        return self._generate('section', *self._resource('section'),
+                              target=target, collection=collection,
+                              delta_from=delta_from, formats=formats,
+                              shards=shards, shard_by=shard_by)
@@ -0,0 +1,131 @@
+# coding: utf-8
+"""
+Persistent HTTP cache of the upstream responses.
+"""
+import os
+import time
+import json
+import base64
+import hashlib
+import tempfile
+
+import requests
+
+
+class HTTPCache(object):
+    """
+    On-disk cache of ``GET`` responses, keyed by request.
+
+    Responses that carry an ``ETag`` or a ``Last-Modified`` header are
+    always revalidated with a conditional request. The others are
+    considered fresh for ``ttl`` seconds after being stored, and the
+    pages of listings only until :meth:`expire_listings` is called.
+    """
+    def __init__(self, directory, ttl=3600, clock=time.time):
+        self._directory = directory
+        self._ttl = ttl
+        self._clock = clock
+
+    def _path(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self._directory, digest[:2], digest)
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write(self, key, entry):
+        path = self._path(key)
+        base_path = os.path.dirname(path)
+        if not os.path.exists(base_path):
+            try:
+                os.makedirs(base_path, 0755)
+            except OSError:  # created by a concurrent writer
+                pass
+
+        # written aside and renamed, so readers never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=base_path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp_path, path)
+
+    def _listings_stamp(self):
+        return os.path.join(self._directory, 'listings.expired')
+
+    def expire_listings(self):
+        """
+        Makes the listing pages stored so far stale, e.g. after a change
+        of any of the resources they embed. Listings are keyed by their
+        offsets, so they can't be told apart as the resources are.
+        """
+        if not os.path.exists(self._directory):
+            os.makedirs(self._directory, 0755)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self._directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write(repr(self._clock()))
+        os.rename(tmp_path, self._listings_stamp())
+
+    def _listings_expired_at(self):
+        try:
+            with open(self._listings_stamp()) as f:
+                return float(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def invalidate(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:  # not cached
+            pass
+
+    def store(self, key, response):
+        headers = dict((k.lower(), v) for k, v in response.headers.items())
+        self._write(key, {
+            'status': response.status_code,
+            'headers': headers,
+            'body': base64.b64encode(response.content),
+            'stored_at': self._clock(),
+        })
+
+    def refresh(self, key, entry, response):
+        """
+        Updates ``entry`` after a ``304 Not Modified`` ``response``.
+        """
+        for header in ('etag', 'last-modified'):
+            if header in response.headers:
+                entry['headers'][header] = response.headers[header]
+        entry['stored_at'] = self._clock()
+        self._write(key, entry)
+
+    def validators(self, entry):
+        """
+        Headers that make a request conditional on ``entry`` having
+        changed upstream.
+        """
+        headers = {}
+        if 'etag' in entry['headers']:
+            headers['If-None-Match'] = entry['headers']['etag']
+        if 'last-modified' in entry['headers']:
+            headers['If-Modified-Since'] = entry['headers']['last-modified']
+        return headers
+
+    def is_fresh(self, entry, listing=False):
+        if self.validators(entry):
+            return False
+        if listing:
+            expired_at = self._listings_expired_at()
+            if expired_at is not None and entry['stored_at'] <= expired_at:
+                return False
+        return self._clock() - entry['stored_at'] < self._ttl
+
+    def response(self, entry, url):
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.headers.update(entry['headers'])
+        response._content = base64.b64decode(entry['body'])
+        response.url = url
+        return response
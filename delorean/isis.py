@@ -0,0 +1,218 @@
+# coding: utf-8
+"""
+ISIS databases: the ID text format, the master file (``.mst`` and
+``.xrf``) built from it by ``id2i`` and the ISO-2709 interchange format.
+"""
+import re
+import struct
+
+BLOCK_SIZE = 512
+CONTROL_SIZE = 64
+XRF_ENTRIES = 127  # per block
+
+# little-endian CDS/ISIS layout, with the leader packed
+CONTROL = struct.Struct('<iiihhiiii')
+LEADER = struct.Struct('<ihihhhh')
+DIRECTORY_ENTRY = struct.Struct('<hhh')
+XRF_BLOCK = struct.Struct('<i%di' % XRF_ENTRIES)
+
+FIELD_LINE = re.compile(r'^!v(\d+)!(.*)$')
+
+
+def parse_id(id_string):
+    """
+    Parses the records of an ID file, returning a list of records, each
+    a list of ``(tag, value)`` fields in their original order.
+    """
+    records = []
+    for line in id_string.splitlines():
+        if line.startswith('!ID '):
+            records.append([])
+            continue
+
+        match = FIELD_LINE.match(line)
+        if match:
+            records[-1].append((int(match.group(1)), match.group(2)))
+        elif line and records and records[-1]:
+            # a value broken into lines
+            tag, value = records[-1][-1]
+            records[-1][-1] = (tag, value + line)
+    return records
+
+
+class MasterFileWriter(object):
+    """
+    Writes records to a master file, ``mst`` and ``xrf`` being binary
+    file objects. Records are written as they are given; the control
+    record and the cross-reference file are completed by :meth:`close`.
+    """
+    def __init__(self, mst, xrf, encoding='cp1252'):
+        self._mst = mst
+        self._xrf = xrf
+        self._encoding = encoding
+        self._positions = []
+        self._offset = CONTROL_SIZE  # in the file
+
+        self._mst.write(b'\0' * CONTROL_SIZE)
+
+    def write(self, fields):
+        """
+        Appends a record given as a list of ``(tag, value)`` fields.
+        """
+        values = [value.encode(self._encoding, 'replace')
+                  if isinstance(value, unicode) else value
+                  for tag, value in fields]
+
+        base = LEADER.size + DIRECTORY_ENTRY.size * len(fields)
+        length = base + sum(len(value) for value in values)
+        length += length % 2  # records have even lengths
+        if length > 0x7fff:
+            raise ValueError('record too long for a master file')
+
+        # leaders can't be split between blocks
+        block_offset = self._offset % BLOCK_SIZE
+        if block_offset + LEADER.size > BLOCK_SIZE:
+            self._mst.write(b'\0' * (BLOCK_SIZE - block_offset))
+            self._offset += BLOCK_SIZE - block_offset
+
+        mfn = len(self._positions) + 1
+        self._positions.append((self._offset // BLOCK_SIZE + 1,
+                                self._offset % BLOCK_SIZE))
+
+        chunks = [LEADER.pack(mfn, length, 0, 0, base, len(fields), 0)]
+        position = 0
+        for (tag, value), encoded in zip(fields, values):
+            chunks.append(DIRECTORY_ENTRY.pack(tag, position, len(encoded)))
+            position += len(encoded)
+        chunks.extend(values)
+
+        record = b''.join(chunks)
+        record += b'\0' * (length - len(record))
+        self._mst.write(record)
+        self._offset += length
+
+    def close(self):
+        # the unused end of the last block is filled
+        if self._offset % BLOCK_SIZE:
+            self._mst.write(b'\0' * (BLOCK_SIZE - self._offset % BLOCK_SIZE))
+
+        self._mst.seek(0)
+        self._mst.write(CONTROL.pack(
+            0,
+            len(self._positions) + 1,  # next MFN
+            self._offset // BLOCK_SIZE + 1,  # next position block
+            self._offset % BLOCK_SIZE + 1,  # next position offset (1-based)
+            0, 0, 0, 0, 0))
+        self._mst.seek(0, 2)
+
+        blocks = max(1, (len(self._positions) + XRF_ENTRIES - 1) // XRF_ENTRIES)
+        for i in range(blocks):
+            entries = [block * 2048 + offset for block, offset
+                       in self._positions[i * XRF_ENTRIES:(i + 1) * XRF_ENTRIES]]
+            entries.extend([0] * (XRF_ENTRIES - len(entries)))
+            number = -(i + 1) if i == blocks - 1 else i + 1
+            self._xrf.write(XRF_BLOCK.pack(number, *entries))
+
+
+def read_master(mst, xrf, encoding='cp1252'):
+    """
+    Yields the active records of a master file as lists of
+    ``(tag, value)`` fields, in MFN order.
+    """
+    mst_data = mst.read()
+    xrf_data = xrf.read()
+
+    for i in range(len(xrf_data) // XRF_BLOCK.size):
+        block = XRF_BLOCK.unpack_from(xrf_data, i * XRF_BLOCK.size)
+        for entry in block[1:]:
+            if entry <= 0:
+                continue
+
+            start = (entry // 2048 - 1) * BLOCK_SIZE + entry % 512
+            mfn, length, bwb, bwp, base, nvf, status = LEADER.unpack_from(
+                mst_data, start)
+            if status != 0:
+                continue
+
+            fields = []
+            for n in range(nvf):
+                tag, position, size = DIRECTORY_ENTRY.unpack_from(
+                    mst_data, start + LEADER.size + n * DIRECTORY_ENTRY.size)
+                value = mst_data[start + base + position:
+                                 start + base + position + size]
+                fields.append((tag, value.decode(encoding)))
+            yield fields
+
+
+# ISO-2709 interchange format, as exported by CDS/ISIS
+ISO_FIELD_SEPARATOR = b'\x1e'
+ISO_RECORD_TERMINATOR = b'\x1d'
+ISO_LEADER_SIZE = 24
+ISO_DIRECTORY_ENTRY = 12  # tag, field length and starting position
+
+
+class ISO2709Writer(object):
+    """
+    Writes records to ``out``, a binary file object, in the ISO-2709
+    format, as they are given.
+    """
+    def __init__(self, out, encoding='cp1252'):
+        self._out = out
+        self._encoding = encoding
+
+    def write(self, fields):
+        """
+        Writes a record given as a list of ``(tag, value)`` fields.
+        """
+        directory = []
+        data = []
+        position = 0
+        for tag, value in fields:
+            if isinstance(value, unicode):
+                value = value.encode(self._encoding, 'replace')
+            if not 0 < tag <= 999:
+                raise ValueError('invalid ISO-2709 tag: %s' % tag)
+
+            length = len(value) + 1  # with the field separator
+            if length > 9999:
+                raise ValueError('field too long for ISO-2709')
+            directory.append(b'%03d%04d%05d' % (tag, length, position))
+            data.append(value)
+            position += length
+
+        base = ISO_LEADER_SIZE + ISO_DIRECTORY_ENTRY * len(fields) + 1
+        length = base + position + 1
+        if length > 99999:
+            raise ValueError('record too long for ISO-2709')
+
+        # status n(ew), no indicators nor subfield identifiers and the
+        # 4500 entry map.
+        leader = b'%05dn000000%05d0004500' % (length, base)
+        data.append(b'')
+        self._out.write(b''.join([leader, b''.join(directory),
+                                  ISO_FIELD_SEPARATOR,
+                                  ISO_FIELD_SEPARATOR.join(data),
+                                  ISO_RECORD_TERMINATOR]))
+
+
+def read_iso2709(data, encoding='cp1252'):
+    """
+    Yields the records of ISO-2709 ``data`` as lists of ``(tag, value)``
+    fields.
+    """
+    start = 0
+    while start < len(data):
+        length = int(data[start:start + 5])
+        base = int(data[start + 12:start + 17])
+        record = data[start:start + length]
+
+        fields = []
+        directory = record[ISO_LEADER_SIZE:base - 1]
+        for i in range(0, len(directory), ISO_DIRECTORY_ENTRY):
+            entry = directory[i:i + ISO_DIRECTORY_ENTRY]
+            tag, size, position = int(entry[:3]), int(entry[3:7]), int(entry[7:])
+            value = record[base + position:base + position + size - 1]
+            fields.append((tag, value.decode(encoding)))
+        yield fields
+
+        start += length
@@ -0,0 +1,110 @@
+# coding: utf-8
+"""
+Lookup cache shared by the worker processes of a host.
+"""
+import json
+import time
+
+from .storage import SQLiteConnections
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    key TEXT PRIMARY KEY,
+    expires REAL NOT NULL
+);
+"""
+
+
+class SQLiteLookupCache(object):
+    """
+    Caches the resources fetched by ``DataCollector._lookup_field`` in a
+    SQLite database in WAL mode, so that it can be shared by all the
+    processes of a host.
+
+    Entries expire after ``ttl`` seconds. Concurrent misses for the same
+    key are coalesced: only the process holding the key lease fetches
+    it, the others wait for the value to show up. A lease not released
+    after ``lease_timeout`` seconds, e.g. by a killed process, is taken
+    over.
+    """
+    def __init__(self, path, ttl=3600, lease_timeout=30, poll_interval=0.05,
+                 clock=time.time, sleep=time.sleep):
+        self._path = path
+        self._ttl = ttl
+        self._lease_timeout = lease_timeout
+        self._poll_interval = poll_interval
+        self._clock = clock
+        self._sleep = sleep
+        self._connections = SQLiteConnections(
+            path, SCHEMA, timeout=lease_timeout, retry_interval=poll_interval,
+            sleep=sleep)
+
+    @property
+    def _conn(self):
+        return self._connections.get()
+
+    def get(self, key):
+        row = self._conn.execute(
+            'SELECT value FROM entries WHERE key = ? AND expires > ?',
+            (key, self._clock())).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set(self, key, value):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO entries (key, value, expires) VALUES (?, ?, ?)',
+            (key, json.dumps(value), self._clock() + self._ttl))
+
+    def invalidate(self, key):
+        self._conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def _acquire(self, key):
+        now = self._clock()
+        conn = self._conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM leases WHERE key = ? AND expires <= ?',
+                         (key, now))
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO leases (key, expires) VALUES (?, ?)',
+                (key, now + self._lease_timeout))
+            acquired = cursor.rowcount == 1
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return acquired
+
+    def _release(self, key):
+        self._conn.execute('DELETE FROM leases WHERE key = ?', (key,))
+
+    def get_or_fill(self, key, fill):
+        """
+        Returns the value cached under ``key``, calling ``fill`` to
+        obtain it on a miss.
+        """
+        while True:
+            value = self.get(key)
+            if value is not None:
+                return value
+
+            if self._acquire(key):
+                try:
+                    # filled by the previous lease holder meanwhile
+                    value = self.get(key)
+                    if value is not None:
+                        return value
+
+                    value = fill()
+                    if value is not None:
+                        self.set(key, value)
+                    return value
+                finally:
+                    self._release(key)
+
+            self._sleep(self._poll_interval)
@@ -0,0 +1,357 @@
+# coding: utf-8
+"""
+Instrumentation used to find out where a bundle generation spends
+its resources.
+"""
+import os
+import sys
+import cProfile
+import pstats
+import StringIO
+import threading
+import collections
+from contextlib import contextmanager
+
+try:
+    import tracemalloc
+except ImportError:  # only available on python 2 through pytracemalloc
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+_local = threading.local()
+
+# tracemalloc and the resident set size are process-wide, so only one
+# generation is measured at a time.
+_memory_profiling_lock = threading.Lock()
+
+
+class ProfilerBusyError(Exception):
+    def __init__(self, *args, **kwargs):
+        super(ProfilerBusyError, self).__init__(*args, **kwargs)
+
+
+@contextmanager
+def phase(name):
+    """
+    Delimits a generation phase, to be measured by the memory profiler
+    active on the current thread, if any.
+    """
+    profiler = getattr(_local, 'memory_profiler', None)
+    if profiler is None:
+        yield
+    else:
+        with profiler.phase(name):
+            yield
+
+
+def collected(collector):
+    """
+    Reports the size of the memo kept by a data ``collector`` once the
+    crawl is over to the memory profiler active on the current thread,
+    if any. The records are crawled lazily while they are rendered, so
+    the memory of the crawl can't be told apart by phase.
+    """
+    profiler = getattr(_local, 'memory_profiler', None)
+    if profiler is not None:
+        profiler.collected(collector.memo)
+
+
+def _deep_size(obj, seen):
+    """
+    Size of ``obj`` and of the containers and records within, in bytes.
+    Objects already ``seen`` are not counted again.
+    """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict) or hasattr(obj, 'items'):
+        for key, value in obj.items():
+            size += _deep_size(key, seen) + _deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += _deep_size(item, seen)
+    return size
+
+
+def _max_rss():
+    """
+    Peak resident set size of the process, in bytes.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is given in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _current_rss():
+    """
+    Resident set size of the process, in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def _delta(before, after):
+    if before is None or after is None:
+        return None
+    return after - before
+
+
+class GenerationProfiler(object):
+    """
+    Runs a bundle generation under ``cProfile`` and dumps the collected
+    stats next to the generated bundle.
+
+    Two files are produced: the raw ``.pstats`` file, that can be loaded
+    with ``pstats`` or any compatible viewer, and a plain text summary
+    with the ``top_n`` most expensive calls.
+    """
+    def __init__(self, target, top_n=30, sort_by='cumulative',
+                 profile_lib=cProfile):
+        self._target = target
+        self._top_n = top_n
+        self._sort_by = sort_by
+        self._profile_lib = profile_lib
+        self._profile = None
+
+    def run(self, func, *args, **kwargs):
+        """
+        Calls ``func`` with the given arguments while profiling it,
+        and returns its result.
+        """
+        self._profile = self._profile_lib.Profile()
+        return self._profile.runcall(func, *args, **kwargs)
+
+    def dump(self, basename):
+        """
+        Writes the stats collected by the last ``run`` to the target
+        directory, and returns the names of the stats and summary files.
+        """
+        if self._profile is None:
+            raise ValueError('there is nothing to dump')
+
+        if not os.path.exists(self._target):
+            os.makedirs(self._target, 0755)
+
+        stats_name = '%s.pstats' % basename
+        summary_name = '%s.profile.txt' % basename
+
+        self._profile.dump_stats(os.path.join(self._target, stats_name))
+
+        summary = StringIO.StringIO()
+        stats = pstats.Stats(self._profile, stream=summary)
+        stats.strip_dirs().sort_stats(self._sort_by).print_stats(self._top_n)
+
+        with open(os.path.join(self._target, summary_name), 'w') as f:
+            f.write(summary.getvalue())
+
+        return stats_name, summary_name
+
+
+class StackSampler(object):
+    """
+    Statistical profiler that periodically captures the stacks of the
+    threads running bundle generations.
+
+    The samples are aggregated per resource in the collapsed-stack
+    format, that is understood by flamegraph tools: one line per distinct
+    stack, with its frames separated by ``;`` and followed by the number
+    of times it was seen.
+    """
+    def __init__(self, interval=0.01, max_depth=128,
+                 current_frames=sys._current_frames):
+        self._interval = interval
+        self._max_depth = max_depth
+        self._current_frames = current_frames
+        self._lock = threading.Lock()
+        self._tracked = {}  # thread ident -> resource name
+        self._stacks = {}  # resource name -> collections.Counter
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @contextmanager
+    def track(self, resource_name):
+        """
+        Sample the calling thread, under ``resource_name``, while
+        the context is active.
+        """
+        ident = threading.current_thread().ident
+        with self._lock:
+            self._tracked[ident] = resource_name
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._tracked.pop(ident, None)
+
+    def _collapse(self, frame):
+        stack = []
+        while frame is not None and len(stack) < self._max_depth:
+            code = frame.f_code
+            stack.append('%s (%s)' % (code.co_name,
+                                      os.path.basename(code.co_filename)))
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+    def sample(self):
+        """
+        Takes a single sample of every tracked thread.
+        """
+        frames = self._current_frames()
+        with self._lock:
+            for ident, resource_name in self._tracked.items():
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                self._stacks.setdefault(resource_name,
+                    collections.Counter())[self._collapse(frame)] += 1
+
+    def collapsed(self, resource_name):
+        """
+        Returns the aggregated samples of ``resource_name`` in the
+        collapsed-stack format.
+        """
+        with self._lock:
+            stacks = self._stacks.get(resource_name, {}).items()
+        return '\n'.join('%s %s' % (stack, count)
+                         for stack, count in sorted(stacks))
+
+    def reset(self, resource_name=None):
+        with self._lock:
+            if resource_name is None:
+                self._stacks.clear()
+            else:
+                self._stacks.pop(resource_name, None)
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self.sample()
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='delorean-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class MemoryProfiler(object):
+    """
+    Records the memory allocated by each generation phase.
+
+    For each phase, delimited with :func:`phase`, it is recorded the peak
+    and the retained (still allocated when the phase is over) memory,
+    and the ``top_n`` allocation sites. ``tracemalloc`` is used when
+    available, otherwise only the growth of the process resident set
+    size is reported and the allocation sites are left empty.
+
+    As both are process-wide, a single profiler can be active at a time:
+    activating another one raises :class:`ProfilerBusyError`.
+    """
+    def __init__(self, top_n=10, nframes=1, tracemalloc_lib=tracemalloc):
+        self._top_n = top_n
+        self._nframes = nframes
+        self._tracemalloc = tracemalloc_lib
+        self.phases = []
+
+    @contextmanager
+    def activate(self):
+        """
+        Makes the profiler measure the phases run by the calling thread.
+        """
+        if not _memory_profiling_lock.acquire(False):
+            raise ProfilerBusyError('another generation is being measured')
+
+        previous = getattr(_local, 'memory_profiler', None)
+        _local.memory_profiler = self
+        try:
+            yield self
+        finally:
+            _local.memory_profiler = previous
+            _memory_profiling_lock.release()
+
+    @contextmanager
+    def phase(self, name):
+        if self._tracemalloc is None:
+            measure = self._measure_rss
+        else:
+            measure = self._measure_tracemalloc
+
+        with measure() as record:
+            yield
+
+        record['phase'] = name
+        self.phases.append(record)
+
+    def collected(self, memo):
+        """
+        Records the ``collect`` phase: the field lookups memoized by the
+        crawl, and the bytes they retain. Its peak is unknown.
+        """
+        self.phases.append({
+            'phase': 'collect',
+            'peak_bytes': None,
+            'retained_bytes': _deep_size(memo, set()),
+            'memoized_lookups': sum(len(fields)
+                                    for resources in memo.values()
+                                    for fields in resources.values()),
+            'top_allocations': [],
+        })
+
+    @contextmanager
+    def _measure_tracemalloc(self):
+        # tracing is restarted so the measures are relative to the phase
+        if self._tracemalloc.is_tracing():
+            self._tracemalloc.stop()
+        self._tracemalloc.start(self._nframes)
+
+        record = {}
+        try:
+            yield record
+        finally:
+            retained, peak = self._tracemalloc.get_traced_memory()
+            snapshot = self._tracemalloc.take_snapshot()
+            self._tracemalloc.stop()
+
+        record['peak_bytes'] = peak
+        record['retained_bytes'] = retained
+        record['top_allocations'] = [
+            {'site': '%s:%s' % (stat.traceback[0].filename,
+                                stat.traceback[0].lineno),
+             'size_bytes': stat.size,
+             'count': stat.count}
+            for stat in snapshot.statistics('lineno')[:self._top_n]]
+
+    @contextmanager
+    def _measure_rss(self):
+        max_rss_before = _max_rss()
+        rss_before = _current_rss()
+
+        record = {}
+        yield record
+
+        record['peak_bytes'] = _delta(max_rss_before, _max_rss())
+        record['retained_bytes'] = _delta(rss_before, _current_rss())
+        record['top_allocations'] = []
+
+    def report(self):
+        return list(self.phases)
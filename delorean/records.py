@@ -0,0 +1,63 @@
+# coding: utf-8
+"""
+Rendered records of the last generation of each bundle, so that a
+bundle can be rebuilt re-rendering only the records that changed.
+"""
+import os
+import json
+import tempfile
+
+
+class RecordStore(object):
+    """
+    Directory with a JSON file per resource and collection, holding the
+    ``[key, dependencies, text]`` entries of the records in the order
+    they were rendered.
+    """
+    SUFFIX = '.records.json'
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    def _path(self, prefix, collection):
+        return os.path.join(self._directory, '%s-%s%s' % (
+            prefix, collection or 'all', self.SUFFIX))
+
+    def load(self, prefix, collection=None):
+        """
+        Returns the entries of the resource and collection, or ``None``
+        if they were never stored.
+        """
+        try:
+            with open(self._path(prefix, collection)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def save(self, prefix, collection, entries):
+        if not os.path.exists(self._directory):
+            try:
+                os.makedirs(self._directory, 0755)
+            except OSError:  # created by a concurrent writer
+                pass
+
+        # written aside and renamed, so readers never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=self._directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f)
+        os.rename(tmp_path, self._path(prefix, collection))
+
+    def collections(self, prefix):
+        """
+        Returns the collections whose records of ``prefix`` are stored,
+        where ``None`` stands for all the collections.
+        """
+        if not os.path.exists(self._directory):
+            return []
+
+        collections = []
+        for name in sorted(os.listdir(self._directory)):
+            if name.startswith(prefix + '-') and name.endswith(self.SUFFIX):
+                collection = name[len(prefix) + 1:-len(self.SUFFIX)]
+                collections.append(None if collection == 'all' else collection)
+        return collections
@@ -0,0 +1,91 @@
+# coding: utf-8
+"""
+Persistent cache of the rendered records.
+"""
+import json
+import time
+import hashlib
+
+from .storage import SQLiteConnections, json_default
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS renders (
+    fingerprint TEXT PRIMARY KEY,
+    text TEXT NOT NULL,
+    used REAL NOT NULL
+);
+"""
+
+
+def _default(obj):
+    try:
+        return json_default(obj)
+    except TypeError:
+        return repr(obj)
+
+
+def fingerprint(template_version, data):
+    """
+    Identifies the rendering of ``data`` by a template version.
+    """
+    content = json.dumps(data, sort_keys=True, default=_default)
+    return hashlib.sha1(('%s:%s' % (template_version, content)).encode(
+        'utf-8')).hexdigest()
+
+
+class RenderCache(object):
+    """
+    Caches the text rendered for each record in a SQLite database in
+    WAL mode, keyed by the :func:`fingerprint` of the record data and
+    the template.
+
+    Renderings not used for ``max_age`` seconds are dropped by
+    :meth:`prune`.
+    """
+    def __init__(self, path, max_age=30 * 24 * 3600, clock=time.time,
+                 sleep=time.sleep):
+        self._path = path
+        self._max_age = max_age
+        self._clock = clock
+        self._connections = SQLiteConnections(
+            path, SCHEMA, pragmas=('synchronous=NORMAL',), sleep=sleep)
+        self.hits = 0
+        self.misses = 0
+
+    def __reduce__(self):
+        # e.g. to the processes rendering shards, with their own
+        # connections and counters.
+        return (RenderCache, (self._path, self._max_age))
+
+    @property
+    def _conn(self):
+        return self._connections.get()
+
+    def get(self, key):
+        row = self._conn.execute(
+            'SELECT text, used FROM renders WHERE fingerprint = ?',
+            (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        now = self._clock()
+        # writing on every hit would cost as much as rendering
+        if now - row[1] > self._max_age / 10.0:
+            self._conn.execute(
+                'UPDATE renders SET used = ? WHERE fingerprint = ?', (now, key))
+        return row[0]
+
+    def set(self, key, text):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO renders (fingerprint, text, used) '
+            'VALUES (?, ?, ?)', (key, text, self._clock()))
+
+    def prune(self):
+        """
+        Drops the renderings unused for longer than ``max_age``.
+        """
+        self._conn.execute('DELETE FROM renders WHERE used < ?',
+                           (self._clock() - self._max_age,))
@@ -0,0 +1,172 @@
+# coding: utf-8
+"""
+Protection against an unavailable or struggling upstream API.
+"""
+import time
+import random
+import threading
+import collections
+
+
+class GenerationCancelled(Exception):
+    def __init__(self, *args, **kwargs):
+        super(GenerationCancelled, self).__init__(*args, **kwargs)
+
+
+class DeadlineExceeded(GenerationCancelled):
+    def __init__(self, *args, **kwargs):
+        super(DeadlineExceeded, self).__init__(*args, **kwargs)
+
+
+class CancellationToken(object):
+    """
+    Tells a generation it must stop, because it was cancelled or because
+    it has run for more than ``timeout`` seconds.
+
+    The generation calls :meth:`check` at its safe points, which raises
+    :class:`GenerationCancelled` or :class:`DeadlineExceeded`.
+    """
+    def __init__(self, timeout=None, clock=time.time):
+        self._clock = clock
+        self._deadline = None if timeout is None else clock() + timeout
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def remaining(self):
+        """
+        Seconds until the deadline, or ``None`` if there is none.
+        """
+        if self._deadline is None:
+            return None
+        return max(0, self._deadline - self._clock())
+
+    def check(self):
+        if self.cancelled:
+            raise GenerationCancelled('generation cancelled')
+        if self._deadline is not None and self._clock() >= self._deadline:
+            raise DeadlineExceeded('generation deadline exceeded')
+
+    def sleep(self, secs):
+        """
+        Sleeps for ``secs`` seconds, waking up early to raise if the
+        generation is cancelled or reaches its deadline meanwhile.
+        """
+        remaining = self.remaining()
+        if remaining is not None:
+            secs = min(secs, remaining)
+        self._cancelled.wait(secs)
+        self.check()
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0, random_lib=random):
+    """
+    Seconds to wait before the retry number ``attempt`` (starting at 0),
+    using exponential backoff with full jitter.
+    """
+    return random_lib.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling the upstream API while the circuit is open.
+    """
+    def __init__(self, retry_after, *args):
+        super(CircuitOpenError, self).__init__(
+            'upstream unavailable, retry after %ds' % retry_after, *args)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """
+    Shared circuit breaker around the upstream calls.
+
+    The outcomes of the last ``window`` calls are tracked, and the circuit
+    opens when at least ``min_calls`` of them were made and the share of
+    failures reaches ``failure_rate``. While open, calls fail immediately
+    with :class:`CircuitOpenError`. After ``reset_timeout`` seconds up to
+    ``trial_calls`` concurrent calls are let through: a success closes the
+    circuit, a failure opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_rate=0.5, window=20, min_calls=10,
+                 reset_timeout=30, trial_calls=1, clock=time.time):
+        self._failure_rate = failure_rate
+        self._min_calls = min_calls
+        self._reset_timeout = reset_timeout
+        self._trial_calls = trial_calls
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._outcomes = collections.deque(maxlen=window)
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._trials = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            self._update()
+            return self._state
+
+    def _update(self):
+        if (self._state == self.OPEN and
+                self._clock() - self._opened_at >= self._reset_timeout):
+            self._state = self.HALF_OPEN
+            self._trials = 0
+
+    def _open(self):
+        self._state = self.OPEN
+        self._opened_at = self._clock()
+        self._outcomes.clear()
+
+    def retry_after(self):
+        """
+        Seconds until trial calls are let through.
+        """
+        with self._lock:
+            if self._state != self.OPEN:
+                return 0
+            return max(0, int(round(
+                self._opened_at + self._reset_timeout - self._clock())))
+
+    def before_call(self):
+        with self._lock:
+            self._update()
+            if self._state == self.CLOSED:
+                return
+            if self._state == self.HALF_OPEN and self._trials < self._trial_calls:
+                self._trials += 1
+                return
+            if self._state == self.HALF_OPEN:
+                retry_after = 1  # a trial call is in progress
+            else:
+                retry_after = self._opened_at + self._reset_timeout - self._clock()
+
+        raise CircuitOpenError(max(0, int(round(retry_after))))
+
+    def on_success(self):
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._state = self.CLOSED
+                self._outcomes.clear()
+            self._outcomes.append(True)
+
+    def on_failure(self):
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._open()
+                return
+
+            self._outcomes.append(False)
+            failures = self._outcomes.count(False)
+            if (len(self._outcomes) >= self._min_calls and
+                    failures >= self._failure_rate * len(self._outcomes)):
+                self._open()
@@ -0,0 +1,325 @@
+# coding: utf-8
+"""
+Background pre-generation of bundles on cron-like schedules.
+"""
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_field(field, low, high):
+    """
+    Returns the set of values matched by a cron field, that may be
+    ``*``, a value, a range ``a-b``, any of them with a step ``/n``, or
+    a comma separated list of those.
+    """
+    values = set()
+    for part in field.split(','):
+        if '/' in part:
+            part, step = part.split('/')
+            step = int(step)
+        else:
+            step = 1
+
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = [int(v) for v in part.split('-')]
+        else:
+            start = end = int(part)
+
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError('invalid cron field: %s' % field)
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule(object):
+    """
+    Schedule given as a crontab expression: ``minute hour day month
+    weekday``. Weekdays start at 0 (or 7) for Sunday and, as in cron,
+    when both the day and the weekday are restricted either may match.
+    """
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError('invalid cron expression: %s' % expr)
+
+        self.expr = expr
+        self._minutes = _parse_field(fields[0], 0, 59)
+        self._hours = _parse_field(fields[1], 0, 23)
+        self._days = _parse_field(fields[2], 1, 31)
+        self._months = _parse_field(fields[3], 1, 12)
+        self._weekdays = set(d % 7 for d in _parse_field(fields[4], 0, 7))
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    def _day_matches(self, dt):
+        day = dt.day in self._days
+        weekday = (dt.weekday() + 1) % 7 in self._weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def matches(self, dt):
+        return (dt.minute in self._minutes and dt.hour in self._hours and
+                dt.month in self._months and self._day_matches(dt))
+
+    def next_after(self, dt):
+        """
+        Returns the first time matching the schedule after ``dt``.
+        """
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=366 * 5)
+        while dt < limit:
+            if dt.month not in self._months:
+                dt = (dt.replace(day=1, hour=0, minute=0) +
+                      timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self._hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self._minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+        raise ValueError('schedule never matches: %s' % self.expr)
+
+
+class Job(object):
+    def __init__(self, resource_name, collection, schedule):
+        self.resource_name = resource_name
+        self.collection = collection
+        self.schedule = schedule
+
+    def __repr__(self):
+        return '<Job %s %s %s>' % (self.resource_name,
+                                   self.collection or 'all',
+                                   self.schedule.expr)
+
+
+def parse_jobs(value):
+    """
+    Parses the jobs of the ``delorean.schedule.jobs`` setting, one per
+    line: ``<resource> <collection> <cron expression>``, where the
+    collection ``all`` stands for every collection.
+    """
+    jobs = []
+    for line in value.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        fields = line.split(None, 2)
+        if len(fields) != 3:
+            raise ValueError('invalid schedule: %s' % line)
+
+        resource_name, collection, expr = fields
+        jobs.append(Job(resource_name,
+                        None if collection == 'all' else collection,
+                        CronSchedule(expr)))
+    return jobs
+
+
+@contextmanager
+def _flocked(path, blocking=True):
+    """
+    Holds an exclusive lock on the file at ``path``, shared by all the
+    processes, yielding the open file, or ``None`` if it is held
+    elsewhere and not ``blocking``.
+    """
+    with open(path, 'a+') as f:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(f.fileno(), flags)
+        except IOError:
+            yield None
+            return
+        try:
+            yield f
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class PrebuiltBundles(object):
+    """
+    Index of the last bundle pre-generated for each resource and
+    collection, persisted to a JSON file so that it survives restarts
+    and is shared by the server processes: it is read again whenever
+    another process replaces it.
+    """
+    def __init__(self, path, bundles_dir, clock=time.time):
+        self._path = path
+        self._bundles_dir = bundles_dir
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._index = None
+        self._version = None  # of the file the index was read from
+
+    @staticmethod
+    def _key(resource_name, collection):
+        return '%s-%s' % (resource_name, collection or 'all')
+
+    def _load(self):
+        try:
+            stat = os.stat(self._path)
+            version = (stat.st_ino, stat.st_mtime, stat.st_size)
+        except OSError:
+            version = None
+
+        if self._index is None or version != self._version:
+            try:
+                with open(self._path) as f:
+                    self._index = json.load(f)
+            except (IOError, ValueError):
+                self._index = {}
+            self._version = version
+        return self._index
+
+    def record(self, resource_name, collection, bundle_name):
+        # other processes may be recording their bundles too
+        with self._lock, _flocked(self._path + '.lock'):
+            index = self._load()
+            index[self._key(resource_name, collection)] = {
+                'bundle_name': bundle_name,
+                'built_at': self._clock(),
+            }
+
+            tmp_path = '%s.%s.tmp' % (self._path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.rename(tmp_path, self._path)
+
+    def _entry(self, resource_name, collection):
+        with self._lock:
+            entry = self._load().get(self._key(resource_name, collection))
+
+        if entry is None or not os.path.exists(
+                os.path.join(self._bundles_dir, entry['bundle_name'])):
+            return None
+        return entry
+
+    def current(self, resource_name, collection):
+        """
+        Returns the name of the last bundle pre-generated for the
+        resource and collection, if it still exists.
+        """
+        entry = self._entry(resource_name, collection)
+        return None if entry is None else entry['bundle_name']
+
+    def fresh(self, resource_name, collection, max_age):
+        """
+        Returns the name of the last bundle pre-generated for the
+        resource and collection, if it is younger than ``max_age``
+        seconds and still exists.
+        """
+        entry = self._entry(resource_name, collection)
+        if entry is None or self._clock() - entry['built_at'] > max_age:
+            return None
+        return entry['bundle_name']
+
+
+class BundleScheduler(object):
+    """
+    Thread that calls ``run(resource_name, collection)`` for each job
+    when its schedule is due. Jobs run one at a time; a job still running
+    when it is due again skips that run.
+
+    Every server process has its own scheduler. With a ``lock_dir``, each
+    due run of a job is claimed through a lock file there, so it is made
+    by a single process.
+    """
+    def __init__(self, jobs, run, clock=datetime.now, poll_interval=60,
+                 lock_dir=None):
+        self._jobs = jobs
+        self._run = run
+        self._clock = clock
+        self._poll_interval = poll_interval
+        self._lock_dir = lock_dir
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop,
+                                        name='delorean-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def run_pending(self, due):
+        """
+        Runs the jobs whose next run is before ``now``, and returns the
+        updated next runs.
+        """
+        now = self._clock()
+        for i, job in enumerate(self._jobs):
+            if due[i] > now:
+                continue
+
+            with self._claimed(job, due[i]) as claimed:
+                if claimed:
+                    try:
+                        self._run(job.resource_name, job.collection)
+                    except Exception:
+                        logger.exception('Scheduled generation failed: %r' % job)
+                else:
+                    logger.info('%r due at %s run by another process.' % (
+                        job, due[i]))
+            due[i] = job.schedule.next_after(self._clock())
+        return due
+
+    @contextmanager
+    def _claimed(self, job, due):
+        """
+        Yields whether this process makes the run of ``job`` due at
+        ``due``: the job's lock file holds the last run claimed, and is
+        locked while it runs.
+        """
+        if self._lock_dir is None:
+            yield True
+            return
+
+        if not os.path.isdir(self._lock_dir):
+            try:
+                os.makedirs(self._lock_dir, 0755)
+            except OSError:  # created by another process
+                pass
+
+        path = os.path.join(self._lock_dir, '%s-%s.lock' % (
+            job.resource_name, job.collection or 'all'))
+        with _flocked(path, blocking=False) as f:
+            if f is None:  # running elsewhere
+                yield False
+                return
+
+            f.seek(0)
+            if f.read().strip() >= due.isoformat():
+                yield False  # already made elsewhere
+                return
+
+            f.seek(0)
+            f.truncate()
+            f.write(due.isoformat())
+            f.flush()
+            yield True
+
+    def _loop(self):
+        now = self._clock()
+        due = [job.schedule.next_after(now) for job in self._jobs]
+        while not self._stopped.is_set():
+            wait = (min(due) - self._clock()).total_seconds()
+            if wait > 0:
+                self._stopped.wait(min(wait, self._poll_interval))
+                continue
+            due = self.run_pending(due)
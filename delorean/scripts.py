@@ -0,0 +1,161 @@
+# coding: utf-8
+"""
+Command-line tools, run with the settings of a paste ini file.
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+
+from pyramid.paster import get_appsettings, setup_logging
+
+from . import main, _upstream_limiter, HERE
+from .upstream import UpstreamSession
+from .datasources import (
+    APIDataSource,
+    SnapshotDataSource,
+    write_snapshot,
+    SNAPSHOT_RESOURCES,
+)
+from .domain import OUTPUT_FORMATS, SHARD_BY
+from .concurrency import parallel_map
+from .resilience import CancellationToken
+from .views import RESOURCE_HANDLERS, _upstream_session, _delorean
+
+logger = logging.getLogger(__name__)
+
+
+def snapshot(argv=sys.argv):
+    """
+    Dumps the Journal Manager resources of a collection to a snapshot,
+    from which bundles can be generated offline.
+    """
+    parser = argparse.ArgumentParser(
+        prog='delorean-snapshot',
+        description='Dumps the Journal Manager resources of a collection.')
+    parser.add_argument('config_uri', help='paste ini file, e.g. production.ini')
+    parser.add_argument('--collection', default=None,
+                        help='collection acronym (default: all)')
+    parser.add_argument('--out', required=True,
+                        help='snapshot file, e.g. brasil.jsonl.gz')
+    parser.add_argument('--resources', default=','.join(SNAPSHOT_RESOURCES),
+                        help='comma separated resources (default: %(default)s)')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+
+    source = APIDataSource(
+        settings['delorean.manager_access_uri'],
+        username=settings.get('delorean.manager_access_username'),
+        api_key=settings.get('delorean.manager_access_api_key'),
+        session=UpstreamSession(limiter=_upstream_limiter(settings)))
+
+    start = time.time()
+    counts = write_snapshot(source, args.out, collection=args.collection,
+                            resources=args.resources.split(','))
+    for resource in sorted(counts):
+        print '%-10s %8d' % (resource, counts[resource])
+    print 'written to %s in %.1fs' % (args.out, time.time() - start)
+
+
+def _comma_separated(value):
+    return tuple(item.strip() for item in value.split(',') if item.strip())
+
+
+def generate(argv=sys.argv, stream=sys.stdout):
+    """
+    Generates bundles outside of the WSGI server, with the components
+    configured by the settings of the ini file, e.g. for cron jobs.
+
+    The timings are reported to ``stream``. Returns the exit status: 0
+    if all the bundles were generated.
+    """
+    parser = argparse.ArgumentParser(
+        prog='delorean-generate',
+        description='Generates the title, issue and section bundles.')
+    parser.add_argument('config_uri', help='paste ini file, e.g. production.ini')
+    parser.add_argument('resource', choices=sorted(RESOURCE_HANDLERS) + ['all'])
+    parser.add_argument('--collection', default=None,
+                        help='collection acronym (default: all)')
+    parser.add_argument('--out', default=os.path.join(HERE, 'public'),
+                        help='directory the bundles are written to '
+                             '(default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='bundles generated at a time (default: 1)')
+    parser.add_argument('--formats', type=_comma_separated, default=None,
+                        help='comma separated members among %s' % ', '.join(
+                            OUTPUT_FORMATS))
+    parser.add_argument('--shards', type=int, default=None,
+                        help='ID files the records are split into')
+    parser.add_argument('--shard-by', choices=SHARD_BY, default='count')
+    parser.add_argument('--snapshot', default=None,
+                        help='snapshot read instead of the API, as written '
+                             'by delorean-snapshot')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds each generation may run')
+    args = parser.parse_args(argv[1:])
+
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.formats and set(args.formats) - set(OUTPUT_FORMATS):
+        parser.error('invalid --formats')
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    # the components are built as in the server, but without its scheduler
+    settings['delorean.schedule.jobs'] = ''
+    registry = main({}, **settings).registry
+
+    data_source = None
+    if args.snapshot:
+        data_source = SnapshotDataSource(args.snapshot)
+
+    handler_kwargs = {'collection': args.collection}
+    if args.formats:
+        handler_kwargs['formats'] = args.formats
+    if args.shards is not None:
+        handler_kwargs['shards'] = args.shards
+        handler_kwargs['shard_by'] = args.shard_by
+
+    def run(resource_name):
+        dl = _delorean(registry, _upstream_session(registry),
+                       CancellationToken(timeout=args.timeout),
+                       data_source=data_source)
+        handler = getattr(dl, RESOURCE_HANDLERS[resource_name])
+        start = time.time()
+        try:
+            name = handler(args.out, **handler_kwargs)
+        except Exception:
+            logger.exception('failed to generate the %s bundle', resource_name)
+            return resource_name, None, time.time() - start
+        return resource_name, name, time.time() - start
+
+    if args.resource == 'all':
+        resources = sorted(RESOURCE_HANDLERS)
+    else:
+        resources = [args.resource]
+
+    start = time.time()
+    try:
+        results = parallel_map(run, resources, workers=args.workers)
+    finally:
+        if data_source is not None:
+            data_source.close()
+
+    for resource_name, name, elapsed in results:
+        if name is None:
+            print >> stream, '%-8s %8.1fs  FAILED' % (resource_name, elapsed)
+        else:
+            size = os.path.getsize(os.path.join(args.out, name))
+            print >> stream, '%-8s %8.1fs %10d bytes  %s' % (
+                resource_name, elapsed, size, name)
+
+    render_cache = getattr(registry, 'render_cache', None)
+    if render_cache is not None:
+        print >> stream, 'render cache: %d hits, %d misses' % (
+            render_cache.hits, render_cache.misses)
+    print >> stream, 'total    %8.1fs' % (time.time() - start)
+
+    return 1 if any(name is None for _, name, _ in results) else 0
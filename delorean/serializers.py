@@ -0,0 +1,89 @@
+# coding: utf-8
+"""
+JSON decoding of the upstream responses.
+"""
+import json
+import itertools
+import StringIO
+
+from slumber import serialize
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+# fastest first
+DECODERS = ('ujson', 'simplejson', 'json')
+
+
+def load_decoder(name='auto'):
+    """
+    Returns the module used to decode JSON documents. ``auto`` picks the
+    fastest one installed, falling back to the stdlib ``json``.
+    """
+    if name != 'auto':
+        return __import__(name)
+
+    for candidate in DECODERS:
+        try:
+            return __import__(candidate)
+        except ImportError:
+            continue
+
+
+class LazyPage(dict):
+    """
+    A page of a collection (``{"meta": {...}, "objects": [...]}``),
+    whose ``objects`` are decoded one at a time, as they are iterated.
+
+    Non-integer numbers are decoded as ``decimal.Decimal``.
+    """
+    def __init__(self, data, ijson_lib=ijson):
+        super(LazyPage, self).__init__()
+        self['meta'] = next(ijson_lib.items(StringIO.StringIO(data), 'meta'))
+        self['objects'] = ijson_lib.items(StringIO.StringIO(data),
+                                          'objects.item')
+
+
+class FastJsonSerializer(serialize.JsonSerializer):
+    """
+    slumber serializer that decodes with the given ``decoder`` module.
+
+    With ``incremental``, collection pages are returned as
+    :class:`LazyPage` instances, so that their first records can be
+    processed before the whole page is decoded. It requires ``ijson``.
+    """
+    def __init__(self, decoder=None, incremental=False, ijson_lib=ijson):
+        if incremental and ijson_lib is None:
+            raise ValueError('incremental decoding requires ijson')
+
+        self._decoder = decoder or load_decoder()
+        self._incremental = incremental
+        self._ijson = ijson_lib
+
+    def _is_page(self, data):
+        # collection pages start with the meta key
+        events = self._ijson.parse(StringIO.StringIO(data))
+        head = list(itertools.islice(events, 2))
+        return head == [('', 'start_map', None), ('', 'map_key', 'meta')]
+
+    def loads(self, data):
+        if self._incremental and self._is_page(data):
+            return LazyPage(data, ijson_lib=self._ijson)
+
+        return self._decoder.loads(data)
+
+    def dumps(self, data):
+        return json.dumps(data)
+
+
+def json_serializer(decoder='auto', incremental=False):
+    """
+    Returns a slumber ``Serializer`` that decodes JSON with ``decoder``.
+    """
+    return serialize.Serializer(
+        default='json',
+        serializers=[FastJsonSerializer(load_decoder(decoder),
+                                        incremental=incremental)])
@@ -0,0 +1,62 @@
+# coding: utf-8
+"""
+Helpers shared by the stores kept on disk.
+"""
+import time
+import decimal
+import sqlite3
+import threading
+
+from .compact import CompactRecord
+
+
+def json_default(obj):
+    """
+    ``default`` of :func:`json.dumps` for the values found in records.
+    """
+    # numbers decoded incrementally by ijson
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    # records kept by the collectors in compact mode
+    if isinstance(obj, CompactRecord):
+        return obj.to_dict()
+    raise TypeError('%r is not JSON serializable' % obj)
+
+
+class SQLiteConnections(object):
+    """
+    Connections to a SQLite database in WAL mode, one per thread, with
+    ``schema`` created on connecting.
+    """
+    def __init__(self, path, schema, pragmas=(), timeout=30,
+                 retry_interval=0.05, sleep=time.sleep):
+        self._path = path
+        self._schema = schema
+        self._pragmas = ('journal_mode=WAL',) + tuple(pragmas)
+        self._timeout = timeout
+        self._retry_interval = retry_interval
+        self._sleep = sleep
+        self._local = threading.local()
+
+    def get(self):
+        # sqlite connections can't be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=self._timeout,
+                                   isolation_level=None)
+            self._init_db(conn)
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self, conn, attempts=10):
+        # processes starting together race to create the schema
+        for attempt in range(attempts):
+            try:
+                for pragma in self._pragmas:
+                    conn.execute('PRAGMA %s' % pragma)
+                conn.executescript(self._schema)
+                return
+            except sqlite3.OperationalError:
+                if attempt == attempts - 1:
+                    raise
+                self._sleep(self._retry_interval)
@@ -29,6 +29,51 @@ class ViewTests(unittest.TestCase):
         info = app_status(request)
         self.assertEqual(info['app_name'], 'delorean')
 
+    def test_profiling_restricted_to_admin_clients(self):
+        from .views import _profiling_requested
+        self.config.registry.settings.update({
+            'delorean.profiling': 'true',
+            'delorean.admin_clients': '127.0.0.1 10.0.0.1',
+        })
+        request = testing.DummyRequest(params={'profile': '1'})
+
+        request.client_addr = '10.0.0.1'
+        self.assertTrue(_profiling_requested(request))
+
+        request.client_addr = '200.136.72.1'
+        self.assertFalse(_profiling_requested(request))
+
+    def test_profiling_disabled_by_default(self):
+        from .views import _profiling_requested
+        self.config.registry.settings['delorean.admin_clients'] = '127.0.0.1'
+        request = testing.DummyRequest(params={'profile': '1'})
+        request.client_addr = '127.0.0.1'
+        self.assertFalse(_profiling_requested(request))
+
+    def test_sampled_stacks_restricted_to_admin_clients(self):
+        from pyramid import httpexceptions
+        from .views import sampled_stacks
+        self.config.registry.settings['delorean.admin_clients'] = '127.0.0.1'
+        request = testing.DummyRequest()
+        request.matchdict['resource'] = 'title'
+        request.client_addr = '200.136.72.1'
+        self.assertRaises(httpexceptions.HTTPForbidden, sampled_stacks, request)
+
+    def test_sampled_stacks(self):
+        from delorean.profiling import StackSampler
+        from .views import sampled_stacks
+        self.config.registry.settings['delorean.admin_clients'] = '127.0.0.1'
+        self.config.registry.sampler = StackSampler()
+        with self.config.registry.sampler.track('title'):
+            self.config.registry.sampler.sample()
+
+        request = testing.DummyRequest()
+        request.matchdict['resource'] = 'title'
+        request.client_addr = '127.0.0.1'
+        response = sampled_stacks(request)
+        self.assertEqual(response.content_type, 'text/plain')
+        self.assertTrue(response.text.endswith(' 1'))
+
 
 # Unit tests
 #################
@@ -168,6 +213,30 @@ class DataCollectorTests(MockerTestCase):
         self.assertTrue('objects' in res)
         self.assertTrue(len(res['objects']), 1)
 
+    def test_lookups_are_made_for_the_collection(self):
+        dummy_slumber = self.mocker.mock()
+        dummy_user = self.mocker.mock()
+
+        dummy_slumber.API(ANY)
+        self.mocker.result(dummy_slumber)
+
+        dummy_slumber.users(ANY)
+        self.mocker.result(dummy_user)
+
+        dummy_user.get(username='user', api_key='key', collection='brasil')
+        self.mocker.result({'username': 'albert.einstein@scielo.org'})
+
+        self.mocker.replay()
+
+        dc = self._makeOne(self.title_res,
+                           slumber_lib=dummy_slumber,
+                           username='user',
+                           api_key='key',
+                           collection='brasil')
+
+        self.assertEqual(dc._lookup_field('users', '1', 'username'),
+                         'albert.einstein@scielo.org')
+
 
 class TitleCollectorTests(MockerTestCase):
     title_res = u'http://manager.scielo.org/api/v1/'
@@ -192,14 +261,10 @@ class TitleCollectorTests(MockerTestCase):
         from delorean.domain import TitleCollector
 
         dummy_slumber = self.mocker.mock()
-        dummy_journal = self.mocker.mock()
 
         dummy_slumber.API(ANY)
         self.mocker.result(dummy_slumber)
 
-        dummy_slumber.journals
-        self.mocker.result(dummy_journal)
-
         self.mocker.replay()
 
         dc = self._makeOne(self.title_res,
@@ -209,14 +274,10 @@ class TitleCollectorTests(MockerTestCase):
 
     def test_gen_iterable(self):
         dummy_slumber = self.mocker.mock()
-        dummy_journal = self.mocker.mock()
 
         dummy_slumber.API(ANY)
         self.mocker.result(dummy_slumber)
 
-        dummy_slumber.journals
-        self.mocker.result(dummy_journal)
-
         self.mocker.replay()
 
         dc = self._makeOne(self.title_res,
@@ -301,14 +362,10 @@ class SectionCollectorTests(MockerTestCase):
         from delorean.domain import SectionCollector
 
         dummy_slumber = self.mocker.mock()
-        dummy_journal = self.mocker.mock()
 
         dummy_slumber.API(ANY)
         self.mocker.result(dummy_slumber)
 
-        dummy_slumber.journals
-        self.mocker.result(dummy_journal)
-
         self.mocker.replay()
 
         dc = self._makeOne(self.section_res,
@@ -317,14 +374,10 @@ class SectionCollectorTests(MockerTestCase):
 
     def test_gen_iterable(self):
         dummy_slumber = self.mocker.mock()
-        dummy_journal = self.mocker.mock()
 
         dummy_slumber.API(ANY)
         self.mocker.result(dummy_slumber)
 
-        dummy_slumber.journals
-        self.mocker.result(dummy_journal)
-
         self.mocker.replay()
 
         dc = self._makeOne(self.section_res,
@@ -405,14 +458,10 @@ class IssueCollectorTests(MockerTestCase):
         from delorean.domain import IssueCollector
 
         dummy_slumber = self.mocker.mock()
-        dummy_issues = self.mocker.mock()
 
         dummy_slumber.API(ANY)
         self.mocker.result(dummy_slumber)
 
-        dummy_slumber.issues
-        self.mocker.result(dummy_issues)
-
         self.mocker.replay()
 
         dc = self._makeOne(self.issue_res,
@@ -421,14 +470,10 @@ class IssueCollectorTests(MockerTestCase):
 
     def test_gen_iterable(self):
         dummy_slumber = self.mocker.mock()
-        dummy_issues = self.mocker.mock()
 
         dummy_slumber.API(ANY)
         self.mocker.result(dummy_slumber)
 
-        dummy_slumber.issues
-        self.mocker.result(dummy_issues)
-
         self.mocker.replay()
 
         dc = self._makeOne(self.issue_res,
@@ -973,3 +1018,2736 @@ class ResourceUnavailableErrorTests(unittest.TestCase):
     def test_raise(self):
         from delorean.domain import ResourceUnavailableError
         self.assertTrue(issubclass(ResourceUnavailableError, BaseException))
+
+
+class GenerationProfilerTests(unittest.TestCase):
+
+    def _makeOne(self, *args, **kwargs):
+        from delorean.profiling import GenerationProfiler
+        return GenerationProfiler(*args, **kwargs)
+
+    def test_run_returns_the_func_result(self):
+        p = self._makeOne('/tmp/files')
+        self.assertEqual(p.run(lambda x, y=0: x + y, 1, y=2), 3)
+
+    def test_dump_writes_stats_and_summary(self):
+        import pstats
+        p = self._makeOne('/tmp/files', top_n=5)
+        p.run(sorted, range(10))
+        stats_name, summary_name = p.dump('title-profiled')
+
+        self.assertEqual(stats_name, 'title-profiled.pstats')
+        self.assertEqual(summary_name, 'title-profiled.profile.txt')
+        pstats.Stats(os.path.join('/tmp/files', stats_name))
+        self.assertTrue(os.path.getsize(os.path.join('/tmp/files', summary_name)))
+
+    def test_dump_before_run(self):
+        p = self._makeOne('/tmp/files')
+        self.assertRaises(ValueError, p.dump, 'title')
+
+
+class StackSamplerTests(unittest.TestCase):
+
+    def _makeOne(self, *args, **kwargs):
+        from delorean.profiling import StackSampler
+        return StackSampler(*args, **kwargs)
+
+    def test_only_tracked_threads_are_sampled(self):
+        sampler = self._makeOne()
+        sampler.sample()
+        self.assertEqual(sampler.collapsed('issue'), '')
+
+        with sampler.track('issue'):
+            sampler.sample()
+            sampler.sample()
+        sampler.sample()
+
+        stack, count = sampler.collapsed('issue').rsplit(' ', 1)
+        self.assertEqual(count, '2')
+        self.assertTrue(stack.endswith(
+            'test_only_tracked_threads_are_sampled (tests.py);sample (profiling.py)'))
+
+    def test_stacks_are_aggregated_per_resource(self):
+        sampler = self._makeOne()
+        with sampler.track('issue'):
+            sampler.sample()
+        with sampler.track('title'):
+            sampler.sample()
+
+        sampler.reset('issue')
+        self.assertEqual(sampler.collapsed('issue'), '')
+        self.assertNotEqual(sampler.collapsed('title'), '')
+
+    def test_start_and_stop(self):
+        import time
+        sampler = self._makeOne(interval=0.001)
+        sampler.start()
+        with sampler.track('section'):
+            time.sleep(0.05)
+        sampler.stop()
+        self.assertNotEqual(sampler.collapsed('section'), '')
+
+
+class MemoryProfilerTests(unittest.TestCase):
+
+    def _makeOne(self, *args, **kwargs):
+        from delorean.profiling import MemoryProfiler
+        return MemoryProfiler(*args, **kwargs)
+
+    def test_phases_without_tracemalloc(self):
+        from delorean.domain import Bundle, Transformer
+        profiler = self._makeOne(tracemalloc_lib=None)
+
+        with profiler.activate():
+            id_string = Transformer('!v100!${title}').transform_list(
+                [{'title': 'Revista %s' % i} for i in range(10)])
+            Bundle(('title.id', id_string)).deploy('/tmp/files/profiled.tar')
+
+        report = profiler.report()
+        self.assertEqual([p['phase'] for p in report],
+                         ['render', 'join', 'tar', 'deploy'])
+        for record in report:
+            self.assertTrue('peak_bytes' in record)
+            self.assertTrue('retained_bytes' in record)
+            self.assertEqual(record['top_allocations'], [])
+
+    def test_phases_outside_activation_are_ignored(self):
+        from delorean.profiling import phase
+        profiler = self._makeOne(tracemalloc_lib=None)
+        with phase('render'):
+            pass
+        self.assertEqual(profiler.report(), [])
+
+    def test_phases_with_tracemalloc(self):
+        from delorean.profiling import phase
+
+        class Frame(object):
+            filename = 'domain.py'
+            lineno = 42
+
+        class Stat(object):
+            traceback = [Frame()]
+            size = 2048
+            count = 3
+
+        class Snapshot(object):
+            def statistics(self, key_type):
+                return [Stat()]
+
+        class DummyTracemalloc(object):
+            tracing = False
+
+            def is_tracing(self):
+                return self.tracing
+
+            def start(self, nframes):
+                self.tracing = True
+
+            def stop(self):
+                self.tracing = False
+
+            def get_traced_memory(self):
+                return 1024, 4096
+
+            def take_snapshot(self):
+                return Snapshot()
+
+        dummy_tracemalloc = DummyTracemalloc()
+        profiler = self._makeOne(tracemalloc_lib=dummy_tracemalloc)
+        with profiler.activate():
+            with phase('tar'):
+                self.assertTrue(dummy_tracemalloc.tracing)
+
+        self.assertFalse(dummy_tracemalloc.tracing)
+        self.assertEqual(profiler.report(), [{
+            'phase': 'tar',
+            'peak_bytes': 4096,
+            'retained_bytes': 1024,
+            'top_allocations': [
+                {'site': 'domain.py:42', 'size_bytes': 2048, 'count': 3}],
+        }])
+
+    def test_a_single_profiler_is_active_at_a_time(self):
+        from delorean.profiling import ProfilerBusyError
+        profiler = self._makeOne(tracemalloc_lib=None)
+        with profiler.activate():
+            other = self._makeOne(tracemalloc_lib=None)
+            with self.assertRaises(ProfilerBusyError):
+                with other.activate():
+                    pass
+        with profiler.activate():
+            pass
+
+    def test_collected_memo_is_reported(self):
+        import sys
+        from delorean.profiling import collected
+        profiler = self._makeOne(tracemalloc_lib=None)
+        memo = {'publishers': {'1': {'name': 'Unesp', 'city': 'Sao Paulo'},
+                               '2': {'name': 'USP'}}}
+        class Collector(object):
+            pass
+        collector = Collector()
+        collector.memo = memo
+
+        with profiler.activate():
+            collected(collector)
+
+        record, = profiler.report()
+        self.assertEqual(record['phase'], 'collect')
+        self.assertEqual(record['memoized_lookups'], 3)
+        self.assertIsNone(record['peak_bytes'])
+        self.assertTrue(record['retained_bytes'] > sys.getsizeof(memo))
+
+    def test_concurrent_memory_profiling_is_a_conflict(self):
+        from delorean.views import _memory_profiling
+        from pyramid import httpexceptions
+        self.config = testing.setUp(settings={
+            'delorean.memory_profiling': 'true',
+            'delorean.admin_clients': '127.0.0.1',
+        })
+        self.addCleanup(testing.tearDown)
+        request = testing.DummyRequest(params={'memory': '1'})
+        request.client_addr = '127.0.0.1'
+
+        result = {}
+        with _memory_profiling(request, result):
+            with self.assertRaises(httpexceptions.HTTPConflict):
+                with _memory_profiling(request, {}):
+                    pass
+        self.assertTrue('memory_profile' in result)
+
+
+class TracerTests(unittest.TestCase):
+
+    def _makeOne(self, *args, **kwargs):
+        from delorean.tracing import Tracer
+        return Tracer(*args, **kwargs)
+
+    def test_spans_outside_activation_are_ignored(self):
+        from delorean.tracing import span
+        tracer = self._makeOne()
+        with span('render') as args:
+            args['bytes'] = 10
+        self.assertEqual(tracer.events, [])
+
+    def test_nested_spans(self):
+        from delorean.tracing import span
+        tracer = self._makeOne()
+        with tracer.activate():
+            with span('lookup', endpoint='journals', id='1'):
+                with span('http', cat='upstream') as args:
+                    args['status'] = 200
+
+        http, lookup = tracer.events
+        self.assertEqual(lookup['name'], 'lookup')
+        self.assertEqual(lookup['ph'], 'X')
+        self.assertEqual(lookup['args'], {'endpoint': 'journals', 'id': '1'})
+        self.assertEqual(http['args'], {'status': 200})
+        self.assertTrue(lookup['ts'] <= http['ts'])
+        self.assertTrue(lookup['ts'] + lookup['dur'] >= http['ts'] + http['dur'])
+
+    def test_failed_spans_are_annotated(self):
+        from delorean.tracing import span
+        tracer = self._makeOne()
+
+        def fail():
+            with tracer.activate():
+                with span('fetch_page'):
+                    raise ValueError('boom')
+
+        self.assertRaises(ValueError, fail)
+        self.assertTrue('boom' in tracer.events[0]['args']['error'])
+
+    def test_export_and_load(self):
+        from delorean.tracing import span
+        tracer = self._makeOne()
+        with tracer.activate():
+            with span('render'):
+                pass
+            with span('bundle.tar'):
+                pass
+
+        tracer.export('/tmp/files/traces/test.trace.jsonl')
+        events = tracer.load('/tmp/files/traces/test.trace.jsonl')
+        self.assertEqual([e['name'] for e in events], ['render', 'bundle.tar'])
+
+    def test_collector_spans(self):
+        from delorean.domain import TitleCollector
+
+        class DummyResource(object):
+            def __init__(self, data):
+                self.data = data
+
+            def __call__(self, res_id):
+                return self
+
+            def get(self, **kwargs):
+                return self.data
+
+        class DummyAPI(object):
+            journals = DummyResource({
+                'objects': [{'previous_title': '/api/v1/journals/2/'}],
+                'meta': {'next': None}})
+
+        class DummySlumber(object):
+            @staticmethod
+            def API(resource_url):
+                return DummyAPI()
+
+        tracer = self._makeOne()
+        dc = TitleCollector('http://localhost:8000/api/v1/',
+                            slumber_lib=DummySlumber)
+        with tracer.activate():
+            dc.fetch_data(0, 50)
+            dc._lookup_field('journals', '2', 'meta')
+
+        lookup = [e for e in tracer.events if e['name'] == 'lookup'][0]
+        self.assertEqual(lookup['args'],
+                         {'endpoint': 'journals', 'id': '2', 'retries': 0})
+
+    def test_spans_of_started_threads_are_recorded(self):
+        import threading
+        from delorean.tracing import span
+        from delorean.concurrency import (HedgingPolicy, SingleFlight,
+                                          parallel_map)
+
+        def work(name):
+            with span(name):
+                return threading.current_thread().ident
+
+        tracer = self._makeOne()
+        with tracer.activate():
+            idents = parallel_map(work, ['first', 'second'])
+            idents.append(SingleFlight().do('key', lambda: work('shared'),
+                                            timeout=5)[0])
+            done = threading.Event()
+            HedgingPolicy._spawn(lambda: (work('hedged'), done.set()))
+            self.assertTrue(done.wait(5))
+
+        events = dict((e['name'], e['tid']) for e in tracer.events)
+        self.assertEqual(sorted(events),
+                         ['first', 'hedged', 'second', 'shared'])
+        self.assertFalse(threading.current_thread().ident in events.values())
+        self.assertEqual([events['first'], events['second'], events['shared']],
+                         idents)
+
+    def test_threads_started_without_a_tracer_record_nothing(self):
+        from delorean.tracing import span
+        from delorean.concurrency import parallel_map
+
+        def work(name):
+            with span(name):
+                pass
+
+        tracer = self._makeOne()
+        parallel_map(work, ['first'])
+        self.assertEqual(tracer.events, [])
+
+
+class UpstreamSessionTests(unittest.TestCase):
+
+    def _makeOne(self, *args, **kwargs):
+        from delorean.upstream import UpstreamSession
+        session = UpstreamSession(*args, **kwargs)
+        session.mount('http://', DummyAdapter())
+        return session
+
+    def test_http_spans(self):
+        from delorean.tracing import Tracer
+        tracer = Tracer()
+        with tracer.activate():
+            response = self._makeOne().get('http://manager/api/v1/journals/')
+
+        self.assertEqual(response.status_code, 200)
+        event = tracer.events[0]
+        self.assertEqual(event['name'], 'http')
+        self.assertEqual(event['args']['status'], 200)
+        self.assertEqual(event['args']['bytes'], len(response.content))
+
+
+class CassetteTests(unittest.TestCase):
+    cassette_path = '/tmp/files/journals.cassette.gz'
+
+    def setUp(self):
+        if not os.path.exists('/tmp/files'):
+            os.makedirs('/tmp/files')
+
+    def _makeOne(self, *args, **kwargs):
+        from delorean.cassette import Cassette
+        return Cassette(*args, **kwargs)
+
+    def _session(self, cassette, adapter=None):
+        from delorean.upstream import UpstreamSession
+        session = UpstreamSession(cassette=cassette)
+        session.mount('http://', adapter or DummyAdapter())
+        return session
+
+    def _record(self):
+        cassette = self._makeOne(self.cassette_path, mode='record')
+        session = self._session(cassette, DummyAdapter([
+            (200, b'{"objects": [], "meta": {"next": null}}', {'etag': '"a"'}),
+            (200, b'{"title": "ABCD"}', {}),
+        ]))
+        session.get('http://manager/api/v1/journals/',
+                    params={'offset': 0, 'limit': 50, 'api_key': 'secret'})
+        session.get('http://manager/api/v1/journals/1/')
+        cassette.close()
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, self._makeOne, self.cassette_path,
+                          mode='rewind')
+
+    def test_key_ignores_credentials(self):
+        from delorean.cassette import Cassette
+        self.assertEqual(
+            Cassette.key('get', 'http://manager/api/v1/journals/',
+                         {'limit': 50, 'offset': 0, 'username': 'x', 'api_key': 'y'}),
+            'GET http://manager/api/v1/journals/?limit=50&offset=0')
+
+    def test_replay(self):
+        self._record()
+        adapter = DummyAdapter()
+        session = self._session(
+            self._makeOne(self.cassette_path, mode='replay'), adapter)
+
+        page = session.get('http://manager/api/v1/journals/',
+                           params={'offset': 0, 'limit': 50, 'api_key': 'other'})
+        journal = session.get('http://manager/api/v1/journals/1/')
+
+        self.assertEqual(adapter.requests, [])
+        self.assertEqual(page.json(), {'objects': [], 'meta': {'next': None}})
+        self.assertEqual(page.headers['etag'], '"a"')
+        self.assertEqual(journal.json(), {'title': 'ABCD'})
+
+    def test_replay_miss(self):
+        from delorean.cassette import CassetteMissError
+        self._record()
+        session = self._session(self._makeOne(self.cassette_path, mode='replay'))
+        self.assertRaises(CassetteMissError, session.get,
+                          'http://manager/api/v1/journals/2/')
+
+    def test_replay_emulating_timing(self):
+        self._record()
+        slept = []
+        session = self._session(self._makeOne(
+            self.cassette_path, emulate_timing=True, sleep=slept.append))
+        session.get('http://manager/api/v1/journals/1/')
+        self.assertEqual(len(slept), 1)
+        self.assertTrue(slept[0] >= 0)
+
+    def test_generations_with_a_cassette_skip_the_lookup_cache(self):
+        from delorean.views import _delorean
+        config = testing.setUp(settings={
+            'delorean.manager_access_uri': 'http://manager/api/v1/',
+            'delorean.manager_access_username': 'user',
+            'delorean.manager_access_api_key': 'key',
+        })
+        self.addCleanup(testing.tearDown)
+        config.registry.lookup_cache = lookup_cache = object()
+
+        dl = _delorean(config.registry, None, None)
+        self.assertTrue(dl._lookup_cache is lookup_cache)
+        dl = _delorean(config.registry, None, None,
+                       cassette=self._makeOne(self.cassette_path))
+        self.assertIsNone(dl._lookup_cache)
+
+    def test_no_recording_after_close(self):
+        self._record()
+        cassette = self._makeOne(self.cassette_path, mode='record')
+        cassette.close()
+        session = self._session(cassette, DummyAdapter([(200, b'{}', {})]))
+        self.assertRaises(ValueError, session.get,
+                          'http://manager/api/v1/journals/2/')
+
+        # what was recorded before is kept
+        session = self._session(self._makeOne(self.cassette_path))
+        self.assertEqual(session.get('http://manager/api/v1/journals/1/').json(),
+                         {'title': 'ABCD'})
+
+
+class HTTPCacheTests(unittest.TestCase):
+    url = 'http://manager/api/v1/journals/1/'
+
+    def setUp(self):
+        import tempfile
+        self.cache_dir = tempfile.mkdtemp()
+        self.now = [1000.0]
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.cache_dir)
+
+    def _session(self, adapter, ttl=60):
+        from delorean.httpcache import HTTPCache
+        from delorean.upstream import UpstreamSession
+        cache = HTTPCache(self.cache_dir, ttl=ttl, clock=lambda: self.now[0])
+        session = UpstreamSession(cache=cache)
+        session.mount('http://', adapter)
+        return session
+
+    def test_revalidation_with_etag(self):
+        adapter = DummyAdapter([
+            (200, b'{"title": "ABCD"}', {'ETag': '"v1"'}),
+            (304, b'', {'ETag': '"v1"'}),
+        ])
+        session = self._session(adapter)
+
+        first = session.get(self.url)
+        second = session.get(self.url)
+
+        self.assertEqual(first.cache_status, 'miss')
+        self.assertEqual(second.cache_status, 'revalidated')
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json(), {'title': 'ABCD'})
+        self.assertEqual(adapter.requests[1].headers['If-None-Match'], '"v1"')
+
+    def test_changed_resources_are_replaced(self):
+        adapter = DummyAdapter([
+            (200, b'{"title": "ABCD"}', {'Last-Modified': 'Mon, 01 Jul 2013 10:00:00 GMT'}),
+            (200, b'{"title": "ABCD."}', {'Last-Modified': 'Tue, 02 Jul 2013 10:00:00 GMT'}),
+        ])
+        session = self._session(adapter)
+
+        session.get(self.url)
+        self.assertEqual(session.get(self.url).json(), {'title': 'ABCD.'})
+        self.assertEqual(adapter.requests[1].headers['If-Modified-Since'],
+                         'Mon, 01 Jul 2013 10:00:00 GMT')
+
+    def test_ttl_without_validators(self):
+        adapter = DummyAdapter([
+            (200, b'{"title": "ABCD"}', {}),
+            (200, b'{"title": "ABCD."}', {}),
+        ])
+        session = self._session(adapter, ttl=60)
+
+        session.get(self.url)
+        self.assertEqual(session.get(self.url).cache_status, 'fresh')
+        self.assertEqual(len(adapter.requests), 1)
+
+        self.now[0] += 61
+        self.assertEqual(session.get(self.url).json(), {'title': 'ABCD.'})
+        self.assertEqual(len(adapter.requests), 2)
+
+    def test_listings_are_refetched_once_expired(self):
+        from delorean.httpcache import HTTPCache
+        listing = 'http://manager/api/v1/journals/'
+        adapter = DummyAdapter([
+            (200, b'{"objects": [{"title": "ABCD"}]}', {}),
+            (200, b'{"title": "ABCD"}', {}),
+            (200, b'{"objects": [{"title": "ABCD."}]}', {}),
+        ])
+        session = self._session(adapter, ttl=60)
+        session.get(listing, params={'offset': 0})
+        session.get(self.url)
+
+        self.now[0] += 1
+        HTTPCache(self.cache_dir, clock=lambda: self.now[0]).expire_listings()
+        self.now[0] += 1
+
+        self.assertEqual(session.get(listing, params={'offset': 0}).json(),
+                         {'objects': [{'title': 'ABCD.'}]})
+        self.assertEqual(session.get(self.url).cache_status, 'fresh')
+        self.assertEqual(session.get(listing, params={'offset': 0}).cache_status,
+                         'fresh')
+        self.assertEqual(len(adapter.requests), 3)
+
+    def test_errors_are_not_cached(self):
+        adapter = DummyAdapter([(500, b'', {}), (200, b'{}', {})])
+        session = self._session(adapter)
+        session.get(self.url)
+        session.get(self.url)
+        self.assertEqual(len(adapter.requests), 2)
+
+
+class SerializerTests(unittest.TestCase):
+    page = (b'{"meta": {"next": null, "total_count": 2}, '
+            b'"objects": [{"acronym": "abcd"}, {"acronym": "rsp"}]}')
+
+    def test_auto_decoder(self):
+        from delorean.serializers import load_decoder
+        self.assertTrue(hasattr(load_decoder(), 'loads'))
+        self.assertEqual(load_decoder('json').__name__, 'json')
+
+    def test_decoder_is_used(self):
+        from delorean.serializers import FastJsonSerializer
+
+        class DummyDecoder(object):
+            @staticmethod
+            def loads(data):
+                return 'decoded'
+
+        s = FastJsonSerializer(decoder=DummyDecoder)
+        self.assertEqual(s.loads(self.page), 'decoded')
+        self.assertEqual(s.get_content_type(), 'application/json')
+
+    def test_incremental_requires_ijson(self):
+        from delorean.serializers import FastJsonSerializer
+        self.assertRaises(ValueError, FastJsonSerializer,
+                          incremental=True, ijson_lib=None)
+
+    def test_collector_with_serializer(self):
+        from delorean.domain import TitleCollector
+        from delorean.serializers import json_serializer
+        from delorean.upstream import UpstreamSession
+
+        session = UpstreamSession()
+        session.mount('http://', DummyAdapter([(200, self.page, {})]))
+
+        class AcronymCollector(TitleCollector):
+            def get_data(self, obj):
+                return obj['acronym']
+
+        dc = AcronymCollector('http://manager/api/v1/', session=session,
+                              serializer=json_serializer('json'))
+        self.assertEqual(list(dc), ['abcd', 'rsp'])
+
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+@unittest.skipIf(ijson is None, 'ijson is not installed')
+class IncrementalSerializerTests(unittest.TestCase):
+    page = SerializerTests.page
+
+    def _makeOne(self):
+        from delorean.serializers import FastJsonSerializer
+        return FastJsonSerializer(incremental=True)
+
+    def test_pages_are_decoded_lazily(self):
+        page = self._makeOne().loads(self.page)
+        self.assertEqual(page['meta'], {'next': None, 'total_count': 2})
+        self.assertFalse(isinstance(page['objects'], list))
+        self.assertEqual(list(page['objects']),
+                         [{'acronym': 'abcd'}, {'acronym': 'rsp'}])
+
+    def test_other_documents_are_fully_decoded(self):
+        self.assertEqual(self._makeOne().loads(b'{"title": "ABCD", "meta": 1}'),
+                         {'title': 'ABCD', 'meta': 1})
+
+
+class SQLiteLookupCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.cache_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.cache_dir, 'lookups.sqlite')
+        self.now = [1000.0]
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.cache_dir)
+
+    def _makeOne(self, **kwargs):
+        from delorean.lookupcache import SQLiteLookupCache
+        kwargs.setdefault('clock', lambda: self.now[0])
+        return SQLiteLookupCache(self.path, **kwargs)
+
+    def test_get_or_fill(self):
+        cache = self._makeOne()
+        fills = []
+
+        def fill():
+            fills.append(1)
+            return {'title': 'ABCD'}
+
+        self.assertEqual(cache.get_or_fill('journals-1', fill), {'title': 'ABCD'})
+        self.assertEqual(cache.get_or_fill('journals-1', fill), {'title': 'ABCD'})
+        self.assertEqual(len(fills), 1)
+
+    def test_entries_expire(self):
+        cache = self._makeOne(ttl=60)
+        cache.set('journals-1', {'title': 'ABCD'})
+        self.now[0] += 61
+        self.assertEqual(cache.get('journals-1'), None)
+
+    def test_shared_between_instances(self):
+        self._makeOne().set('journals-1', {'title': 'ABCD'})
+        self.assertEqual(self._makeOne().get('journals-1'), {'title': 'ABCD'})
+
+    def test_concurrent_misses_are_coalesced(self):
+        import threading
+        import time
+        fills = []
+        results = []
+
+        def fill():
+            fills.append(1)
+            time.sleep(0.1)
+            return {'title': 'ABCD'}
+
+        def lookup():
+            cache = self._makeOne(clock=time.time, poll_interval=0.01)
+            results.append(cache.get_or_fill('journals-1', fill))
+
+        threads = [threading.Thread(target=lookup) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(fills), 1)
+        self.assertEqual(results, [{'title': 'ABCD'}] * 4)
+
+    def test_stale_leases_are_taken_over(self):
+        cache = self._makeOne(lease_timeout=30)
+        self.assertTrue(cache._acquire('journals-1'))
+        self.assertFalse(cache._acquire('journals-1'))
+        self.now[0] += 31
+        self.assertTrue(cache._acquire('journals-1'))
+
+    def test_collector_lookups(self):
+        from delorean.domain import TitleCollector
+        from delorean.upstream import UpstreamSession
+
+        session = UpstreamSession()
+        adapter = DummyAdapter([(200, b'{"title": "ABCD"}', {})])
+        session.mount('http://', adapter)
+        cache = self._makeOne()
+
+        for i in range(2):
+            dc = TitleCollector('http://manager/api/v1/', session=session,
+                                lookup_cache=cache)
+            self.assertEqual(dc._lookup_field('journals', '1', 'title'), 'ABCD')
+        self.assertEqual(len(adapter.requests), 1)
+
+
+class SingleFlightTests(unittest.TestCase):
+
+    def _makeOne(self):
+        from delorean.concurrency import SingleFlight
+        return SingleFlight()
+
+    def _concurrently(self, flight, keys, func):
+        import threading
+        self.entered = []
+        results = []
+
+        def call(key):
+            self.entered.append(key)
+            results.append(flight.do(key, lambda: func(key)))
+
+        threads = [threading.Thread(target=call, args=(key,)) for key in keys]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_concurrent_calls_are_coalesced(self):
+        import threading
+        import time
+        flight = self._makeOne()
+        release = threading.Event()
+        calls = []
+
+        def generate(key):
+            calls.append(key)
+            release.wait()
+            return 'issue-20120712-10:07:34:803942.tar'
+
+        threads, results = self._concurrently(
+            flight, [('issue', 'scl')] * 3, generate)
+        while len(self.entered) < 3 or not flight._calls:
+            time.sleep(0.01)
+        time.sleep(0.05)  # let the followers reach the flight
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(shared for result, shared in results),
+                         [False, True, True])
+        self.assertEqual(set(result for result, shared in results),
+                         set(['issue-20120712-10:07:34:803942.tar']))
+
+    def test_distinct_keys_run_separately(self):
+        flight = self._makeOne()
+        threads, results = self._concurrently(
+            flight, [('issue', 'scl'), ('issue', 'arg')], lambda key: key[1])
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), [('arg', False), ('scl', False)])
+
+    def test_exceptions_are_shared(self):
+        from delorean.domain import ResourceUnavailableError
+        flight = self._makeOne()
+
+        def generate():
+            raise ResourceUnavailableError('down')
+
+        self.assertRaises(ResourceUnavailableError, flight.do,
+                          ('title', None), generate)
+        self.assertEqual(flight._calls, {})
+
+    def test_leader_may_give_up_waiting(self):
+        import threading
+        from delorean.resilience import DeadlineExceeded
+        flight = self._makeOne()
+        release = threading.Event()
+
+        def generate():
+            release.wait()
+            return 'issue-20120712-10:07:34:803942.tar'
+
+        # the call started by the impatient request goes on
+        self.assertRaises(DeadlineExceeded, flight.do, ('issue', 'scl'),
+                          generate, timeout=0.01)
+        threading.Timer(0.05, release.set).start()
+        self.assertEqual(flight.do(('issue', 'scl'), lambda: None),
+                         ('issue-20120712-10:07:34:803942.tar', True))
+        self.assertEqual(flight._calls, {})
+
+    def test_followers_give_up_after_timeout(self):
+        import threading
+        from delorean.resilience import DeadlineExceeded
+        flight = self._makeOne()
+        release = threading.Event()
+        leader = threading.Thread(target=flight.do,
+                                  args=(('issue', 'scl'), release.wait))
+        leader.start()
+        while not flight._calls:
+            pass
+
+        self.assertRaises(DeadlineExceeded, flight.do, ('issue', 'scl'),
+                          lambda: None, timeout=0.01)
+        release.set()
+        leader.join()
+
+    def test_call_is_cancelled_when_everyone_gave_up(self):
+        import threading
+        from delorean.resilience import CancellationToken, DeadlineExceeded
+        flight = self._makeOne()
+        token = CancellationToken()
+
+        def generate():
+            while True:
+                token.sleep(0.01)
+
+        def follow():
+            self.assertRaises(DeadlineExceeded, flight.do, ('issue', 'scl'),
+                              generate, timeout=0.2)
+
+        follower = threading.Timer(0.005, follow)
+        follower.start()
+        self.assertRaises(DeadlineExceeded, flight.do, ('issue', 'scl'),
+                          generate, timeout=0.05, cancellation=token)
+        # the follower is still waiting
+        self.assertFalse(token.cancelled)
+        follower.join()
+        self.assertTrue(token.cancelled)
+        self.assertEqual(flight._calls, {})
+
+        # later calls start over
+        self.assertEqual(flight.do(('issue', 'scl'), lambda: 'issue.tar'),
+                         ('issue.tar', False))
+
+    def test_call_waited_without_deadline_is_not_cancelled(self):
+        import threading
+        from delorean.resilience import CancellationToken, DeadlineExceeded
+        flight = self._makeOne()
+        token = CancellationToken()
+        release = threading.Event()
+        results = []
+
+        def generate():
+            release.wait()
+            token.check()
+            return 'issue.tar'
+
+        # e.g. the scheduler
+        leader = threading.Thread(target=lambda: results.append(flight.do(
+            ('issue', 'scl'), generate, cancellation=token)))
+        leader.start()
+        while not flight._calls:
+            pass
+
+        self.assertRaises(DeadlineExceeded, flight.do, ('issue', 'scl'),
+                          generate, timeout=0.01)
+        self.assertFalse(token.cancelled)
+        release.set()
+        leader.join()
+        self.assertEqual(results, [('issue.tar', False)])
+
+
+class TokenBucketTests(unittest.TestCase):
+
+    def _makeOne(self, rate, burst):
+        from delorean.concurrency import TokenBucket
+        self.now = [0.0]
+        self.slept = []
+        return TokenBucket(rate, burst, clock=lambda: self.now[0],
+                           sleep=self.slept.append)
+
+    def test_bursts_do_not_wait(self):
+        bucket = self._makeOne(rate=2, burst=3)
+        self.assertEqual([bucket.acquire() for i in range(3)], [0, 0, 0])
+        self.assertEqual(self.slept, [])
+
+    def test_waits_when_empty(self):
+        bucket = self._makeOne(rate=2, burst=1)
+        bucket.acquire()
+        self.assertEqual(bucket.acquire(), 0.5)
+        self.assertEqual(bucket.acquire(), 1.0)  # queued behind the previous
+
+    def test_refills_over_time(self):
+        bucket = self._makeOne(rate=2, burst=1)
+        bucket.acquire()
+        self.now[0] += 0.5
+        self.assertEqual(bucket.acquire(), 0)
+
+
+class UpstreamLimiterTests(unittest.TestCase):
+
+    def test_endpoint_name(self):
+        from delorean.concurrency import endpoint_name
+        self.assertEqual(endpoint_name('http://manager/api/v1/journals/'), 'journals')
+        self.assertEqual(endpoint_name('http://manager/api/v1/issues/12/'), 'issues')
+
+    def test_per_endpoint_limits(self):
+        from delorean.concurrency import UpstreamLimiter
+        slept = []
+        limiter = UpstreamLimiter(rate=None, endpoint_limits={'issues': (1, 1)},
+                                  clock=lambda: 0.0, sleep=slept.append)
+        for i in range(2):
+            with limiter.slot('journals'):
+                pass
+        self.assertEqual(slept, [])
+
+        for i in range(2):
+            with limiter.slot('issues'):
+                pass
+        self.assertEqual(slept, [1.0])
+
+    def test_max_concurrency(self):
+        from delorean.concurrency import UpstreamLimiter
+        limiter = UpstreamLimiter(max_concurrency=1)
+        with limiter.slot('journals'):
+            self.assertFalse(limiter._semaphore.acquire(False))
+        self.assertTrue(limiter._semaphore.acquire(False))
+
+    def test_session_accumulates_the_wait(self):
+        from delorean.concurrency import UpstreamLimiter
+        from delorean.upstream import UpstreamSession
+        now = [0.0]
+
+        def sleep(secs):
+            now[0] += secs
+
+        session = UpstreamSession(limiter=UpstreamLimiter(
+            rate=10, burst=1, clock=lambda: now[0], sleep=sleep))
+        session.mount('http://', DummyAdapter())
+        for i in range(3):
+            session.get('http://manager/api/v1/journals/')
+        self.assertAlmostEqual(session.limiter_wait, 0.2)
+
+    def test_settings(self):
+        from delorean import _upstream_limiter
+        limiter = _upstream_limiter({
+            'delorean.upstream.max_concurrency': '4',
+            'delorean.upstream.rate': '20',
+            'delorean.upstream.rate.issues': '5 2',
+            'delorean.upstream.rate.sections': '3',
+        })
+        self.assertEqual(limiter._default_limit, (20.0, 1.0))
+        self.assertEqual(limiter._endpoint_limits,
+                         {'issues': (5.0, 2.0), 'sections': (3.0, 3.0)})
+
+
+class CircuitBreakerTests(unittest.TestCase):
+
+    def _makeOne(self, **kwargs):
+        from delorean.resilience import CircuitBreaker
+        self.now = [0.0]
+        kwargs.setdefault('clock', lambda: self.now[0])
+        return CircuitBreaker(**kwargs)
+
+    def test_opens_on_failure_rate(self):
+        from delorean.resilience import CircuitOpenError
+        breaker = self._makeOne(failure_rate=0.5, window=4, min_calls=4,
+                                reset_timeout=30)
+        for outcome in [breaker.on_success, breaker.on_failure,
+                        breaker.on_success]:
+            outcome()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+        breaker.on_failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+        self.assertEqual(breaker.retry_after(), 30)
+
+    def test_trial_call_closes_the_circuit(self):
+        from delorean.resilience import CircuitOpenError
+        breaker = self._makeOne(window=1, min_calls=1, reset_timeout=30)
+        breaker.on_failure()
+
+        self.now[0] += 30
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        breaker.before_call()
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+
+        breaker.on_success()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.before_call()
+
+    def test_failed_trial_reopens_the_circuit(self):
+        breaker = self._makeOne(window=1, min_calls=1, reset_timeout=30)
+        breaker.on_failure()
+        self.now[0] += 30
+        breaker.before_call()
+        breaker.on_failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+    def test_session_feeds_the_breaker(self):
+        from delorean.resilience import CircuitOpenError
+        from delorean.upstream import UpstreamSession
+        breaker = self._makeOne(window=2, min_calls=2)
+        session = UpstreamSession(breaker=breaker)
+        session.mount('http://', DummyAdapter([(500, b'', {}), (502, b'', {})]))
+
+        session.get('http://manager/api/v1/journals/')
+        session.get('http://manager/api/v1/journals/')
+        self.assertRaises(CircuitOpenError, session.get,
+                          'http://manager/api/v1/journals/')
+
+    def test_backoff_delay(self):
+        from delorean.resilience import backoff_delay
+
+        class DummyRandom(object):
+            @staticmethod
+            def uniform(a, b):
+                return b
+
+        self.assertEqual([backoff_delay(i, base=1, cap=10, random_lib=DummyRandom)
+                          for i in range(6)], [1, 2, 4, 8, 10, 10])
+
+
+class CircuitBreakerViewTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_open_circuit_fails_fast(self):
+        from pyramid import httpexceptions
+        from delorean.resilience import CircuitBreaker
+        from .views import bundle_generator
+
+        self.config.registry.settings.update({
+            'delorean.manager_access_uri': 'http://manager/api/v1/',
+            'delorean.manager_access_username': 'user',
+            'delorean.manager_access_api_key': 'key',
+        })
+        breaker = self.config.registry.circuit_breaker = CircuitBreaker(
+            window=1, min_calls=1, reset_timeout=30)
+        breaker.on_failure()
+
+        request = testing.DummyRequest()
+        request.matchdict['resource'] = 'title'
+        try:
+            bundle_generator(request)
+        except httpexceptions.HTTPServiceUnavailable as exc:
+            self.assertTrue(int(exc.headers['Retry-After']) > 0)
+        else:
+            self.fail('HTTPServiceUnavailable not raised')
+
+
+class CancellationTokenTests(unittest.TestCase):
+
+    def _makeOne(self, timeout=None):
+        from delorean.resilience import CancellationToken
+        self.now = [0.0]
+        return CancellationToken(timeout=timeout, clock=lambda: self.now[0])
+
+    def test_cancel(self):
+        from delorean.resilience import GenerationCancelled
+        token = self._makeOne()
+        token.check()
+        token.cancel()
+        self.assertRaises(GenerationCancelled, token.check)
+
+    def test_deadline(self):
+        from delorean.resilience import DeadlineExceeded
+        token = self._makeOne(timeout=10)
+        self.now[0] += 4
+        self.assertEqual(token.remaining(), 6)
+        token.check()
+        self.now[0] += 6
+        self.assertRaises(DeadlineExceeded, token.check)
+
+    def test_sleep_is_interrupted_by_cancellation(self):
+        import threading
+        import time
+        from delorean.resilience import CancellationToken, GenerationCancelled
+        token = CancellationToken()
+        threading.Timer(0.01, token.cancel).start()
+        start = time.time()
+        self.assertRaises(GenerationCancelled, token.sleep, 10)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_collector_stops_between_pages(self):
+        from delorean.domain import TitleCollector
+        from delorean.resilience import GenerationCancelled
+        from delorean.upstream import UpstreamSession
+
+        token = self._makeOne()
+        page = (b'{"meta": {"next": "/api/v1/journals/?offset=50"}, '
+                b'"objects": [{"acronym": "abcd"}]}')
+        session = UpstreamSession()
+        session.mount('http://', DummyAdapter([(200, page, {})] * 2))
+
+        class AcronymCollector(TitleCollector):
+            def get_data(self, obj):
+                return obj['acronym']
+
+        records = iter(AcronymCollector('http://manager/api/v1/',
+                                        session=session, cancellation=token))
+        self.assertEqual(next(records), 'abcd')
+        token.cancel()
+        self.assertRaises(GenerationCancelled, next, records)
+
+    def test_transform_list_is_cancelled(self):
+        from delorean.domain import Transformer
+        from delorean.resilience import GenerationCancelled
+        token = self._makeOne()
+
+        def records():
+            yield {'title': 'ABCD'}
+            token.cancel()
+            yield {'title': 'RSP'}
+
+        self.assertRaises(GenerationCancelled,
+                          Transformer('!v100!${title}').transform_list,
+                          records(), cancellation=token)
+
+    def test_cancelled_deploy_leaves_nothing_behind(self):
+        from delorean.domain import Bundle
+        from delorean.resilience import GenerationCancelled
+        token = self._makeOne()
+        token.cancel()
+        target = '/tmp/files/cancelled.tar'
+        self.assertRaises(GenerationCancelled,
+                          Bundle(('title.id', '!ID 0'), cancellation=token).deploy,
+                          target)
+        self.assertFalse(os.path.exists(target))
+        self.assertFalse(os.path.exists(target + '.part'))
+
+    def test_shared_generation_ignores_the_request_timeout(self):
+        from delorean import views
+        from delorean.concurrency import SingleFlight
+        config = testing.setUp()
+        tokens = []
+
+        class FakeDeLorean(object):
+            def generate_title(self, target, collection=None):
+                return 'title-20130510.tar'
+
+        def delorean(registry, session, cancellation, **kwargs):
+            tokens.append(cancellation)
+            return FakeDeLorean()
+
+        original = views._delorean
+        views._delorean = delorean
+        try:
+            config.add_static_view('public', 'delorean:public')
+            config.registry.settings.update({
+                'delorean.manager_access_uri': 'http://manager/api/v1/',
+                'delorean.manager_access_username': 'user',
+                'delorean.manager_access_api_key': 'key',
+                'delorean.generation.max_time': '600',
+            })
+            config.registry.single_flight = SingleFlight()
+            request = testing.DummyRequest(params={'timeout': '5'})
+            request.matchdict['resource'] = 'title'
+            request.client_addr = '127.0.0.1'
+            result = views.bundle_generator(request)
+            self.assertFalse(result['coalesced'])
+            self.assertTrue(5 < tokens[0].remaining() <= 600)
+
+            # not shared, the generation is bound to the request timeout
+            del config.registry.single_flight
+            views.bundle_generator(request)
+            self.assertTrue(tokens[1].remaining() <= 5)
+        finally:
+            views._delorean = original
+            testing.tearDown()
+
+    def test_abandoned_shared_generation_is_cancelled(self):
+        import threading
+        from pyramid import httpexceptions
+        from delorean import views
+        from delorean.concurrency import SingleFlight
+        config = testing.setUp()
+        tokens = []
+        stopped = threading.Event()
+
+        class FakeDeLorean(object):
+            def generate_title(self, target, collection=None):
+                try:
+                    while True:
+                        tokens[0].sleep(0.01)
+                finally:
+                    stopped.set()
+
+        def delorean(registry, session, cancellation, **kwargs):
+            tokens.append(cancellation)
+            return FakeDeLorean()
+
+        original = views._delorean
+        views._delorean = delorean
+        try:
+            config.registry.settings.update({
+                'delorean.manager_access_uri': 'http://manager/api/v1/',
+                'delorean.manager_access_username': 'user',
+                'delorean.manager_access_api_key': 'key',
+                'delorean.generation.max_time': '600',
+            })
+            config.registry.single_flight = SingleFlight()
+            request = testing.DummyRequest(params={'timeout': '0.05'})
+            request.matchdict['resource'] = 'title'
+            request.client_addr = '127.0.0.1'
+            self.assertRaises(httpexceptions.HTTPGatewayTimeout,
+                              views.bundle_generator, request)
+            self.assertTrue(tokens[0].cancelled)
+            self.assertTrue(stopped.wait(5))
+        finally:
+            views._delorean = original
+            testing.tearDown()
+
+    def test_generations_are_sampled_where_they_run(self):
+        import threading
+        from contextlib import contextmanager
+        from delorean import views
+        from delorean.concurrency import SingleFlight
+        config = testing.setUp()
+        tracked = []
+        generated = []
+
+        class Sampler(object):
+            def __init__(self):
+                self.tracking = {}
+
+            @contextmanager
+            def track(self, resource_name):
+                self.tracking[threading.current_thread().ident] = resource_name
+                yield
+
+        class FakeDeLorean(object):
+            def generate_title(self, target, collection=None):
+                tracked.append(sampler.tracking.get(
+                    threading.current_thread().ident))
+                generated.append(threading.current_thread().ident)
+                return 'title-20130510.tar'
+
+        class Prebuilt(object):
+            def fresh(self, resource_name, collection, max_age):
+                return None
+
+            def record(self, resource_name, collection, bundle_name):
+                pass
+
+        original = views._delorean
+        views._delorean = lambda *args, **kwargs: FakeDeLorean()
+        try:
+            config.add_static_view('public', 'delorean:public')
+            config.registry.settings.update({
+                'delorean.manager_access_uri': 'http://manager/api/v1/',
+                'delorean.manager_access_username': 'user',
+                'delorean.manager_access_api_key': 'key',
+            })
+            config.registry.single_flight = SingleFlight()
+            config.registry.prebuilt_bundles = Prebuilt()
+            config.registry.sampler = sampler = Sampler()
+
+            # run in the thread of the flight
+            request = testing.DummyRequest(params={'timeout': '5'})
+            request.matchdict['resource'] = 'title'
+            request.client_addr = '127.0.0.1'
+            views.bundle_generator(request)
+            views.pregenerate(config.registry, 'title')
+
+            self.assertEqual(tracked, ['title', 'title'])
+            self.assertNotEqual(generated[0], threading.current_thread().ident)
+        finally:
+            views._delorean = original
+            testing.tearDown()
+
+    def test_request_timeout_is_limited_by_settings(self):
+        from pyramid import httpexceptions
+        from .views import _cancellation
+        config = testing.setUp()
+        try:
+            config.registry.settings['delorean.generation.max_time'] = '600'
+            token = _cancellation(testing.DummyRequest(params={'timeout': '30'}))
+            self.assertTrue(token.remaining() <= 30)
+            token = _cancellation(testing.DummyRequest(params={'timeout': '900'}))
+            self.assertTrue(token.remaining() <= 600)
+            self.assertRaises(httpexceptions.HTTPBadRequest, _cancellation,
+                              testing.DummyRequest(params={'timeout': 'soon'}))
+        finally:
+            testing.tearDown()
+
+
+class HedgingPolicyTests(unittest.TestCase):
+
+    def _makeOne(self, latencies=(), **kwargs):
+        from delorean.concurrency import HedgingPolicy
+        kwargs.setdefault('min_samples', 10)
+        policy = HedgingPolicy(**kwargs)
+        for latency in latencies:
+            policy.observe('issues', latency)
+        return policy
+
+    def test_no_delay_before_min_samples(self):
+        policy = self._makeOne([0.1] * 9)
+        self.assertEqual(policy.delay('issues'), None)
+        policy.observe('issues', 0.1)
+        self.assertEqual(policy.delay('issues'), 0.1)
+
+    def test_delay_is_the_percentile_latency(self):
+        policy = self._makeOne([i / 100.0 for i in range(1, 101)],
+                               percentile=95)
+        self.assertAlmostEqual(policy.delay('issues'), 0.95)
+        self.assertEqual(policy.delay('journals'), None)
+
+    def test_slow_request_is_hedged(self):
+        import time
+        import threading
+        policy = self._makeOne([0.01] * 10, max_extra=1)
+        release = threading.Event()
+        calls = []
+
+        class Response(object):
+            def __init__(self, name):
+                self.name = name
+                self.closed = False
+
+            def close(self):
+                self.closed = True
+
+        slow = Response('slow')
+
+        def func():
+            calls.append(None)
+            if len(calls) == 1:
+                release.wait(5)
+                return slow
+            return Response('fast')
+
+        self.assertEqual(policy.call('issues', func).name, 'fast')
+        self.assertEqual(len(calls), 2)
+
+        release.set()
+        for i in range(100):
+            if slow.closed:
+                break
+            time.sleep(0.01)
+        self.assertTrue(slow.closed)
+
+    def test_hedges_are_limited(self):
+        import time
+        policy = self._makeOne([0.0] * 10, max_extra=0)
+        calls = []
+
+        def func():
+            calls.append(None)
+            time.sleep(0.02)
+            return 'response'
+
+        self.assertEqual(policy.call('issues', func), 'response')
+        self.assertEqual(len(calls), 1)
+
+    def test_failure_waits_for_the_hedge(self):
+        import time
+        import threading
+        policy = self._makeOne([0.01] * 10, max_extra=1)
+        hedged = threading.Event()
+        calls = []
+
+        def func():
+            calls.append(None)
+            if len(calls) == 1:
+                hedged.wait(5)
+                raise ValueError('boom')
+            hedged.set()
+            time.sleep(0.05)
+            return 'response'
+
+        self.assertEqual(policy.call('issues', func), 'response')
+
+    def test_session_hedges_gets_only(self):
+        from delorean.upstream import UpstreamSession
+        calls = []
+
+        class Policy(object):
+            def call(self, endpoint, func):
+                calls.append(endpoint)
+                return func()
+
+        session = UpstreamSession(hedging=Policy())
+        session.mount('http://', DummyAdapter())
+        session.get('http://manager/api/v1/issues/')
+        session.post('http://manager/api/v1/issues/', data='{}')
+        self.assertEqual(calls, ['issues'])
+
+class CheckpointTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'issue-all.checkpoint.jsonl')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _makeOne(self):
+        from delorean.checkpoint import Checkpoint
+        return Checkpoint(self.path)
+
+    def test_load_without_checkpoint(self):
+        self.assertEqual(self._makeOne().load(), (0, [], False))
+
+    def test_pages_are_accumulated(self):
+        checkpoint = self._makeOne()
+        checkpoint.save(50, [{'id': 1}])
+        checkpoint.save(100, [{'id': 2}])
+        self.assertEqual(self._makeOne().load(),
+                         (100, [{'id': 1}, {'id': 2}], False))
+
+        checkpoint.save(None, [{'id': 3}])
+        self.assertEqual(self._makeOne().load()[2], True)
+
+    def test_incomplete_line_is_dropped(self):
+        checkpoint = self._makeOne()
+        checkpoint.save(50, [{'id': 1}])
+        with open(self.path, 'ab') as f:
+            f.write(b'{"next": 100, "rec')
+
+        self.assertEqual(checkpoint.load(), (50, [{'id': 1}], False))
+        checkpoint.save(100, [{'id': 2}])
+        self.assertEqual(checkpoint.load(),
+                         (100, [{'id': 1}, {'id': 2}], False))
+
+    def test_clear(self):
+        checkpoint = self._makeOne()
+        checkpoint.save(50, [{'id': 1}])
+        checkpoint.clear()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_old_crawls_are_discarded(self):
+        from delorean.checkpoint import Checkpoint
+        now = [1000.0]
+        checkpoint = Checkpoint(self.path, max_age=3600, clock=lambda: now[0])
+        checkpoint.save(50, [{'id': 1}])
+
+        resumed = Checkpoint(self.path, max_age=3600, clock=lambda: now[0] + 60)
+        self.assertEqual(resumed.load(), (50, [{'id': 1}], False))
+        self.assertEqual(resumed.run, checkpoint.run)
+
+        expired = Checkpoint(self.path, max_age=3600, clock=lambda: now[0] + 3601)
+        self.assertEqual(expired.load(), (0, [], False))
+        self.assertFalse(os.path.exists(self.path))
+
+        # a new crawl starts a new file
+        expired.save(50, [{'id': 2}])
+        self.assertNotEqual(expired.run, checkpoint.run)
+        self.assertEqual(self._makeOne().load(), (50, [{'id': 2}], False))
+
+    def test_headerless_file_is_discarded(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'{"next": 50, "records": [{"id": 1}]}\n')
+        self.assertEqual(self._makeOne().load(), (0, [], False))
+
+    def test_held_by_a_single_generation(self):
+        first, second = self._makeOne(), self._makeOne()
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        first.release()
+        self.assertTrue(second.acquire())
+        second.release()
+
+    def test_concurrent_generations_dont_share_it(self):
+        from delorean.domain import DeLorean
+        dl = DeLorean('http://manager/api/v1/', checkpoint_dir=self.tmpdir)
+        first = dl._checkpoint('issue', None)
+        self.assertEqual(first.path, self.path)
+        self.assertEqual(dl._checkpoint('issue', None), None)
+        first.release()
+        dl._checkpoint('issue', None).release()
+
+    def _collector(self, responses):
+        from delorean.domain import TitleCollector
+        from delorean.upstream import UpstreamSession
+
+        class AcronymCollector(TitleCollector):
+            def get_data(self, obj):
+                return obj['acronym']
+
+        adapter = DummyAdapter(responses)
+        session = UpstreamSession()
+        session.mount('http://', adapter)
+        return adapter, AcronymCollector('http://manager/api/v1/',
+                                         session=session,
+                                         checkpoint=self._makeOne())
+
+    def test_interrupted_crawl_is_resumed(self):
+        first = (b'{"meta": {"next": "/api/v1/journals/?offset=50"}, '
+                 b'"objects": [{"acronym": "abcd"}, {"acronym": "rsp"}]}')
+        second = (b'{"meta": {"next": null}, '
+                  b'"objects": [{"acronym": "bjmbr"}]}')
+
+        adapter, collector = self._collector([(200, first, {}),
+                                              (200, second, {})])
+        records = iter(collector)
+        self.assertEqual([next(records) for i in range(3)],
+                         ['abcd', 'rsp', 'bjmbr'])
+        del records  # interrupted before the second page was completed
+
+        adapter, collector = self._collector([(200, second, {})])
+        self.assertEqual(list(collector), ['abcd', 'rsp', 'bjmbr'])
+        self.assertEqual(len(adapter.requests), 1)
+        self.assertIn('offset=50', adapter.requests[0].url)
+
+        # the finished crawl is replayed without requests
+        adapter, collector = self._collector([])
+        self.assertEqual(list(collector), ['abcd', 'rsp', 'bjmbr'])
+        self.assertEqual(adapter.requests, [])
+
+class SchedulerTests(unittest.TestCase):
+
+    def test_cron_next_after(self):
+        from datetime import datetime
+        from delorean.scheduler import CronSchedule
+        schedule = CronSchedule('30 2 * * *')
+        self.assertEqual(schedule.next_after(datetime(2013, 5, 10, 2, 30)),
+                         datetime(2013, 5, 11, 2, 30))
+        self.assertEqual(schedule.next_after(datetime(2013, 12, 31, 23, 0)),
+                         datetime(2014, 1, 1, 2, 30))
+
+        schedule = CronSchedule('*/15 8-9 * * 1-5')
+        # 2013-05-11 is a saturday
+        self.assertEqual(schedule.next_after(datetime(2013, 5, 10, 9, 50)),
+                         datetime(2013, 5, 13, 8, 0))
+        self.assertTrue(schedule.matches(datetime(2013, 5, 13, 9, 45)))
+        self.assertFalse(schedule.matches(datetime(2013, 5, 13, 9, 40)))
+
+    def test_invalid_cron_expressions(self):
+        from delorean.scheduler import CronSchedule
+        self.assertRaises(ValueError, CronSchedule, '0 2 * *')
+        self.assertRaises(ValueError, CronSchedule, '60 2 * * *')
+        self.assertRaises(ValueError, CronSchedule, '0 0 32 * *')
+
+    def test_parse_jobs(self):
+        from delorean.scheduler import parse_jobs
+        jobs = parse_jobs('\n  title all 0 2 * * *\n  issue brasil 0 */6 * * *\n')
+        self.assertEqual([(j.resource_name, j.collection) for j in jobs],
+                         [('title', None), ('issue', 'brasil')])
+        self.assertEqual(jobs[1].schedule.expr, '0 */6 * * *')
+        self.assertEqual(parse_jobs(''), [])
+
+    def test_due_jobs_are_run(self):
+        from datetime import datetime
+        from delorean.scheduler import BundleScheduler, parse_jobs
+        now = [datetime(2013, 5, 10, 2, 0)]
+        runs = []
+
+        def run(resource_name, collection):
+            runs.append((resource_name, collection))
+            if resource_name == 'issue':
+                raise ValueError('upstream is down')
+
+        jobs = parse_jobs('title all 0 2 * * *\nissue brasil 0 2 * * *')
+        scheduler = BundleScheduler(jobs, run, clock=lambda: now[0])
+        due = scheduler.run_pending([datetime(2013, 5, 10, 2, 0),
+                                     datetime(2013, 5, 10, 2, 1)])
+        self.assertEqual(runs, [('title', None)])
+        self.assertEqual(due, [datetime(2013, 5, 11, 2, 0),
+                               datetime(2013, 5, 10, 2, 1)])
+
+        now[0] = datetime(2013, 5, 10, 2, 1)
+        due = scheduler.run_pending(due)
+        self.assertEqual(runs[-1], ('issue', 'brasil'))
+        self.assertEqual(due[1], datetime(2013, 5, 11, 2, 0))
+
+
+    def test_due_runs_are_made_by_a_single_process(self):
+        import shutil
+        import tempfile
+        from datetime import datetime
+        from delorean.scheduler import BundleScheduler, parse_jobs
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+        now = lambda: datetime(2013, 5, 10, 2, 0)
+        jobs = parse_jobs('title all 0 2 * * *')
+        runs = []
+
+        def run(resource_name, collection):
+            runs.append(resource_name)
+            # another process polling while this one runs the job
+            other.run_pending([datetime(2013, 5, 10, 2, 0)])
+
+        scheduler = BundleScheduler(jobs, run, clock=now, lock_dir=lock_dir)
+        other = BundleScheduler(jobs, run, clock=now, lock_dir=lock_dir)
+        scheduler.run_pending([datetime(2013, 5, 10, 2, 0)])
+        self.assertEqual(runs, ['title'])
+
+        # and after it ran
+        late = BundleScheduler(jobs, run, clock=now, lock_dir=lock_dir)
+        late.run_pending([datetime(2013, 5, 10, 2, 0)])
+        self.assertEqual(runs, ['title'])
+
+        # the next day's run is made again
+        tomorrow = BundleScheduler(jobs, lambda *args: runs.append('next'),
+                                   clock=lambda: datetime(2013, 5, 11, 2, 0),
+                                   lock_dir=lock_dir)
+        tomorrow.run_pending([datetime(2013, 5, 11, 2, 0)])
+        self.assertEqual(runs, ['title', 'next'])
+
+
+class PrebuiltBundlesTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.now = [1000.0]
+        with open(os.path.join(self.tmpdir, 'issue-20130510.tar'), 'w'):
+            pass
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _makeOne(self):
+        from delorean.scheduler import PrebuiltBundles
+        return PrebuiltBundles(os.path.join(self.tmpdir, 'prebuilt.json'),
+                               self.tmpdir, clock=lambda: self.now[0])
+
+    def test_fresh_bundle(self):
+        self._makeOne().record('issue', 'brasil', 'issue-20130510.tar')
+        prebuilt = self._makeOne()
+        self.assertEqual(prebuilt.fresh('issue', 'brasil', 60),
+                         'issue-20130510.tar')
+        self.assertEqual(prebuilt.fresh('issue', None, 60), None)
+
+        self.now[0] += 61
+        self.assertEqual(prebuilt.fresh('issue', 'brasil', 60), None)
+
+    def test_bundles_recorded_by_other_processes_are_seen(self):
+        prebuilt, other = self._makeOne(), self._makeOne()
+        self.assertEqual(prebuilt.fresh('issue', 'brasil', 60), None)
+
+        other.record('issue', 'brasil', 'issue-20130510.tar')
+        self.assertEqual(prebuilt.fresh('issue', 'brasil', 60),
+                         'issue-20130510.tar')
+
+        # and are kept when recording
+        prebuilt.record('issue', None, 'issue-20130510.tar')
+        self.assertEqual(self._makeOne().fresh('issue', 'brasil', 60),
+                         'issue-20130510.tar')
+
+    def test_removed_bundle_is_not_served(self):
+        prebuilt = self._makeOne()
+        prebuilt.record('issue', None, 'issue-20130510.tar')
+        os.remove(os.path.join(self.tmpdir, 'issue-20130510.tar'))
+        self.assertEqual(prebuilt.fresh('issue', None, 60), None)
+
+    def test_view_serves_prebuilt_bundle(self):
+        from .views import bundle_generator
+        config = testing.setUp()
+        try:
+            config.add_static_view('public', 'delorean:public')
+            config.registry.settings.update({
+                'delorean.manager_access_uri': 'http://manager/api/v1/',
+                'delorean.manager_access_username': 'user',
+                'delorean.manager_access_api_key': 'key',
+                'delorean.schedule.max_age': '60',
+            })
+            config.registry.prebuilt_bundles = self._makeOne()
+            config.registry.prebuilt_bundles.record(
+                'issue', 'brasil', 'issue-20130510.tar')
+
+            request = testing.DummyRequest(params={'collection': 'brasil'})
+            request.matchdict['resource'] = 'issue'
+            result = bundle_generator(request)
+            self.assertTrue(result['prebuilt'])
+            self.assertTrue(result['expected_bundle_url'].endswith(
+                '/public/issue-20130510.tar'))
+        finally:
+            testing.tearDown()
+
+class ChangeNotificationTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        from delorean.records import RecordStore
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = RecordStore(os.path.join(self.tmpdir, 'records'))
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def test_record_store(self):
+        self.assertEqual(self.store.load('issue'), None)
+        self.assertEqual(self.store.collections('issue'), [])
+
+        self.store.save('issue', None, [['issues-1', ['journals-1'], '!ID 0']])
+        self.store.save('issue', 'brasil', [])
+        self.store.save('title', 'chile', [])
+        self.assertEqual(self.store.load('issue'),
+                         [['issues-1', ['journals-1'], '!ID 0']])
+        self.assertEqual(self.store.collections('issue'), [None, 'brasil'])
+
+    def _delorean(self, responses):
+        from delorean.domain import DeLorean, TitleCollector, Transformer
+        from delorean.upstream import UpstreamSession
+
+        class SponsorCollector(TitleCollector):
+            def get_data(self, obj):
+                return {'acronym': obj['acronym'],
+                        'sponsor': self._lookup_field('sponsors',
+                                                      obj['sponsor'], 'name')}
+
+        adapter = DummyAdapter(responses)
+        session = UpstreamSession()
+        session.mount('http://', adapter)
+        dl = DeLorean('http://manager/api/v1/', session=session,
+                      titlecollector=SponsorCollector,
+                      transformer=lambda filename: Transformer(
+                          '${acronym} ${sponsor}'),
+                      record_store=self.store)
+        return adapter, dl
+
+    def _bundle(self, name):
+        bundle = tarfile.open(os.path.join(self.tmpdir, name))
+        try:
+            return bundle.extractfile('title.id').read()
+        finally:
+            bundle.close()
+
+    def test_refresh_rerenders_affected_records(self):
+        page = (b'{"meta": {"next": null}, "objects": ['
+                b'{"id": 1, "acronym": "abcd", "sponsor": "1"}, '
+                b'{"id": 2, "acronym": "rsp", "sponsor": "2"}]}')
+        adapter, dl = self._delorean([(200, page, {}),
+                                      (200, b'{"name": "FAPESP"}', {}),
+                                      (200, b'{"name": "CNPq"}', {})])
+        name = dl.generate_title(self.tmpdir)
+        self.assertEqual(self._bundle(name), b'abcd FAPESP\nrsp CNPq')
+        self.assertEqual(self.store.load('title')[1],
+                         ['journals-2', ['sponsors-2'], 'rsp CNPq'])
+
+        adapter, dl = self._delorean([
+            (200, b'{"id": 2, "acronym": "rsp", "sponsor": "2"}', {}),
+            (200, b'{"name": "CAPES"}', {})])
+        name = dl.refresh('title', [('sponsors', '2', 'update')], self.tmpdir)
+        self.assertEqual(self._bundle(name), b'abcd FAPESP\nrsp CAPES')
+        self.assertEqual([r.url for r in adapter.requests],
+                         ['http://manager/api/v1/journals/2/',
+                          'http://manager/api/v1/sponsors/2/'])
+
+        adapter, dl = self._delorean([])
+        name = dl.refresh('title', [('journals', '1', 'delete')], self.tmpdir)
+        self.assertEqual(self._bundle(name), b'rsp CAPES')
+        self.assertEqual(adapter.requests, [])
+
+    def test_unaffected_bundles_are_kept(self):
+        page = (b'{"meta": {"next": null}, "objects": ['
+                b'{"id": 1, "acronym": "abcd", "sponsor": "1"}]}')
+        adapter, dl = self._delorean([(200, page, {}),
+                                      (200, b'{"name": "FAPESP"}', {})])
+        name = dl.generate_title(self.tmpdir)
+
+        adapter, dl = self._delorean([])
+        changes = [('issues', '7', 'update'), ('sponsors', '2', 'delete')]
+        self.assertEqual(dl.refresh('title', changes, self.tmpdir,
+                                    current=name), name)
+        self.assertEqual(len([n for n in os.listdir(self.tmpdir)
+                              if n.endswith('.tar')]), 1)
+
+        # without a bundle to keep, it is rebuilt
+        self.assertNotEqual(dl.refresh('title', changes, self.tmpdir), name)
+
+    def test_refresh_requires_a_full_generation(self):
+        adapter, dl = self._delorean([])
+        self.assertEqual(dl.refresh('title', [('journals', '1', 'update')]),
+                         None)
+
+        self.store.save('title', None, [])
+        self.assertEqual(dl.refresh('title', [('journals', '3', 'create')]),
+                         None)
+
+    def test_rebuild_refetches_the_cached_listings(self):
+        from delorean.httpcache import HTTPCache
+        from delorean.upstream import UpstreamSession
+        cache = HTTPCache(os.path.join(self.tmpdir, 'http_cache'))
+        first = (b'{"meta": {"next": null}, "objects": ['
+                 b'{"id": 1, "acronym": "abcd", "sponsor": "1"}]}')
+        second = (b'{"meta": {"next": null}, "objects": ['
+                  b'{"id": 1, "acronym": "abcd", "sponsor": "1"}, '
+                  b'{"id": 2, "acronym": "rsp", "sponsor": "1"}]}')
+
+        def rebuild(responses, **kwargs):
+            adapter, dl = self._delorean(responses)
+            dl._session = UpstreamSession(cache=cache, **kwargs)
+            dl._session.mount('http://', adapter)
+            return adapter, self._bundle(dl.generate_title(self.tmpdir))
+
+        adapter, bundle = rebuild([(200, first, {}),
+                                   (200, b'{"name": "FAPESP"}', {})])
+        self.assertEqual(bundle, b'abcd FAPESP')
+
+        # journals-2 was created: the fresh listing would hide it
+        adapter, bundle = rebuild([])
+        self.assertEqual(adapter.requests, [])
+        self.assertEqual(bundle, b'abcd FAPESP')
+
+        adapter, bundle = rebuild([(200, second, {})], refetch_listings=True)
+        self.assertEqual([r.url.split('?')[0] for r in adapter.requests],
+                         ['http://manager/api/v1/journals/'])
+        self.assertEqual(bundle, b'abcd FAPESP\nrsp FAPESP')
+
+    def test_refresh_bundles_refetches_listings(self):
+        from delorean import views
+        config = testing.setUp()
+        sessions = []
+        refreshed = []
+
+        class FakeDeLorean(object):
+            def refresh(self, resource_name, changes, target, collection,
+                        current=None):
+                refreshed.append((resource_name, collection))
+                return '%s.tar' % resource_name
+
+        originals = views._upstream_session, views._delorean
+        views._upstream_session = lambda registry, **kwargs: sessions.append(
+            kwargs)
+        views._delorean = lambda *args: FakeDeLorean()
+        try:
+            config.registry.settings.update({
+                'delorean.manager_access_uri': 'http://manager/api/v1/',
+                'delorean.manager_access_username': 'user',
+                'delorean.manager_access_api_key': 'key',
+            })
+            self.store.save('title', None, [])
+            config.registry.record_store = self.store
+            views.refresh_bundles(config.registry, [('journals', '2', 'create')])
+            self.assertEqual(sessions, [{'refetch_listings': True}])
+            self.assertEqual(refreshed, [('title', None)])
+        finally:
+            views._upstream_session, views._delorean = originals
+            testing.tearDown()
+
+    def test_refresh_bundles_keeps_unaffected_bundles(self):
+        from delorean import views
+        config = testing.setUp()
+        recorded = []
+
+        class FakeDeLorean(object):
+            def refresh(self, resource_name, changes, target, collection,
+                        current=None):
+                return current if resource_name == 'title' else 'issue-2.tar'
+
+        class Prebuilt(object):
+            def current(self, resource_name, collection):
+                return '%s-1.tar' % resource_name
+
+            def record(self, resource_name, collection, bundle_name):
+                recorded.append(bundle_name)
+
+        originals = views._upstream_session, views._delorean
+        views._upstream_session = lambda registry, **kwargs: None
+        views._delorean = lambda *args: FakeDeLorean()
+        try:
+            self.store.save('title', None, [])
+            self.store.save('issue', None, [])
+            config.registry.record_store = self.store
+            config.registry.prebuilt_bundles = Prebuilt()
+            views.refresh_bundles(config.registry, [('issues', '2', 'update')])
+            self.assertEqual(recorded, ['issue-2.tar'])
+        finally:
+            views._upstream_session, views._delorean = originals
+            testing.tearDown()
+
+    def _request(self, body, client_addr='127.0.0.1'):
+        request = testing.DummyRequest(post=True)
+        request.body = json.dumps(body)
+        request.client_addr = client_addr
+        return request
+
+    def test_notice_invalidates_caches(self):
+        from pyramid import httpexceptions
+        from .views import change_notification
+        config = testing.setUp()
+        try:
+            config.registry.settings.update({
+                'delorean.manager_access_uri': 'http://manager/api/v1/',
+                'delorean.notification_clients': '127.0.0.1',
+            })
+            invalidated = []
+
+            class LookupCache(object):
+                def invalidate(self, key):
+                    invalidated.append(key)
+
+            config.registry.lookup_cache = LookupCache()
+            request = self._request([
+                {'resource_type': 'journal', 'id': 12, 'action': 'update'},
+                {'resource_type': 'section', 'id': 3, 'action': 'delete'}])
+            result = change_notification(request)
+            self.assertEqual(request.response.status_int, 202)
+            self.assertEqual(result, {'accepted': 2, 'refreshing': False})
+            self.assertEqual(invalidated, ['journals-12', 'sections-3'])
+            self.assertFalse(os.path.exists(
+                os.path.join(self.tmpdir, 'listings.expired')))
+
+            # the listings embedding the changed resources are expired too
+            config.registry.settings['delorean.http_cache.dir'] = self.tmpdir
+            change_notification(self._request(
+                {'resource_type': 'journal', 'id': 12, 'action': 'update'}))
+            self.assertTrue(os.path.exists(
+                os.path.join(self.tmpdir, 'listings.expired')))
+
+            self.assertRaises(httpexceptions.HTTPBadRequest,
+                              change_notification, self._request(
+                                  {'resource_type': 'journal', 'id': 12,
+                                   'action': 'rename'}))
+            self.assertRaises(httpexceptions.HTTPForbidden,
+                              change_notification, self._request(
+                                  {}, client_addr='200.136.72.1'))
+        finally:
+            testing.tearDown()
+
+class RenderCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.now = [1000.0]
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _makeOne(self, **kwargs):
+        from delorean.rendercache import RenderCache
+        kwargs.setdefault('clock', lambda: self.now[0])
+        return RenderCache(os.path.join(self.tmpdir, 'renders.sqlite'),
+                           **kwargs)
+
+    def test_fingerprint(self):
+        from delorean.rendercache import fingerprint
+        self.assertEqual(fingerprint('v1', {'a': 1, 'b': [2]}),
+                         fingerprint('v1', {'b': [2], 'a': 1}))
+        self.assertNotEqual(fingerprint('v1', {'a': 1}),
+                            fingerprint('v2', {'a': 1}))
+        self.assertNotEqual(fingerprint('v1', {'a': 1}),
+                            fingerprint('v1', {'a': 2}))
+
+    def test_unchanged_records_are_not_rendered(self):
+        from delorean.domain import Transformer
+        cache = self._makeOne()
+        renders = []
+
+        class CountingTransformer(Transformer):
+            def __init__(self, *args, **kwargs):
+                super(CountingTransformer, self).__init__(*args, **kwargs)
+                template = self._template
+
+                class Template(object):
+                    source = template.source
+
+                    def render(self, **data):
+                        renders.append(data)
+                        return template.render(**data)
+                self._template = Template()
+
+        transformer = CountingTransformer('!v100!${title}', render_cache=cache)
+        self.assertEqual(transformer.transform_list(
+            [{'title': 'ABCD'}, {'title': 'RSP'}]), '!v100!ABCD\n!v100!RSP')
+        self.assertEqual(transformer.transform_list(
+            [{'title': 'ABCD'}, {'title': 'BJMBR'}]), '!v100!ABCD\n!v100!BJMBR')
+        self.assertEqual(len(renders), 3)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+        # a new template version renders everything again
+        transformer = CountingTransformer('!v100!${title}!', render_cache=cache)
+        transformer.transform({'title': 'ABCD'})
+        self.assertEqual(len(renders), 4)
+
+    def test_prune(self):
+        cache = self._makeOne(max_age=100)
+        cache.set('old', 'text')
+        self.now[0] += 50
+        cache.set('new', 'text')
+        self.now[0] += 60
+        cache.prune()
+        self.assertEqual(cache.get('old'), None)
+        self.assertEqual(cache.get('new'), 'text')
+
+class DeltaTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _issue(self, acronym, order, title):
+        return '!ID 0\n!v930!%s\n!v036!%s\n!v033!%s\n' % (acronym, order, title)
+
+    def test_split_records(self):
+        from delorean.delta import split_records
+        id_string = '\n'.join([self._issue('ABCD', '20101', 'A'),
+                               self._issue('ABCD', '20102', 'B')])
+        self.assertEqual(split_records(id_string),
+                         [self._issue('ABCD', '20101', 'A').rstrip(),
+                          self._issue('ABCD', '20102', 'B').rstrip()])
+        self.assertEqual(split_records(''), [])
+
+    def test_diff(self):
+        from delorean.delta import diff, KEY_FIELDS
+        previous = '\n'.join([self._issue('ABCD', '20101', 'A'),
+                              self._issue('ABCD', '20102', 'B'),
+                              self._issue('ABCD', '20103', 'C')])
+        current = '\n'.join([self._issue('ABCD', '20101', 'A'),
+                             self._issue('ABCD', '20102', 'Changed'),
+                             self._issue('ABCD', '20104', 'D')])
+
+        updated, changed, removed = diff(previous, current,
+                                         KEY_FIELDS['issue'])
+        self.assertEqual(updated,
+                         [self._issue('ABCD', '20102', 'Changed').rstrip(),
+                          self._issue('ABCD', '20104', 'D').rstrip()])
+        self.assertEqual(changed, [('ABCD', '20102')])
+        self.assertEqual(removed, [('ABCD', '20103')])
+
+    def test_sections_without_issn_are_told_apart(self):
+        from delorean.delta import diff, KEY_FIELDS
+        sections = '\n'.join(['!ID 0\n!v048!^lpt^hSumario\n!v930!ABCD\n',
+                              '!ID 0\n!v048!^lpt^hSumario\n!v930!RSP\n'])
+        self.assertEqual(diff(sections, sections, KEY_FIELDS['section']),
+                         ([], [], []))
+
+    def test_duplicate_keys_are_refused(self):
+        from delorean.delta import diff
+        records = '\n'.join([self._issue('ABCD', '20101', 'A'),
+                             self._issue('ABCD', '20101', 'B')])
+        self.assertRaises(ValueError, diff, records, '', ('v930', 'v036'))
+        self.assertRaises(ValueError, diff, '', records, ('v930', 'v036'))
+
+    def _generate(self, titles, delta_from=None, **kwargs):
+        from delorean.domain import DeLorean, Transformer
+
+        def collector(*args, **kwargs):
+            return [{'order': order, 'title': title}
+                    for order, title in titles]
+
+        dl = DeLorean('http://manager/api/v1/', issuecollector=collector,
+                      transformer=lambda filename: Transformer(
+                          '!ID 0\n!v930!ABCD\n!v036!${order}\n'
+                          '!v033!${title}'))
+        return dl.generate_issue(self.tmpdir, delta_from=delta_from, **kwargs)
+
+    def test_delta_bundle(self):
+        from delorean.delta import read_member
+        base = self._generate([('20101', 'A'), ('20102', 'B')])
+        name = self._generate([('20102', 'B'), ('20103', 'São Paulo')],
+                              delta_from=base)
+        self.assertTrue(name.startswith('issue-delta-'))
+
+        path = os.path.join(self.tmpdir, name)
+        self.assertEqual(read_member(path, 'issue.id'),
+                         '!ID 0\n!v930!ABCD\n!v036!20103\n!v033!São Paulo')
+        self.assertEqual(read_member(path, 'issue.removed'),
+                         'ABCD\t20101')
+        manifest = json.loads(read_member(path, 'issue.delta.json'))
+        self.assertEqual(manifest['base'], base)
+        self.assertEqual(manifest['changed'], [])
+
+        self.assertRaises(ValueError, self._generate, [], delta_from=name)
+
+    def test_delta_from_must_be_a_full_bundle(self):
+        from pyramid import httpexceptions
+        from delorean.views import _delta_from
+        titles = [('20101', 'A'), ('20102', 'B')]
+        full = self._generate(titles)
+        sharded = self._generate(titles, shards=2)
+        without_id = self._generate(titles, formats=('jsonl',))
+        delta = self._generate(titles, delta_from=full)
+
+        def delta_from(name):
+            request = testing.DummyRequest(params={'delta_from': name})
+            return _delta_from(request, 'issue', self.tmpdir)
+
+        self.assertEqual(delta_from(full), full)
+        for name in (sharded, without_id, delta):
+            self.assertRaises(httpexceptions.HTTPBadRequest, delta_from, name)
+
+
+class MasterFileTests(unittest.TestCase):
+
+    def _assets(self):
+        here = os.path.abspath(os.path.dirname(__file__))
+        assets = os.path.join(here, 'tests_assets')
+        return [os.path.join(assets, name) for name in sorted(os.listdir(assets))
+                if name.endswith('.id')]
+
+    def _write(self, records):
+        import StringIO
+        from delorean.isis import MasterFileWriter
+        mst, xrf = StringIO.StringIO(), StringIO.StringIO()
+        writer = MasterFileWriter(mst, xrf)
+        for fields in records:
+            writer.write(fields)
+        writer.close()
+        mst.seek(0)
+        xrf.seek(0)
+        return mst, xrf
+
+    def test_parse_id(self):
+        from delorean.isis import parse_id
+        records = parse_id('!ID 0\n!v030!ABCD\n!v049!^lpt^cABCD010\n'
+                           '!ID 0\n!v030!RSP\n')
+        self.assertEqual(records, [[(30, 'ABCD'), (49, '^lpt^cABCD010')],
+                                   [(30, 'RSP')]])
+
+    def test_fixtures_round_trip(self):
+        from delorean.isis import parse_id, read_master
+        for path in self._assets():
+            with open(path) as f:
+                records = parse_id(f.read().decode('cp1252'))
+            self.assertTrue(records)
+            self.assertEqual(list(read_master(*self._write(records))),
+                             records, path)
+
+    def test_layout(self):
+        from delorean.isis import (BLOCK_SIZE, CONTROL, LEADER,
+                                   XRF_BLOCK, read_master)
+        records = [[(30, 'x' * 100), (31, str(i))] for i in range(300)]
+        mst, xrf = self._write(records)
+        mst_data, xrf_data = mst.getvalue(), xrf.getvalue()
+
+        self.assertEqual(len(mst_data) % BLOCK_SIZE, 0)
+        ctlmfn, nxtmfn, nxtmfb, nxtmfp = CONTROL.unpack_from(mst_data)[:4]
+        self.assertEqual((ctlmfn, nxtmfn), (0, 301))
+        # the next record goes right after the last one, in the last block
+        self.assertEqual(nxtmfb, len(mst_data) // BLOCK_SIZE)
+        self.assertEqual(mst_data[(nxtmfb - 1) * BLOCK_SIZE + nxtmfp - 1:],
+                         b'\0' * (BLOCK_SIZE - nxtmfp + 1))
+
+        # 300 records fit in 3 blocks of the cross-reference file
+        self.assertEqual(len(xrf_data), 3 * XRF_BLOCK.size)
+        entries = []
+        for i in range(3):
+            block = XRF_BLOCK.unpack_from(xrf_data, i * XRF_BLOCK.size)
+            self.assertEqual(block[0], -3 if i == 2 else i + 1)
+            entries.extend(e for e in block[1:] if e)
+        self.assertEqual(len(entries), 300)
+        self.assertEqual(entries[0], 1 * 2048 + 64)
+        for entry in entries:
+            # leaders never cross a block boundary
+            self.assertTrue(entry % 512 + LEADER.size <= BLOCK_SIZE)
+
+        self.assertEqual(list(read_master(mst, xrf)), records)
+
+    def test_reference_layout(self):
+        # built field by field from the CDS/ISIS master file layout,
+        # not with the structs of the writer.
+        import struct
+
+        def leader(mfn, length, base, nvf):
+            # MFN, MFRL, MFBWB, MFBWP, BASE, NVF, STATUS
+            return (struct.pack(b'<i', mfn) + struct.pack(b'<h', length) +
+                    struct.pack(b'<i', 0) + struct.pack(b'<h', 0) +
+                    struct.pack(b'<h', base) + struct.pack(b'<h', nvf) +
+                    struct.pack(b'<h', 0))
+
+        def entry(tag, position, length):
+            return struct.pack(b'<hhh', tag, position, length)
+
+        # 18 bytes of leader, 6 per field and the values, of even length
+        first = (leader(1, 42, 30, 2) + entry(30, 0, 4) + entry(100, 4, 7) +
+                 b'ABCDRevista\0')
+        second = leader(2, 28, 24, 1) + entry(30, 0, 3) + b'RSP\0'
+        # CTLMFN, NXTMFN, NXTMFB, NXTMFP (1-based), MFTYPE, RECCNT and
+        # MFCXX1-3, in the first 64 bytes
+        control = struct.pack(b'<iiihhiiii', 0, 3, 1, 64 + 42 + 28 + 1,
+                              0, 0, 0, 0, 0)
+        expected_mst = (control + b'\0' * (64 - len(control)) + first +
+                        second + b'\0' * (512 - 64 - 42 - 28))
+        # the last (and only) block is numbered -1, the entries hold the
+        # block of each record times 2048 plus its offset in the block
+        expected_xrf = (struct.pack(b'<i', -1) +
+                        struct.pack(b'<i', 1 * 2048 + 64) +
+                        struct.pack(b'<i', 1 * 2048 + 64 + 42) +
+                        b'\0' * 4 * 125)
+
+        mst, xrf = self._write([[(30, 'ABCD'), (100, 'Revista')],
+                                [(30, 'RSP')]])
+        self.assertEqual(mst.getvalue(), expected_mst)
+        self.assertEqual(xrf.getvalue(), expected_xrf)
+
+    def _scan(self, mst_data, xrf_data):
+        """
+        Reads the records of a master file sequentially, as a list of
+        ``(mfn, fields)``, checking that the cross-reference file points
+        at each one of them.
+        """
+        import struct
+        nxtmfb, nxtmfp = struct.unpack_from(b'<ii', mst_data, 8)
+        end = (nxtmfb - 1) * 512 + nxtmfp - 1
+
+        records, offset = [], 64
+        while offset < end:
+            if offset % 512 + 18 > 512:  # leaders aren't split
+                offset += 512 - offset % 512
+            mfn, length = struct.unpack_from(b'<ih', mst_data, offset)
+            base, nvf = struct.unpack_from(b'<hh', mst_data, offset + 12)
+
+            xrf_block, index = divmod(mfn - 1, 127)
+            pointer, = struct.unpack_from(
+                b'<i', xrf_data, xrf_block * 512 + 4 + index * 4)
+            self.assertEqual(pointer, (offset // 512 + 1) * 2048 + offset % 512)
+
+            fields = []
+            for n in range(nvf):
+                tag, position, size = struct.unpack_from(
+                    b'<hhh', mst_data, offset + 18 + n * 6)
+                start = offset + base + position
+                fields.append((tag, mst_data[start:start + size].decode('cp1252')))
+            records.append((mfn, fields))
+            offset += length
+        return records
+
+    def test_fixtures_fields_and_mfns(self):
+        from delorean.isis import parse_id
+        for path in self._assets():
+            with open(path) as f:
+                records = parse_id(f.read().decode('cp1252'))
+            mst, xrf = self._write(records)
+            self.assertEqual(self._scan(mst.getvalue(), xrf.getvalue()),
+                             list(enumerate(records, 1)), path)
+
+        # spread over blocks of both files
+        records = [[(30, 'x' * (i % 500)), (31, str(i))] for i in range(300)]
+        mst, xrf = self._write(records)
+        self.assertEqual(self._scan(mst.getvalue(), xrf.getvalue()),
+                         list(enumerate(records, 1)))
+
+    def test_bundle_with_master_file(self):
+        import tempfile
+        import shutil
+        from delorean.domain import DeLorean, Transformer
+        from delorean.isis import read_master
+        target = tempfile.mkdtemp()
+        try:
+            dl = DeLorean('http://manager/api/v1/',
+                          sectioncollector=lambda *a, **kw: [
+                              {'issn': '0102-6720'}, {'issn': '1413-7852'}],
+                          transformer=lambda filename: Transformer(
+                              '!ID 0\n!v035!${issn}'))
+            name = dl.generate_section(target, formats=['id', 'mst'])
+
+            bundle = tarfile.open(os.path.join(target, name))
+            self.assertEqual(sorted(bundle.getnames()),
+                             ['section.id', 'section.mst', 'section.xrf'])
+            records = list(read_master(bundle.extractfile('section.mst'),
+                                       bundle.extractfile('section.xrf')))
+            self.assertEqual(records, [[(35, '0102-6720')], [(35, '1413-7852')]])
+        finally:
+            shutil.rmtree(target)
+
+class ISO2709Tests(unittest.TestCase):
+
+    def _export(self, records):
+        import StringIO
+        from delorean.isis import ISO2709Writer
+        out = StringIO.StringIO()
+        writer = ISO2709Writer(out)
+        for fields in records:
+            writer.write(fields)
+        return out.getvalue()
+
+    def test_record_layout(self):
+        data = self._export([[(30, 'ABCD'), (35, '0102-6720')]])
+        self.assertEqual(data,
+            b'00065n000000000490004500'
+            b'030000500000'
+            b'035001000005'
+            b'\x1eABCD\x1e0102-6720\x1e\x1d')
+
+    def test_fixtures_round_trip(self):
+        from delorean.isis import parse_id, read_iso2709
+        here = os.path.abspath(os.path.dirname(__file__))
+        assets = os.path.join(here, 'tests_assets')
+        for name in sorted(os.listdir(assets)):
+            if not name.endswith('.id'):
+                continue
+            with open(os.path.join(assets, name)) as f:
+                records = parse_id(f.read().decode('cp1252'))
+            self.assertEqual(list(read_iso2709(self._export(records))),
+                             records, name)
+
+    def test_invalid_tags(self):
+        self.assertRaises(ValueError, self._export, [[(1000, 'ABCD')]])
+
+class OutputFormatsTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.passes = []
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _generate(self, formats):
+        from delorean.domain import DeLorean, Transformer
+
+        def collector(*args, **kwargs):
+            self.passes.append(1)
+            return iter([
+                {'acronym': 'abcd', 'title': 'São Paulo',
+                 'sponsors': ['FAPESP']},
+                {'acronym': 'rsp', 'previous_title': None},
+            ])
+
+        dl = DeLorean('http://manager/api/v1/', titlecollector=collector,
+                      transformer=lambda filename: Transformer(
+                          '!ID 0\n!v068!${acronym}'))
+        name = dl.generate_title(self.tmpdir, formats=formats)
+        bundle = tarfile.open(os.path.join(self.tmpdir, name))
+        try:
+            return dict((member, bundle.extractfile(member).read())
+                        for member in bundle.getnames())
+        finally:
+            bundle.close()
+
+    def test_formats_from_a_single_crawl(self):
+        members = self._generate(['id', 'jsonl', 'csv'])
+        self.assertEqual(len(self.passes), 1)
+        self.assertEqual(sorted(members),
+                         ['title.csv', 'title.id', 'title.jsonl'])
+        self.assertEqual(members['title.id'],
+                         b'!ID 0\n!v068!abcd\n!ID 0\n!v068!rsp')
+
+        lines = members['title.jsonl'].split(b'\n')
+        self.assertEqual([json.loads(line) for line in lines], [
+            {'acronym': 'abcd', 'title': 'São Paulo', 'sponsors': ['FAPESP']},
+            {'acronym': 'rsp', 'previous_title': None},
+        ])
+
+        import csv
+        import StringIO
+        rows = list(csv.reader(StringIO.StringIO(members['title.csv'])))
+        header = rows[0]
+        first = dict(zip(header, rows[1]))
+        self.assertEqual(first[b'title'].decode('utf-8'), 'São Paulo')
+        self.assertEqual(json.loads(first[b'sponsors']), ['FAPESP'])
+        self.assertEqual(dict(zip(header, rows[2]))[b'previous_title'], b'')
+        self.assertEqual(sorted(header), [b'acronym', b'previous_title',
+                                          b'sponsors', b'title'])
+
+    def test_without_id(self):
+        members = self._generate(['jsonl'])
+        self.assertEqual(sorted(members), ['title.jsonl'])
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, self._generate, ['id', 'xml'])
+
+class SnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'brasil.jsonl.gz')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self):
+        from delorean.datasources import write_snapshot
+
+        class Source(object):
+            objects = {
+                'journals': [{'id': i, 'acronym': 'j%s' % i, 'sponsor': '1'}
+                             for i in range(1, 4)],
+                'sponsors': [{'id': 1, 'name': 'FAPESP'}],
+            }
+
+            def page(self, resource, offset, limit, collection=None):
+                objects = self.objects.get(resource, [])
+                return {'meta': {'next': '/next' if offset + limit < len(objects)
+                                 else None},
+                        'objects': objects[offset:offset + limit]}
+
+        return write_snapshot(Source(), self.path, collection='brasil',
+                              resources=('journals', 'sponsors'), limit=2)
+
+    def test_write_and_read(self):
+        from delorean.datasources import SnapshotDataSource, ResourceNotFoundError
+        self.assertEqual(self._write(), {'journals': 3, 'sponsors': 1})
+
+        source = SnapshotDataSource(self.path)
+        try:
+            self.assertEqual(source.info['collection'], 'brasil')
+            self.assertEqual(source.get('sponsors', 1), {'id': 1, 'name': 'FAPESP'})
+            self.assertRaises(ResourceNotFoundError, source.get, 'sponsors', 2)
+
+            page = source.page('journals', 0, 2, 'brasil')
+            self.assertEqual([obj['acronym'] for obj in page['objects']],
+                             ['j1', 'j2'])
+            self.assertTrue(page['meta']['next'])
+            page = source.page('journals', 2, 2, 'brasil')
+            self.assertEqual(len(page['objects']), 1)
+            self.assertFalse(page['meta']['next'])
+
+            self.assertRaises(ValueError, source.page, 'journals', 0, 2, 'chile')
+        finally:
+            source.close()
+
+    def test_collectors_read_the_snapshot(self):
+        from delorean.domain import TitleCollector
+        from delorean.datasources import SnapshotDataSource
+        self._write()
+
+        class SponsorCollector(TitleCollector):
+            def get_data(self, obj):
+                return (obj['acronym'],
+                        self._lookup_field('sponsors', obj['sponsor'], 'name'))
+
+        source = SnapshotDataSource(self.path)
+        try:
+            collector = SponsorCollector('http://manager/api/v1/',
+                                         collection='brasil',
+                                         data_source=source)
+            self.assertEqual(list(collector), [('j1', 'FAPESP'),
+                                               ('j2', 'FAPESP'),
+                                               ('j3', 'FAPESP')])
+        finally:
+            source.close()
+
+    def test_generations_from_a_snapshot_keep_off_the_live_state(self):
+        from delorean.views import _delorean
+        config = testing.setUp(settings={
+            'delorean.manager_access_uri': 'http://manager/api/v1/',
+            'delorean.manager_access_username': 'user',
+            'delorean.manager_access_api_key': 'key',
+            'delorean.checkpoint.dir': '/tmp/checkpoints',
+        })
+        self.addCleanup(testing.tearDown)
+        config.registry.lookup_cache = object()
+        config.registry.record_store = object()
+
+        dl = _delorean(config.registry, None, None)
+        self.assertTrue(dl._lookup_cache is config.registry.lookup_cache)
+        self.assertTrue(dl._record_store is config.registry.record_store)
+        self.assertEqual(dl._checkpoint_dir, '/tmp/checkpoints')
+
+        dl = _delorean(config.registry, None, None, data_source=object())
+        self.assertIsNone(dl._lookup_cache)
+        self.assertIsNone(dl._record_store)
+        self.assertIsNone(dl._checkpoint_dir)
+
+
+class ShardingTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _generate(self, **kwargs):
+        from delorean.domain import DeLorean, Transformer, TitleCollector
+
+        class Collector(TitleCollector):
+            def __iter__(self):
+                return iter([{'acronym': acronym} for acronym in
+                             ['abcd', 'rsp', 'bjmbr', 'rbepid', 'abcd']])
+
+        dl = DeLorean('http://manager/api/v1/', titlecollector=Collector,
+                      transformer=lambda filename: Transformer(
+                          '!ID 0\n!v068!${acronym}'))
+        name = dl.generate_title(self.tmpdir, **kwargs)
+        bundle = tarfile.open(os.path.join(self.tmpdir, name))
+        try:
+            return dict((member, bundle.extractfile(member).read())
+                        for member in bundle.getnames())
+        finally:
+            bundle.close()
+
+    def test_by_count(self):
+        import hashlib
+        members = self._generate(shards=2)
+        self.assertEqual(sorted(members), ['title.000.id', 'title.001.id',
+                                           'title.manifest.json'])
+        self.assertEqual(members['title.000.id'],
+                         b'!ID 0\n!v068!abcd\n!ID 0\n!v068!rsp\n'
+                         b'!ID 0\n!v068!bjmbr')
+        self.assertEqual(members['title.001.id'],
+                         b'!ID 0\n!v068!rbepid\n!ID 0\n!v068!abcd')
+
+        manifest = json.loads(members['title.manifest.json'])
+        self.assertEqual(manifest['shard_by'], 'count')
+        self.assertEqual(manifest['records'], 5)
+        self.assertEqual([shard['records'] for shard in manifest['shards']],
+                         [3, 2])
+        for shard in manifest['shards']:
+            self.assertEqual(shard['sha1'],
+                             hashlib.sha1(members[shard['name']]).hexdigest())
+
+    def test_by_journal(self):
+        members = self._generate(shards=3, shard_by='journal', formats=['id', 'iso'])
+        self.assertIn('title.iso', members)
+        acronyms = {}
+        for i in range(3):
+            for line in members['title.%03d.id' % i].splitlines():
+                if line.startswith(b'!v068!'):
+                    acronyms.setdefault(line[6:], set()).add(i)
+        self.assertEqual(sorted(acronyms),
+                         [b'abcd', b'bjmbr', b'rbepid', b'rsp'])
+        # the records of a journal are kept in a shard
+        self.assertEqual(len(acronyms[b'abcd']), 1)
+
+    def test_more_shards_than_records(self):
+        members = self._generate(shards=7)
+        manifest = json.loads(members['title.manifest.json'])
+        self.assertEqual(len(manifest['shards']), 7)
+        self.assertEqual(members['title.006.id'], b'')
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self._generate, shards=0)
+        self.assertRaises(ValueError, self._generate, shards=2, shard_by='issn')
+
+    def test_shards_are_rendered_by_other_processes(self):
+        from delorean.domain import DeLorean, Transformer
+        from delorean.compact import record_type
+        import multiprocessing
+        Record = record_type('Record', ['acronym'])
+        transformer = Transformer('<%! import os %>${acronym} ${os.getpid()}')
+        groups = [[{'acronym': 'abcd'}, Record.project({'acronym': 'rsp'})],
+                  [{'acronym': 'bjmbr'}]]
+
+        cpu_count = multiprocessing.cpu_count
+        multiprocessing.cpu_count = lambda: 1
+        try:
+            texts = DeLorean('http://manager/api/v1/')._render_shards(
+                groups, transformer)
+            self.assertEqual(set(int(text.split()[1]) for group in texts
+                                 for text in group), set([os.getpid()]))
+
+            multiprocessing.cpu_count = lambda: 2
+            texts = DeLorean('http://manager/api/v1/')._render_shards(
+                groups, transformer)
+        finally:
+            multiprocessing.cpu_count = cpu_count
+
+        self.assertEqual([[text.split()[0] for text in group] for group in texts],
+                         [['abcd', 'rsp'], ['bjmbr']])
+        pids = set(int(text.split()[1]) for group in texts for text in group)
+        self.assertFalse(os.getpid() in pids)
+
+    def test_rendering_shards_stops_at_the_deadline(self):
+        import time
+        import multiprocessing
+        from delorean.domain import DeLorean, Transformer
+        from delorean.resilience import CancellationToken, DeadlineExceeded
+        transformer = Transformer('<%! import time %>${time.sleep(30)}')
+        dl = DeLorean('http://manager/api/v1/',
+                      cancellation=CancellationToken(timeout=0.3))
+
+        cpu_count = multiprocessing.cpu_count
+        multiprocessing.cpu_count = lambda: 2
+        start = time.time()
+        try:
+            self.assertRaises(DeadlineExceeded, dl._render_shards,
+                              [[{}], [{}]], transformer)
+        finally:
+            multiprocessing.cpu_count = cpu_count
+        self.assertTrue(time.time() - start < 5)
+
+    def test_parallel_map(self):
+        from delorean.concurrency import parallel_map
+        self.assertEqual(parallel_map(lambda x: x * 2, [1, 2, 3]), [2, 4, 6])
+        self.assertRaises(ZeroDivisionError, parallel_map,
+                          lambda x: 1 / x, [1, 0, 2])
+
+
+class GenerateScriptTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.config_uri = os.path.join(self.tmpdir, 'batch.ini')
+        with open(self.config_uri, 'w') as f:
+            f.write('[app:main]\n'
+                    'use = call:delorean:main\n'
+                    'delorean.manager_access_uri = http://manager/api/v1/\n'
+                    'delorean.manager_access_username = user\n'
+                    'delorean.manager_access_api_key = key\n')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _generate(self, *args):
+        from delorean import scripts
+        calls = []
+        tmpdir = self.tmpdir
+
+        class FakeDeLorean(object):
+            def _handler(resource_name):
+                def handler(self, target, **kwargs):
+                    calls.append((resource_name, target, kwargs))
+                    if resource_name == 'section':
+                        raise ValueError('broken')
+                    name = '%s-20140101.tar' % resource_name
+                    with open(os.path.join(tmpdir, name), 'w') as f:
+                        f.write('bundle')
+                    return name
+                return handler
+            generate_title = _handler('title')
+            generate_issue = _handler('issue')
+            generate_section = _handler('section')
+
+        import StringIO
+        original = scripts._delorean
+        scripts._delorean = lambda *args, **kwargs: FakeDeLorean()
+        try:
+            status = scripts.generate(['delorean-generate', self.config_uri] +
+                                      list(args) + ['--out', self.tmpdir],
+                                      stream=StringIO.StringIO())
+        finally:
+            scripts._delorean = original
+        return status, sorted(calls)
+
+    def test_single_resource(self):
+        status, calls = self._generate('title', '--collection', 'brasil',
+                                       '--formats', 'id,iso', '--shards', '4')
+        self.assertEqual(status, 0)
+        self.assertEqual(calls, [('title', self.tmpdir, {
+            'collection': 'brasil', 'formats': ('id', 'iso'),
+            'shards': 4, 'shard_by': 'count'})])
+
+    def test_all_resources(self):
+        status, calls = self._generate('all', '--workers', '2')
+        self.assertEqual(status, 1)  # the section bundle failed
+        self.assertEqual([call[0] for call in calls],
+                         ['issue', 'section', 'title'])
+
+class CompactRecordTests(unittest.TestCase):
+
+    def test_mapping(self):
+        from delorean.compact import record_type
+        Record = record_type('Record', ['title', 'volume', 'number'])
+        record = Record.project({'title': 'Abcd', 'volume': '1', 'extra': 'x'})
+
+        self.assertEqual(record['title'], 'Abcd')
+        self.assertEqual(sorted(record.keys()), ['title', 'volume'])
+        self.assertTrue('volume' in record)
+        self.assertFalse('number' in record)
+        self.assertFalse('keys' in record)
+        self.assertRaises(KeyError, lambda: record['extra'])
+        self.assertEqual(record.get('number', 'n'), 'n')
+        self.assertEqual(record, {'title': 'Abcd', 'volume': '1'})
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertRaises(AttributeError, setattr, record, 'title', 'Other')
+
+    def test_rendering_and_serialization(self):
+        from delorean.compact import record_type
+        from delorean.domain import Transformer
+        from delorean.writers import JSONLinesWriter
+        from delorean.rendercache import fingerprint
+        Journal = record_type('Journal', ['acronym'])
+        Issue = record_type('Issue', ['journal', 'volume'])
+        issue = Issue.project({'journal': Journal.project({'acronym': 'abcd'}),
+                               'volume': '2'})
+
+        transformer = Transformer(
+            "${journal['acronym']}\n"
+            "% if number is UNDEFINED:\n"
+            "${volume}\n"
+            "% endif\n")
+        self.assertEqual(transformer.transform(issue), 'abcd\n2\n')
+
+        writer = JSONLinesWriter()
+        writer.write(issue)
+        self.assertEqual(json.loads(writer.getvalue()),
+                         {'journal': {'acronym': 'abcd'}, 'volume': '2'})
+        self.assertEqual(fingerprint('v1', issue),
+                         fingerprint('v1', issue.to_dict()))
+
+    def test_issue_journals_are_shared(self):
+        from delorean.domain import IssueCollector
+
+        class Collector(IssueCollector):
+            def _lookup_field(self, endpoint, res_id, field):
+                self._dependencies.add('%s-%s' % (endpoint, res_id))
+                return '%s-%s' % (field, res_id)
+
+        def issue(res_id, journal):
+            return {'id': res_id, 'journal': '/api/v1/journals/%s/' % journal,
+                    'created': '2012-07-18T17:47:09', 'updated':
+                    '2012-07-18T17:47:09', 'publication_end_month': 3,
+                    'publication_start_month': 1, 'publication_year': 2012,
+                    'use_license': None, 'sections': [], 'type': 'regular',
+                    'volume': '1', 'number': str(res_id), 'order': res_id,
+                    'suppl_volume': None, 'suppl_number': None,
+                    'cover': 'unused', 'label': 'unused'}
+
+        collector = Collector('http://manager/api/v1/', compact=True)
+        first = collector._get_record(issue(1, 7))
+        second = collector._get_record(issue(2, 7))
+        other = collector._get_record(issue(3, 8))
+
+        self.assertTrue(first[2]['journal'] is second[2]['journal'])
+        self.assertFalse(first[2]['journal'] is other[2]['journal'])
+        self.assertEqual(second[1], ['journals-7'])
+        self.assertFalse('cover' in first[2])
+        self.assertEqual(first[2]['journal']['acronym'], 'acronym-7')
+        self.assertEqual(collector.journal_acronym(other[2]), 'acronym-8')
+
+        plain = Collector('http://manager/api/v1/')._get_record(issue(1, 7))
+        self.assertEqual(first[2].to_dict(),
+                         dict((field, value) for field, value in plain[2].items()
+                              if field in first[2]))
+
+class DummyAdapter(object):
+    """
+    Transport adapter that answers every request with ``responses``,
+    in order, or with an empty JSON object.
+    """
+    def __init__(self, responses=None):
+        self.responses = list(responses or [])
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        import requests
+        self.requests.append(request)
+        if self.responses:
+            status, body, headers = self.responses.pop(0)
+        else:
+            status, body, headers = 200, '{}', {}
+
+        response = requests.Response()
+        response.status_code = status
+        response._content = body
+        response.headers.update(headers)
+        response.headers.setdefault('content-type', 'application/json')
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
@@ -0,0 +1,118 @@
+# coding: utf-8
+"""
+Lightweight tracing of the generations.
+
+Spans are recorded by the :class:`Tracer` active on the current thread,
+which is passed on to the threads it starts with :func:`traced`, and
+exported as JSON-lines, one Chrome trace-viewer *complete event*
+(``"ph": "X"``) per line. Wrapping the lines in a JSON list produces a
+file that can be loaded in ``chrome://tracing``::
+
+    json.dump(Tracer.load('trace.jsonl'), open('trace.json', 'w'))
+"""
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+_local = threading.local()
+
+
+@contextmanager
+def span(name, cat='delorean', **args):
+    """
+    Records a span on the tracer active on the current thread, if any.
+
+    Yields the span ``args`` dict, so that the caller can annotate the
+    span with data known only after the traced operation has finished.
+    """
+    tracer = getattr(_local, 'tracer', None)
+    if tracer is None:
+        yield args
+    else:
+        with tracer.span(name, cat=cat, **args) as span_args:
+            yield span_args
+
+
+def traced(func):
+    """
+    Returns ``func`` wrapped to run with the tracer active on the calling
+    thread, if any, so the spans of the thread it is handed to are
+    recorded by the same tracer.
+    """
+    tracer = getattr(_local, 'tracer', None)
+    if tracer is None:
+        return func
+
+    def wrapper(*args, **kwargs):
+        with tracer.activate():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class Tracer(object):
+    """
+    Collects the spans of a generation.
+    """
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self.events = []
+
+    @contextmanager
+    def activate(self):
+        """
+        Makes the tracer record the spans of the calling thread.
+        """
+        previous = getattr(_local, 'tracer', None)
+        _local.tracer = self
+        try:
+            yield self
+        finally:
+            _local.tracer = previous
+
+    @contextmanager
+    def span(self, name, cat='delorean', **args):
+        start = self._clock()
+        try:
+            yield args
+        except Exception as exc:
+            args['error'] = repr(exc)
+            raise
+        finally:
+            event = {
+                'name': name,
+                'cat': cat,
+                'ph': 'X',
+                'ts': int(start * 1000000),
+                'dur': int((self._clock() - start) * 1000000),
+                'pid': self._pid,
+                'tid': threading.current_thread().ident,
+                'args': args,
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def export(self, path):
+        """
+        Writes the recorded events to ``path``, as JSON-lines sorted by
+        their start time.
+        """
+        base_path = os.path.dirname(path)
+        if base_path and not os.path.exists(base_path):
+            os.makedirs(base_path, 0755)
+
+        with self._lock:
+            events = sorted(self.events, key=lambda e: e['ts'])
+
+        with open(path, 'w') as f:
+            for event in events:
+                f.write(json.dumps(event) + '\n')
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
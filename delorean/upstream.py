@@ -0,0 +1,157 @@
+# coding: utf-8
+"""
+HTTP session used to talk to the Journal Manager API.
+"""
+import time
+import urllib
+import urlparse
+
+import requests
+
+from .tracing import span
+from .concurrency import endpoint_name
+
+
+# query params that are not part of a request identity
+UNKEYED_PARAMS = ('username', 'api_key')
+
+
+def request_key(method, url, params=None):
+    """
+    Identifies a request, regardless of the credentials it carries.
+    """
+    params = sorted((k, v) for k, v in (params or {}).items()
+                    if k not in UNKEYED_PARAMS)
+    if params:
+        url = '%s?%s' % (url, urllib.urlencode(params))
+    return '%s %s' % (method.upper(), url)
+
+
+def is_listing(url):
+    """
+    Tells if ``url`` is a page of a resource listing, e.g.
+    ``http://manager.scielo.org/api/v1/journals/``, rather than a
+    resource.
+    """
+    segments = [seg for seg in urlparse.urlsplit(url).path.split('/') if seg]
+    return bool(segments) and not segments[-1].isdigit()
+
+
+class UpstreamSession(requests.Session):
+    """
+    ``requests.Session`` handed to slumber, where every request made
+    to the upstream API passes through.
+
+    When a :class:`delorean.cassette.Cassette` is given, the responses
+    are recorded to it or, in replay mode, served from it instead of
+    reaching the network. When a :class:`delorean.httpcache.HTTPCache`
+    is given, ``GET`` responses are cached and revalidated. When a
+    :class:`delorean.concurrency.UpstreamLimiter` is given, the requests
+    that reach the network wait for it, and the time spent waiting is
+    accumulated in ``limiter_wait``. When a
+    :class:`delorean.resilience.CircuitBreaker` is given, it is fed with
+    the outcome of those requests and may refuse them. When a
+    :class:`delorean.concurrency.HedgingPolicy` is given, slow ``GET``
+    requests are hedged.
+
+    With ``refetch_listings``, listing pages are always requested again,
+    even when their cached responses are fresh, e.g. when rebuilding after
+    a resource was created.
+    """
+    def __init__(self, cassette=None, cache=None, limiter=None, breaker=None,
+                 hedging=None, refetch_listings=False):
+        super(UpstreamSession, self).__init__()
+        self._cassette = cassette
+        self._cache = cache
+        self._limiter = limiter
+        self._breaker = breaker
+        self._hedging = hedging
+        self._refetch_listings = refetch_listings
+        self.limiter_wait = 0.0
+
+    def _limited(self, method, url, **kwargs):
+        if self._limiter is None:
+            return super(UpstreamSession, self).request(method, url, **kwargs)
+
+        with self._limiter.slot(endpoint_name(url)) as wait:
+            self.limiter_wait += wait
+            response = super(UpstreamSession, self).request(method, url, **kwargs)
+
+        response.limiter_wait = wait
+        return response
+
+    def _hedged(self, method, url, **kwargs):
+        if self._hedging is None or method.upper() != 'GET':
+            return self._limited(method, url, **kwargs)
+
+        return self._hedging.call(endpoint_name(url),
+            lambda: self._limited(method, url, **kwargs))
+
+    def _network(self, method, url, **kwargs):
+        if self._breaker is None:
+            return self._hedged(method, url, **kwargs)
+
+        self._breaker.before_call()
+        try:
+            response = self._hedged(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self._breaker.on_failure()
+            raise
+
+        if response.status_code >= 500:
+            self._breaker.on_failure()
+        else:
+            self._breaker.on_success()
+        return response
+
+    def _fetch(self, method, url, **kwargs):
+        if self._cache is None or method.upper() != 'GET':
+            return self._network(method, url, **kwargs)
+
+        key = request_key(method, url, kwargs.get('params'))
+        entry = self._cache.get(key)
+        if entry is not None:
+            listing = is_listing(url)
+            if (self._cache.is_fresh(entry, listing=listing) and
+                    not (self._refetch_listings and listing)):
+                response = self._cache.response(entry, url)
+                response.cache_status = 'fresh'
+                return response
+
+            headers = dict(kwargs.get('headers') or {})
+            headers.update(self._cache.validators(entry))
+            kwargs['headers'] = headers
+
+        response = self._network(method, url, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            self._cache.refresh(key, entry, response)
+            response = self._cache.response(entry, url)
+            response.cache_status = 'revalidated'
+        elif response.status_code == 200:
+            self._cache.store(key, response)
+            response.cache_status = 'miss'
+
+        return response
+
+    def _send(self, method, url, **kwargs):
+        if self._cassette is not None and self._cassette.replaying:
+            return self._cassette.play(method, url, kwargs.get('params'))
+
+        start = time.time()
+        response = self._fetch(method, url, **kwargs)
+
+        if self._cassette is not None:
+            self._cassette.record(method, url, kwargs.get('params'),
+                                  response, time.time() - start)
+        return response
+
+    def request(self, method, url, **kwargs):
+        with span('http', cat='upstream', method=method, url=url) as args:
+            response = self._send(method, url, **kwargs)
+            args['status'] = response.status_code
+            args['bytes'] = len(response.content)
+            args['cache'] = getattr(response, 'cache_status', None)
+            args['limiter_wait'] = getattr(response, 'limiter_wait', 0.0)
+
+        return response
@@ -1,18 +1,452 @@
 # coding: utf-8
 import os
+import json
 import time
+import logging
+import functools
+import threading
+from contextlib import contextmanager
 
-from .domain import DeLorean
+from .domain import DeLorean, OUTPUT_FORMATS, SHARD_BY
+from .cassette import Cassette
+from .httpcache import HTTPCache
+from .serializers import json_serializer
+from .resilience import (
+    CircuitOpenError,
+    CancellationToken,
+    DeadlineExceeded,
+    GenerationCancelled,
+)
+from .profiling import GenerationProfiler, MemoryProfiler, ProfilerBusyError
+from .tracing import Tracer
+from .upstream import UpstreamSession, request_key
+from . import delta
 
 from pyramid.view import view_config
 from pyramid import httpexceptions
+from pyramid.response import Response
+from pyramid.settings import asbool, aslist
 
+logger = logging.getLogger(__name__)
 HERE = os.path.abspath(os.path.dirname(__file__))
 RESOURCE_HANDLERS = {
     'title': 'generate_title',
     'issue': 'generate_issue',
     'section': 'generate_section'
 }
+# resource types of the change notices, and their API endpoints
+NOTICE_ENDPOINTS = {
+    'journal': 'journals',
+    'issue': 'issues',
+    'section': 'sections',
+    'sponsor': 'sponsors',
+    'user': 'users',
+}
+NOTICE_ACTIONS = ('create', 'update', 'delete')
+
+# bundles are refreshed one change notice at a time
+_refresh_lock = threading.Lock()
+
+
+def _is_allowed_client(request, setting):
+    """
+    Checks if the request comes from one of the addresses listed
+    in ``setting``.
+    """
+    allowed_clients = aslist(request.registry.settings.get(setting, ''))
+    return request.client_addr in allowed_clients
+
+
+def _is_admin_client(request):
+    return _is_allowed_client(request, 'delorean.admin_clients')
+
+
+def _admin_flag(request, setting, param):
+    """
+    Checks if an opt-in feature, enabled by ``setting``, was requested
+    through the ``param`` query parameter by an admin client.
+    """
+    settings = request.registry.settings
+    return all([asbool(settings.get(setting, False)),
+                request.GET.get(param) == '1',
+                _is_admin_client(request)])
+
+
+def _profiling_requested(request):
+    return _admin_flag(request, 'delorean.profiling', 'profile')
+
+
+def _memory_profiling_requested(request):
+    return _admin_flag(request, 'delorean.memory_profiling', 'memory')
+
+
+@contextmanager
+def _memory_profiling(request, result):
+    """
+    Measures the memory used by each generation phase, when requested,
+    and adds the report to ``result``. Only one generation is measured
+    at a time, others are answered with 409.
+    """
+    if not _memory_profiling_requested(request):
+        yield
+        return
+
+    profiler = MemoryProfiler(top_n=int(request.registry.settings.get(
+        'delorean.memory_profiling.top_n', 10)))
+    try:
+        with profiler.activate():
+            yield
+    except ProfilerBusyError as exc:
+        raise httpexceptions.HTTPConflict(comment=str(exc))
+    result['memory_profile'] = profiler.report()
+
+
+def _sampled(registry, resource_name, func):
+    """
+    Returns ``func`` wrapped to be visible to the stack sampler, when it
+    is enabled, in whichever thread the generation runs.
+    """
+    sampler = getattr(registry, 'sampler', None)
+    if sampler is None:
+        return func
+
+    def wrapper(*args, **kwargs):
+        with sampler.track(resource_name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _cassette(request, resource_name, collection):
+    """
+    Returns the cassette where the upstream responses of the generation
+    are recorded to, or replayed from, if enabled.
+    """
+    settings = request.registry.settings
+    mode = settings.get('delorean.cassette.mode', 'off')
+    if mode == 'off':
+        return None
+
+    cassette_dir = settings.get('delorean.cassette.dir',
+                                os.path.join(HERE, 'cassettes'))
+    if not os.path.exists(cassette_dir):
+        os.makedirs(cassette_dir, 0755)
+
+    return Cassette(
+        os.path.join(cassette_dir, '%s-%s.cassette.gz' % (
+            resource_name, collection or 'all')),
+        mode=mode,
+        emulate_timing=asbool(settings.get(
+            'delorean.cassette.emulate_timing', False)))
+
+
+def _http_cache(settings):
+    cache_dir = settings.get('delorean.http_cache.dir', None)
+    if not cache_dir:
+        return None
+
+    return HTTPCache(cache_dir,
+                     ttl=int(settings.get('delorean.http_cache.ttl', 3600)))
+
+
+def _single_flight(registry, key, func, timeout=None, cancellation=None):
+    """
+    Runs ``func`` unless a call with the same ``key`` is already in
+    flight, in which case its result is shared. The ``cancellation``
+    token of ``func`` is cancelled if every caller gives up waiting.
+    """
+    single_flight = getattr(registry, 'single_flight', None)
+    if single_flight is None:
+        return func(), False
+
+    return single_flight.do(key, func, timeout=timeout,
+                            cancellation=cancellation)
+
+
+def _client_timeout(request):
+    """
+    Seconds the client is willing to wait, given by the ``timeout``
+    query param, if any.
+    """
+    if not request.GET.get('timeout'):
+        return None
+    try:
+        return float(request.GET['timeout'])
+    except ValueError:
+        raise httpexceptions.HTTPBadRequest(comment='invalid timeout')
+
+
+def _cancellation(request=None, registry=None):
+    """
+    Returns the cancellation token of the generation, whose deadline is
+    given by the ``timeout`` query param (seconds), limited to the
+    ``delorean.generation.max_time`` setting.
+    """
+    registry = registry or request.registry
+    timeouts = []
+    if request is not None and _client_timeout(request) is not None:
+        timeouts.append(_client_timeout(request))
+
+    max_time = registry.settings.get('delorean.generation.max_time')
+    if max_time:
+        timeouts.append(float(max_time))
+
+    return CancellationToken(timeout=min(timeouts) if timeouts else None)
+
+
+@contextmanager
+def _tracing(tracer):
+    if tracer is None:
+        yield
+    else:
+        with tracer.activate():
+            yield
+
+
+def _upstream_session(registry, cassette=None, refetch_listings=False):
+    return UpstreamSession(
+        cassette=cassette, cache=_http_cache(registry.settings),
+        limiter=getattr(registry, 'upstream_limiter', None),
+        breaker=getattr(registry, 'circuit_breaker', None),
+        hedging=getattr(registry, 'hedging', None),
+        refetch_listings=refetch_listings)
+
+
+def _delorean(registry, session, cancellation, data_source=None,
+              cassette=None):
+    settings = registry.settings
+    # generations from a snapshot don't share the caches, checkpoints and
+    # stored records of the live ones.
+    live = data_source is None
+    lookup_cache = checkpoint_dir = record_store = None
+    if live:
+        checkpoint_dir = settings.get('delorean.checkpoint.dir') or None
+        record_store = getattr(registry, 'record_store', None)
+    # the lookups served by the shared cache wouldn't reach the cassette
+    if live and cassette is None:
+        lookup_cache = getattr(registry, 'lookup_cache', None)
+    return DeLorean(settings['delorean.manager_access_uri'],
+                    username=settings['delorean.manager_access_username'],
+                    api_key=settings['delorean.manager_access_api_key'],
+                    session=session,
+                    serializer=json_serializer(
+                        decoder=settings.get('delorean.json.decoder', 'auto'),
+                        incremental=asbool(settings.get(
+                            'delorean.json.incremental', False))),
+                    lookup_cache=lookup_cache,
+                    cancellation=cancellation,
+                    checkpoint_dir=checkpoint_dir,
+                    checkpoint_max_age=int(settings.get(
+                        'delorean.checkpoint.max_age', 3600)),
+                    record_store=record_store,
+                    render_cache=getattr(registry, 'render_cache', None),
+                    data_source=data_source,
+                    compact_records=asbool(settings.get(
+                        'delorean.compact_records', False)))
+
+
+def _delta_from(request, resource_name, target):
+    """
+    Returns the name of the bundle, given by the ``delta_from`` query
+    param, against which a delta bundle was requested. It must be a
+    full bundle of the resource with its ID file.
+    """
+    name = request.GET.get('delta_from')
+    if not name:
+        return None
+
+    if (os.path.basename(name) != name or
+            not name.startswith(resource_name + '-') or
+            name.startswith(resource_name + '-delta-')):
+        raise httpexceptions.HTTPBadRequest(comment='invalid delta_from')
+    if not os.path.exists(os.path.join(target, name)):
+        raise httpexceptions.HTTPNotFound(comment='unknown delta_from')
+    if not delta.is_full_bundle(os.path.join(target, name), resource_name):
+        raise httpexceptions.HTTPBadRequest(
+            comment='delta_from isn\'t a full bundle with the ID file')
+    return name
+
+
+def _formats(request):
+    """
+    Returns the output formats given by the ``formats`` query param, a
+    comma separated list, or ``None`` for the default ones.
+    """
+    if not request.GET.get('formats'):
+        return None
+
+    formats = tuple(fmt.strip() for fmt in request.GET['formats'].split(',')
+                    if fmt.strip())
+    if not formats or set(formats) - set(OUTPUT_FORMATS):
+        raise httpexceptions.HTTPBadRequest(comment='invalid formats')
+    return formats
+
+
+def _shards(request):
+    """
+    Returns the number of shards of the ID file, given by the ``shards``
+    query param, and how the records are split, given by ``shard_by``,
+    or ``None`` for a single ID file.
+    """
+    if not request.GET.get('shards'):
+        return None
+
+    try:
+        shards = int(request.GET['shards'])
+    except ValueError:
+        shards = 0
+    shard_by = request.GET.get('shard_by', 'count')
+    if not 0 < shards <= 256 or shard_by not in SHARD_BY:
+        raise httpexceptions.HTTPBadRequest(comment='invalid sharding')
+    return shards, shard_by
+
+
+def _prebuilt(request, resource_name, collection):
+    """
+    Returns the name of a bundle pre-generated by the scheduler that is
+    recent enough to be served instead of generating a new one.
+    """
+    prebuilt = getattr(request.registry, 'prebuilt_bundles', None)
+    if prebuilt is None or request.GET.get('fresh') == '1':
+        return None
+
+    max_age = int(request.registry.settings.get(
+        'delorean.schedule.max_age', 3600))
+    return prebuilt.fresh(resource_name, collection, max_age)
+
+
+def pregenerate(registry, resource_name, collection=None):
+    """
+    Generates a bundle outside of a request, on behalf of the scheduler,
+    and records it as the prebuilt bundle of the resource and collection.
+    """
+    session = _upstream_session(registry)
+    dl = _delorean(registry, session, _cancellation(registry=registry))
+    handler = getattr(dl, RESOURCE_HANDLERS[resource_name])
+
+    # the scheduler waits for the generation, it is never cancelled
+    bundle_name, coalesced = _single_flight(
+        registry, (resource_name, collection, None, None, None),
+        _sampled(registry, resource_name, functools.partial(
+            handler, os.path.join(HERE, 'public'), collection=collection)))
+    registry.prebuilt_bundles.record(resource_name, collection, bundle_name)
+    return bundle_name
+
+
+def _parse_notices(request):
+    """
+    Returns the ``(endpoint, id, action)`` changes of the notices in the
+    request body, a JSON object or a list of them with the keys
+    ``resource_type``, ``id`` and ``action``.
+    """
+    try:
+        notices = json.loads(request.body)
+    except ValueError:
+        raise httpexceptions.HTTPBadRequest(comment='invalid JSON')
+
+    if not isinstance(notices, list):
+        notices = [notices]
+
+    changes = []
+    for notice in notices:
+        try:
+            endpoint = NOTICE_ENDPOINTS[notice['resource_type']]
+            res_id = unicode(notice['id'])
+            action = notice['action']
+        except (KeyError, TypeError):
+            raise httpexceptions.HTTPBadRequest(comment='invalid notice')
+
+        if action not in NOTICE_ACTIONS:
+            raise httpexceptions.HTTPBadRequest(comment='invalid action')
+        changes.append((endpoint, res_id, action))
+
+    return changes
+
+
+def _invalidate(registry, changes):
+    """
+    Drops the changed resources from the lookup and HTTP caches. The
+    cached listing pages, which embed them, are expired as a whole.
+    """
+    settings = registry.settings
+    lookup_cache = getattr(registry, 'lookup_cache', None)
+    http_cache = _http_cache(settings)
+    api_uri = settings['delorean.manager_access_uri'].rstrip('/')
+
+    # the resources are looked up with the collection being generated
+    params = [None, {'collection': None}]
+    record_store = getattr(registry, 'record_store', None)
+    if record_store is not None:
+        params.extend({'collection': collection}
+                      for resource_name in RESOURCE_HANDLERS
+                      for collection in record_store.collections(resource_name)
+                      if collection is not None)
+
+    if http_cache is not None and changes:
+        http_cache.expire_listings()
+
+    for endpoint, res_id, action in changes:
+        if lookup_cache is not None:
+            lookup_cache.invalidate('%s-%s' % (endpoint, res_id))
+        if http_cache is not None:
+            url = '%s/%s/%s/' % (api_uri, endpoint, res_id)
+            for param in params:
+                http_cache.invalidate(request_key('GET', url, param))
+
+
+def _rebuild(dl, resource_name, changes, target, collection, current):
+    bundle_name = dl.refresh(resource_name, changes, target,
+                             collection=collection, current=current)
+    if bundle_name is None:
+        bundle_name = getattr(dl, RESOURCE_HANDLERS[resource_name])(
+            target, collection=collection)
+    return bundle_name
+
+
+def refresh_bundles(registry, changes):
+    """
+    Rebuilds the stored bundles affected by ``changes``, re-rendering
+    only the records that changed when possible.
+    """
+    target = os.path.join(HERE, 'public')
+    prebuilt = getattr(registry, 'prebuilt_bundles', None)
+
+    with _refresh_lock:
+        for resource_name in sorted(RESOURCE_HANDLERS):
+            for collection in registry.record_store.collections(resource_name):
+                # the listings cached before the notices are outdated when
+                # a full generation is needed, e.g. after a creation.
+                dl = _delorean(registry, _upstream_session(
+                                   registry, refetch_listings=True),
+                               _cancellation(registry=registry))
+                current = None
+                if prebuilt is not None:
+                    current = prebuilt.current(resource_name, collection)
+                rebuild = _sampled(registry, resource_name, _rebuild)
+                try:
+                    bundle_name = rebuild(dl, resource_name, changes, target,
+                                          collection, current)
+                    if current is not None and bundle_name == current:
+                        continue  # none of its records changed
+                except Exception:
+                    logger.exception('Unable to refresh the %s bundle of %s.' % (
+                        resource_name, collection or 'all'))
+                    continue
+
+                if prebuilt is not None:
+                    prebuilt.record(resource_name, collection, bundle_name)
+
+
+def _in_background(func, *args):
+    thread = threading.Thread(target=func, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _unavailable(retry_after):
+    return httpexceptions.HTTPServiceUnavailable(
+        comment='upstream unavailable',
+        headers={'Retry-After': str(retry_after)})
 
 
 @view_config(route_name='home', renderer='jsonp')
@@ -34,18 +468,156 @@ def bundle_generator(request):
         raise httpexceptions.HTTPInternalServerError(
             comment='missing configuration')
 
-    dl = DeLorean(api_uri, username=username, api_key=api_key)
+    if resource_name not in RESOURCE_HANDLERS:
+        raise httpexceptions.HTTPNotFound()
+
+    target = os.path.join(HERE, 'public')
+    delta_from = _delta_from(request, resource_name, target)
+    handler_kwargs = {'collection': collection}
+    if delta_from is not None:
+        handler_kwargs['delta_from'] = delta_from
+    formats = _formats(request)
+    if formats is not None:
+        handler_kwargs['formats'] = formats
+    sharding = _shards(request)
+    if sharding is not None:
+        if delta_from is not None:
+            raise httpexceptions.HTTPBadRequest(
+                comment='delta bundles can\'t be sharded')
+        handler_kwargs['shards'], handler_kwargs['shard_by'] = sharding
+
+    prebuilt_name = None
+    if delta_from is None and formats is None and sharding is None:
+        prebuilt_name = _prebuilt(request, resource_name, collection)
+    if prebuilt_name is not None:
+        return {
+            'resource_name': resource_name,
+            'prebuilt': True,
+            'expected_bundle_url': request.static_url(
+                'delorean:public/%s' % prebuilt_name),
+            'elapsed_time': time.time() - start_time,
+        }
+
+    breaker = getattr(request.registry, 'circuit_breaker', None)
+    if breaker is not None and breaker.state == breaker.OPEN:
+        raise _unavailable(breaker.retry_after())
+
+    # a coalesced generation is shared by requests with other timeouts,
+    # so it runs under the configured limit only, and each request just
+    # stops waiting for it on its own timeout. Profiled generations aren't
+    # shared, they must run in the request thread to be measured.
+    shared = (getattr(request.registry, 'single_flight', None) is not None and
+              not _profiling_requested(request) and
+              not _memory_profiling_requested(request))
+    if shared:
+        cancellation = _cancellation(registry=request.registry)
+    else:
+        cancellation = _cancellation(request)
+    cassette = _cassette(request, resource_name, collection)
+    settings = request.registry.settings
+    session = _upstream_session(request.registry, cassette=cassette)
+    dl = _delorean(request.registry, session, cancellation, cassette=cassette)
+    handler = getattr(dl, RESOURCE_HANDLERS[resource_name])
+
+    def generate():
+        # a shared generation may outlive the request, so it closes
+        # the cassette it records to itself.
+        try:
+            return handler(target, **handler_kwargs)
+        finally:
+            if cassette is not None:
+                cassette.close()
+    generate = _sampled(request.registry, resource_name, generate)
+
+    result = {'resource_name': resource_name}
+    if delta_from is not None:
+        result['delta_from'] = delta_from
+
+    tracer = Tracer() if asbool(settings.get('delorean.tracing', False)) else None
 
     try:
-        bundle_url = getattr(dl, RESOURCE_HANDLERS[resource_name])(
-            os.path.join(HERE, 'public'), collection=collection)
-    except KeyError:
+        with _memory_profiling(request, result), _tracing(tracer):
+            if _profiling_requested(request):
+                profiler = GenerationProfiler(target, top_n=int(
+                    request.registry.settings.get('delorean.profiling.top_n', 30)))
+                bundle_url = profiler.run(generate)
+
+                stats_name, summary_name = profiler.dump(
+                    os.path.splitext(bundle_url)[0])
+                result['profile_stats_url'] = request.static_url(
+                    'delorean:public/%s' % stats_name)
+                result['profile_summary_url'] = request.static_url(
+                    'delorean:public/%s' % summary_name)
+            elif shared:
+                bundle_url, result['coalesced'] = _single_flight(
+                    request.registry,
+                    (resource_name, collection, delta_from, formats, sharding),
+                    generate, timeout=_client_timeout(request),
+                    cancellation=cancellation)
+            else:
+                bundle_url = generate()
+                result['coalesced'] = False
+    except CircuitOpenError as exc:
+        raise _unavailable(exc.retry_after)
+    except DeadlineExceeded:
+        raise httpexceptions.HTTPGatewayTimeout(
+            comment='generation deadline exceeded')
+    except GenerationCancelled:
+        raise httpexceptions.HTTPServiceUnavailable(
+            comment='generation cancelled')
+
+    result['expected_bundle_url'] = request.static_url(
+        'delorean:public/%s' % bundle_url
+    )
+
+    if tracer is not None:
+        result['trace_name'] = '%s.trace.jsonl' % os.path.splitext(bundle_url)[0]
+        tracer.export(os.path.join(
+            settings.get('delorean.tracing.dir', os.path.join(HERE, 'traces')),
+            result['trace_name']))
+    result['limiter_wait_time'] = session.limiter_wait
+    result['elapsed_time'] = time.time() - start_time
+
+    return result
+
+
+@view_config(route_name='admin_stacks')
+def sampled_stacks(request):
+    """
+    Serves the stacks sampled during the generations of a resource,
+    in the collapsed-stack format used to render flamegraphs.
+    """
+    if not _is_admin_client(request):
+        raise httpexceptions.HTTPForbidden()
+
+    sampler = getattr(request.registry, 'sampler', None)
+    resource_name = request.matchdict.get('resource')
+    if sampler is None or resource_name not in RESOURCE_HANDLERS:
         raise httpexceptions.HTTPNotFound()
 
-    return {
-        'resource_name': resource_name,
-        'expected_bundle_url': request.static_url(
-            'delorean:public/%s' % bundle_url
-        ),
-        'elapsed_time': time.time() - start_time,
-    }
+    body = sampler.collapsed(resource_name)
+    if request.GET.get('reset') == '1':
+        sampler.reset(resource_name)
+
+    return Response(body, content_type='text/plain', charset='utf-8')
+
+
+@view_config(route_name='notify', request_method='POST', renderer='jsonp')
+def change_notification(request):
+    """
+    Receives notices of resources changed in the Journal Manager,
+    dropping them from the caches and refreshing the stored bundles in
+    background.
+    """
+    if not _is_allowed_client(request, 'delorean.notification_clients'):
+        raise httpexceptions.HTTPForbidden()
+
+    changes = _parse_notices(request)
+    _invalidate(request.registry, changes)
+
+    refreshing = getattr(request.registry, 'record_store', None) is not None
+    if refreshing:
+        _in_background(refresh_bundles, request.registry, changes)
+
+    request.response.status = 202
+    return {'accepted': len(changes), 'refreshing': refreshing}
@@ -0,0 +1,72 @@
+# coding: utf-8
+"""
+Writers of the enriched records in formats other than ID.
+"""
+import csv
+import json
+import StringIO
+
+from .compact import CompactRecord
+from .storage import json_default
+
+
+class JSONLinesWriter(object):
+    """
+    One JSON object per record, per line.
+    """
+    extension = 'jsonl'
+
+    def __init__(self):
+        self._lines = []
+
+    def write(self, data):
+        self._lines.append(
+            json.dumps(data, sort_keys=True, default=json_default))
+
+    def getvalue(self):
+        return b'\n'.join(self._lines)
+
+
+class CSVWriter(object):
+    """
+    One row per record, with a column per field. Nested values are
+    JSON encoded. Columns are ordered as the fields first appear, so the
+    rows are laid out once all the records are known.
+    """
+    extension = 'csv'
+
+    def __init__(self):
+        self._columns = []
+        self._known = set()
+        self._rows = []
+
+    def _cell(self, value):
+        if value is None:
+            return b''
+        if isinstance(value, (dict, list, tuple, CompactRecord)):
+            return json.dumps(value, sort_keys=True, default=json_default)
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return bytes(value)
+
+    def write(self, data):
+        for key in data:
+            if key not in self._known:
+                self._known.add(key)
+                self._columns.append(key)
+        self._rows.append(dict((key, self._cell(value))
+                               for key, value in data.items()))
+
+    def getvalue(self):
+        out = StringIO.StringIO()
+        writer = csv.writer(out)
+        writer.writerow([column.encode('utf-8') for column in self._columns])
+        for row in self._rows:
+            writer.writerow([row.get(column, b'') for column in self._columns])
+        return out.getvalue()
+
+
+WRITERS = {
+    'jsonl': JSONLinesWriter,
+    'csv': CSVWriter,
+}
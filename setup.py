@@ -35,11 +35,18 @@ setup(name='delorean',
       include_package_data=True,
       zip_safe=False,
       install_requires=requires,
+      extras_require={
+          # faster and incremental decoding of the API responses
+          'speedups': ['ujson', 'ijson'],
+      },
       tests_require=requires,
       test_suite="delorean",
       entry_points = """\
       [paste.app_factory]
       main = delorean:main
+      [console_scripts]
+      delorean-snapshot = delorean.scripts:snapshot
+      delorean-generate = delorean.scripts:generate
       """,
       )
 